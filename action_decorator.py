@@ -1,9 +1,15 @@
+import atexit
+import collections
+import copy
 import errno
 import functools
 import os
 import shutil
 import stat
+import sys
 import tempfile
+import threading
+import timeit
 
 import six
 import attr
@@ -92,11 +98,50 @@ class ActionDecorator(object):
     Again, this *can* all be achieved with standard function decorators.
     Using ActionDecorators instead simply makes it a bit clearer to read
     and write.
+
+    A composed ActionDecorator is kept flat: it records the uncomposed
+    ActionDecorators it was composed from, in its parts, and its action
+    performs each of theirs in turn, however long the chain. For D above,
+    D.parts is (A, B, C). Its post actions are performed the same way,
+    in the reverse order. How long each action takes is added up in
+    TIMINGS.
+
+    The steps of an ActionDecorator are its parts, except that a part
+    which stands for a chain of other ActionDecorators, such as a state
+    from a StateCache, is replaced by the steps of that chain. Chains
+    which start the same way can be found by comparing their steps.
     """
 
     action = attr.ib()
     # TODO: validate that attr is a function taking a single argument?
     post_action = attr.ib(init=False, default=None)
+    composed_of = attr.ib(init=False, default=None, repr=False)
+    stands_for = attr.ib(init=False, default=None, repr=False)
+    _context_class = attr.ib(init=False, default=None, repr=False)
+
+    @property
+    def parts(self):
+        """The uncomposed ActionDecorators this one performs, in order."""
+        if self.composed_of is None:
+            return (self,)
+        return self.composed_of
+
+    @property
+    def steps(self):
+        steps = ()
+        for part in self.parts:
+            steps += part.stands_for or (part,)
+        return steps
+
+    @property
+    def name(self):
+        return getattr(self, "__name__", self.action.__name__)
+
+    def new_context(self):
+        if self._context_class is None:
+            self._context_class = type(
+                self.action.__name__ + "_ActionDecoratorContext", (), {})
+        return self._context_class()
 
     def __call__(self, context_arg):
         if six.PY3:
@@ -108,11 +153,18 @@ class ActionDecorator(object):
         else:
             return self._make_decorator(context_arg, None)
 
+    def run(self, ctx):
+        """Perform this ActionDecorator's action, timing each part of it."""
+        if self.composed_of is None:
+            TIMINGS.run(self, ctx)
+        else:
+            self.action(ctx)
+
     def _make_decorator(self, func, context_arg):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            ctx = type(self.action.__name__ + "_ActionDecoratorContext", (), {})()
-            self.action(ctx)
+            ctx = self.new_context()
+            self.run(ctx)
             try:
                 if context_arg is not None:
                     kwargs[context_arg] = ctx
@@ -163,21 +215,19 @@ class ActionDecorator(object):
 
         """
 
+        parts = self.parts + other.parts
+
         def then(ctx):
-            self.action(ctx)
-            other.action(ctx)
+            for part in parts:
+                TIMINGS.run(part, ctx)
 
         then.__name__ = self.action.__name__ + "_then_" + other.action.__name__
         then = ActionDecorator(then)
+        then.composed_of = parts
         if other.post_action or self.post_action:
 
             def after(ctx):
-                try:
-                    if other.post_action is not None:
-                        other.post_action(ctx)
-                finally:
-                    if self.post_action is not None:
-                        self.post_action(ctx)
+                run_post_actions(parts, ctx)
 
             if other.post_action is None:
                 after_name = self.post_action.__name__
@@ -190,11 +240,88 @@ class ActionDecorator(object):
         return then
 
 
+def run_post_actions(parts, ctx):
+    """
+    Perform the post actions of `parts` in reverse order.
+
+    They are all performed even if some of them fail; the first failure
+    is then raised.
+    """
+    error = None
+    for part in reversed(parts):
+        if part.post_action is None:
+            continue
+        try:
+            part.post_action(ctx)
+        except BaseException:  # pylint:disable=broad-except
+            if error is None:
+                error = sys.exc_info()
+    if error is not None:
+        six.reraise(*error)
+
+
+@attr.s
+class ActionTimings(object):
+    """
+    The total time taken by the actions of ActionDecorators, by name.
+
+    Each entry of `totals` is the number of times the action was performed
+    and the total number of seconds they took.
+    """
+
+    totals = attr.ib(factory=dict)
+    lock = attr.ib(factory=threading.Lock, repr=False)
+
+    def run(self, decorator, ctx):
+        start = timeit.default_timer()
+        try:
+            decorator.action(ctx)
+        finally:
+            self.add(decorator.name, timeit.default_timer() - start)
+
+    def add(self, name, seconds):
+        with self.lock:
+            calls, total = self.totals.get(name, (0, 0.0))
+            self.totals[name] = (calls + 1, total + seconds)
+
+    def report(self):
+        """Lines for each action, from the one which took longest in all."""
+        return [
+            "%8.3fs %5d  %s" % (total, calls, name)
+            for name, (calls, total) in sorted(
+                self.totals.items(), key=lambda item: item[1][1], reverse=True
+            )
+        ]
+
+    def clear(self):
+        with self.lock:
+            self.totals.clear()
+
+
+TIMINGS = ActionTimings()
+
+
+_work_dirs = threading.local()
+
+
+def work_dir():
+    """
+    The directory made by the innermost tempdir in this thread.
+
+    Without one, this is the current directory.
+    """
+    dirs = getattr(_work_dirs, "dirs", None)
+    if not dirs:
+        return os.getcwd()
+    return dirs[-1]
+
+
 @ActionDecorator
-def mktempdir(ctx):
-    ctx.orig_dir = os.getcwd()
+def tempdir(ctx):
     ctx.tmp_dir = tempfile.mkdtemp()
-    os.chdir(ctx.tmp_dir)
+    if not hasattr(_work_dirs, "dirs"):
+        _work_dirs.dirs = []
+    _work_dirs.dirs.append(ctx.tmp_dir)
 
 
 def handle_remove_readonly(func, path, exc):
@@ -210,7 +337,188 @@ def handle_remove_readonly(func, path, exc):
         raise excvalue
 
 
-@mktempdir.after
+@tempdir.after
 def remove_tmp_dir(ctx):
-    os.chdir(ctx.orig_dir)
+    _work_dirs.dirs.remove(ctx.tmp_dir)
     shutil.rmtree(ctx.tmp_dir, ignore_errors=False, onerror=handle_remove_readonly)
+
+
+@ActionDecorator
+def _chdir_tmp_dir(ctx):
+    ctx.orig_dir = os.getcwd()
+    os.chdir(ctx.tmp_dir)
+
+
+@_chdir_tmp_dir.after
+def _chdir_back(ctx):
+    os.chdir(ctx.orig_dir)
+
+
+# tempdir doesn't change the current directory, so tests using it can
+# run in threads; mktempdir does, for tests which work in it.
+mktempdir = tempdir | _chdir_tmp_dir
+
+
+@attr.s
+class _StateNode(object):
+    step = attr.ib(default=None)
+    key = attr.ib(default=None)
+    children = attr.ib(factory=collections.OrderedDict)
+
+
+@attr.s
+class StateCache(object):
+    """
+    Build the states ActionDecorators set up once, and restore copies.
+
+    ActionDecorators for tests typically set up some files in the current
+    directory, such as a git repo, and the same states get set up for
+    many tests. cached() wraps an ActionDecorator so that its state is
+    built once, in a directory of the cache's own, and from then on that
+    directory is copied into the current one instead.
+
+    The first time any cached state is used, all of them are built. Their
+    steps are put in a trie, so a run of steps which several states start
+    with is only done once, and each state which branches off from it
+    starts from a copy of the directory it left. Setting up the states
+    then takes as many steps as there are distinct nodes in the trie,
+    rather than the sum of the lengths of the chains.
+
+    The actions of the states work in the directory in the context's
+    `path` attribute. A state is restored into work_dir(), and the other
+    attributes set on the context are restored along with the files.
+    Those named in `resources`, such as open repos, can't be copied, so
+    they are made again by calling the function they map to with the
+    restored directory. Git object files never change once written, so
+    they are hard linked rather than copied.
+    """
+
+    resources = attr.ib(factory=dict)
+    root = attr.ib(default=None)
+    decorators = attr.ib(factory=list)
+    states = attr.ib(factory=dict)
+    steps_run = attr.ib(default=0)
+    restores = attr.ib(default=0)
+    lock = attr.ib(factory=threading.Lock, repr=False)
+
+    def cached(self, decorator):
+        def restore(ctx):
+            self.restore(decorator, ctx)
+
+        restore.__name__ = decorator.action.__name__
+        cached = ActionDecorator(restore)
+        cached.post_action = decorator.post_action
+        cached.stands_for = decorator.steps
+        if hasattr(decorator, "__name__"):
+            cached.__name__ = decorator.__name__
+        self.decorators.append(decorator)
+        return cached
+
+    def restore(self, decorator, ctx):
+        key = decorator.action.__name__
+        with self.lock:
+            if key not in self.states:
+                self.build(self.decorators + [decorator])
+            state = self.states[key]
+            self.restores += 1
+        self._copy(state, ctx, work_dir())
+
+    def build(self, decorators):
+        """Build each of the states `decorators` set up which isn't built yet."""
+        trie = _StateNode()
+        for decorator in decorators:
+            key = decorator.action.__name__
+            if key in self.states:
+                continue
+            node = trie
+            for step in decorator.steps:
+                node = node.children.setdefault(id(step), _StateNode(step))
+            node.key = key
+        self._grow(trie, (), None)
+
+    def _grow(self, node, steps, state):
+        for child in node.children.values():
+            segment = [child.step]
+            while child.key is None and len(child.children) == 1:
+                child = next(iter(child.children.values()))
+                segment.append(child.step)
+            child_state = self._run(steps, segment, state)
+            if child.key is not None:
+                self.states[child.key] = child_state
+            self._grow(child, steps + tuple(segment), child_state)
+
+    def _run(self, steps, segment, state):
+        if self.root is None:
+            self.root = tempfile.mkdtemp(prefix="states-")
+            atexit.register(self.clear)
+        path = tempfile.mkdtemp(dir=self.root)
+        ctx = type("StateCache_ActionDecoratorContext", (), {})()
+        try:
+            if state is None:
+                ctx.path = path
+            else:
+                self._copy(state, ctx, path)
+            for step in segment:
+                TIMINGS.run(step, ctx)
+                self.steps_run += 1
+            attributes = dict(
+                (name, None if name in self.resources else copy.deepcopy(value))
+                for name, value in vars(ctx).items()
+                if name != "path"
+            )
+        finally:
+            run_post_actions(steps + tuple(segment), ctx)
+        return path, attributes
+
+    def _copy(self, state, ctx, path):
+        state_path, attributes = state
+        copy_tree(state_path, path)
+        ctx.path = path
+        for name, value in attributes.items():
+            if name in self.resources:
+                value = self.resources[name](path)
+            else:
+                value = copy.deepcopy(value)
+            setattr(ctx, name, value)
+
+    def clear(self):
+        if self.root is not None:
+            shutil.rmtree(self.root, onerror=handle_remove_readonly)
+        self.root = None
+        self.states.clear()
+
+
+def copy_tree(src, dst):
+    """
+    Copy the contents of directory src into directory dst.
+
+    Files under .git/objects are hard linked rather than copied, as git
+    never changes them; everything else, such as the index and the work
+    tree, is copied so that the copy can be changed freely.
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel_dir = os.path.relpath(dirpath, src)
+        target_dir = os.path.normpath(os.path.join(dst, rel_dir))
+        link = rel_dir.split(os.sep)[:2] == [".git", "objects"]
+        for name in dirnames:
+            source = os.path.join(dirpath, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), os.path.join(target_dir, name))
+            else:
+                os.mkdir(os.path.join(target_dir, name))
+        dirnames[:] = [
+            name for name in dirnames if not os.path.islink(os.path.join(dirpath, name))
+        ]
+        for name in filenames:
+            source = os.path.join(dirpath, name)
+            target = os.path.join(target_dir, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+                continue
+            if link:
+                try:
+                    os.link(source, target)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(source, target)
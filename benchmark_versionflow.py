@@ -0,0 +1,461 @@
+"""Benchmarks for versionflow.
+
+Run with e.g.
+
+    python benchmark_versionflow.py startup
+
+Each benchmark prints its timings as a JSON document, and with
+--output FILE also saves them in FILE, so that the timings of two
+versions can be compared with e.g.
+
+    python benchmark_versionflow.py compare old.json new.json
+"""
+from __future__ import print_function
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from contextlib import contextmanager
+
+import attr
+import click
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GIT_IDENT = "Benchmark <benchmark@example.com> 1500000000 +0000"
+GITFLOW_CONFIG = {
+    "gitflow.branch.master": "master",
+    "gitflow.branch.develop": "develop",
+    "gitflow.prefix.feature": "feature/",
+    "gitflow.prefix.release": "release/",
+    "gitflow.prefix.hotfix": "hotfix/",
+    "gitflow.prefix.support": "support/",
+    "gitflow.prefix.versiontag": "",
+}
+
+
+@attr.s
+class Timing(object):
+    name = attr.ib()
+    runs = attr.ib()
+
+    @property
+    def best(self):
+        return min(self.runs)
+
+    @property
+    def median(self):
+        runs = sorted(self.runs)
+        return runs[len(runs) // 2]
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "best": self.best,
+            "median": self.median,
+            "runs": self.runs,
+        }
+
+
+def time_command(name, command, repeat, cwd=HERE, returncodes=(0,), setup=None):
+    """Time `repeat` runs of `command` in a fresh process each time.
+
+    If `setup` is given it is called before each run, untimed.
+    """
+    runs = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            start = timeit.default_timer()
+            returncode = subprocess.call(
+                command, cwd=cwd, stdout=devnull, stderr=devnull)
+            runs.append(timeit.default_timer() - start)
+            if returncode not in returncodes:
+                raise subprocess.CalledProcessError(returncode, command)
+    return Timing(name, runs)
+
+
+def _data(text):
+    return "data %d\n%s\n" % (len(text.encode("utf-8")), text)
+
+
+def _commit(ref, mark, message, parent=None, files=()):
+    lines = ["commit " + ref, "mark :%d" % mark, "committer " + GIT_IDENT]
+    lines.append(_data(message).rstrip("\n"))
+    if parent is not None:
+        lines.append("from :%d" % parent)
+    for filename, contents in files:
+        lines.append("M 644 inline " + filename)
+        lines.append(_data(contents).rstrip("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+def make_repo(
+    path,
+    commits=10,
+    branches=0,
+    tags=1,
+    version="1.0.0",
+    pack_refs=True,
+    files=0,
+    version_files=0,
+):
+    """Generate a versionflow repo at `path`.
+
+    master and develop share a history of `commits` commits, the last of
+    which is tagged with `version`. The `tags - 1` commits before that
+    are tagged with earlier versions. There are also `branches` feature
+    branches, each with one commit of its own on top of a commit
+    somewhere in that history. If `pack_refs` is set the refs are packed,
+    as `git gc` would leave them. The first commit adds `files` files,
+    a thousand to a directory, as well as the versionflow config and
+    `version_files` files with the version in them, which are added to
+    the config as versionflow add would.
+    """
+    commits = max(commits, tags)
+    subprocess.check_call(["git", "init", "-q", path])
+    stream = []
+    config = "[bumpversion]\ncurrent_version = %s\n" % version
+    for number in range(version_files):
+        config += "\n[bumpversion:file:%s]\n" % version_file(number)
+    for mark in range(1, commits + 1):
+        files_changed = [("history", "commit %d\n" % mark)]
+        if mark == 1:
+            files_changed.append((".versionflow", config))
+            files_changed.extend(
+                (tree_file(number), "file %d\n" % number) for number in range(files)
+            )
+            files_changed.extend(
+                (version_file(number), "version = %s\n" % version)
+                for number in range(version_files)
+            )
+        stream.append(
+            _commit(
+                "refs/heads/master",
+                mark,
+                "Commit %d" % mark,
+                mark - 1 if mark > 1 else None,
+                files_changed,
+            )
+        )
+    for mark in range(commits - tags + 1, commits + 1):
+        tag = version if mark == commits else "0.0.%d" % mark
+        stream.append(
+            "tag %s\nfrom :%d\ntagger %s\n%s\n"
+            % (tag, mark, GIT_IDENT, _data(tag).rstrip("\n"))
+        )
+    stream.append("reset refs/heads/develop\nfrom :%d\n\n" % commits)
+    for branch in range(branches):
+        stream.append(
+            _commit(
+                "refs/heads/feature/%d" % branch,
+                commits + branch + 1,
+                "Feature %d" % branch,
+                branch % commits + 1,
+                [("feature-%d" % branch, "feature %d\n" % branch)],
+            )
+        )
+    fast_import = subprocess.Popen(
+        ["git", "fast-import", "--quiet"], cwd=path, stdin=subprocess.PIPE
+    )
+    fast_import.communicate("".join(stream).encode("utf-8"))
+    if fast_import.returncode:
+        raise subprocess.CalledProcessError(fast_import.returncode, "git fast-import")
+    if pack_refs:
+        subprocess.check_call(["git", "pack-refs", "--all"], cwd=path)
+    for key, value in sorted(GITFLOW_CONFIG.items()):
+        subprocess.check_call(["git", "config", key, value], cwd=path)
+    subprocess.check_call(["git", "checkout", "-q", "develop"], cwd=path)
+
+
+def tree_file(number):
+    return "tree/%03d/%d" % (number // 1000, number)
+
+
+def version_file(number):
+    return "versioned/%d" % number
+
+
+@contextmanager
+def generated_repo(**kwargs):
+    path = tempfile.mkdtemp()
+    try:
+        make_repo(path, **kwargs)
+        yield path
+    finally:
+        shutil.rmtree(path)
+
+
+def emit(timings):
+    document = json.dumps([timing.as_dict() for timing in timings], indent=2)
+    click.echo(document)
+    output = click.get_current_context().find_root().params["output"]
+    if output is not None:
+        with open(output, "w") as handle:
+            handle.write(document + "\n")
+
+
+@click.group()
+@click.option(
+    "--output",
+    type=click.Path(dir_okay=False, writable=True),
+    help="Also save the timings as JSON in this file.",
+)
+def cli(output):  # pylint:disable=unused-argument
+    pass
+
+
+@cli.command()
+@click.option("--repeat", default=10, help="Number of runs of each command.")
+def startup(repeat):
+    """Time a cold `import versionflow` and `versionflow --help`."""
+    emit(
+        [
+            time_command(
+                "import", [sys.executable, "-c", "import versionflow"], repeat
+            ),
+            time_command(
+                "help", [sys.executable, "-m", "versionflow", "--help"], repeat
+            ),
+        ]
+    )
+
+
+@cli.command("tag-check")
+@click.option(
+    "--branches",
+    multiple=True,
+    type=int,
+    default=[10, 100, 1000],
+    help="Number of feature branches in a generated repo; may be repeated.",
+)
+@click.option("--commits", default=100, help="Number of commits on master.")
+@click.option("--repeat", default=5, help="Number of runs of each command.")
+def tag_check(branches, commits, repeat):
+    """Time checking that the version tag is on master.
+
+    This compares 'git branch --contains', which visits every branch,
+    with the 'git merge-base --is-ancestor' query that versionflow uses.
+    """
+    version = "1.0.0"
+    timings = []
+    for count in branches:
+        with generated_repo(commits=commits, branches=count, version=version) as path:
+            timings.append(
+                time_command(
+                    "branch-contains/%d" % count,
+                    ["git", "branch", "--contains", version],
+                    repeat,
+                    cwd=path,
+                )
+            )
+            timings.append(
+                time_command(
+                    "merge-base/%d" % count,
+                    ["git", "merge-base", "--is-ancestor", version, "master"],
+                    repeat,
+                    cwd=path,
+                )
+            )
+            timings.append(
+                time_command(
+                    "check/%d" % count,
+                    [sys.executable, os.path.join(HERE, "versionflow.py"), "check"],
+                    repeat,
+                    cwd=path,
+                )
+            )
+    emit(timings)
+
+
+@cli.command()
+@click.option(
+    "--tags",
+    multiple=True,
+    type=int,
+    default=[100, 10000],
+    help="Number of version tags in a generated repo; may be repeated.",
+)
+@click.option(
+    "--packed/--loose", default=True, help="Whether the refs are packed.")
+@click.option("--repeat", default=5, help="Number of runs of each command.")
+def tags(tags, packed, repeat):
+    """Time finding the last version tag.
+
+    This compares the 'git describe' that versionflow used to run through
+    setuptools_scm with versionflow's own 'describe' and 'check'.
+    """
+    timings = []
+    for count in tags:
+        with generated_repo(tags=count, pack_refs=packed) as path:
+            timings.append(
+                time_command(
+                    "git-describe/%d" % count,
+                    ["git", "describe", "--dirty", "--tags", "--long", "--match", "*.*"],
+                    repeat,
+                    cwd=path,
+                )
+            )
+            for command in ["describe", "check"]:
+                timings.append(
+                    time_command(
+                        "%s/%d" % (command, count),
+                        [sys.executable, os.path.join(HERE, "versionflow.py"), command],
+                        repeat,
+                        cwd=path,
+                    )
+                )
+    emit(timings)
+
+
+@cli.command()
+@click.option(
+    "--files",
+    multiple=True,
+    type=int,
+    default=[10000, 100000],
+    help="Number of files in a generated repo; may be repeated.",
+)
+@click.option("--repeat", default=5, help="Number of runs of each command.")
+def dirty(files, repeat):
+    """Time checking whether a large working tree is dirty.
+
+    This compares the 'git status' that versionflow used to run with the
+    'git diff --quiet' commands it runs now, and 'versionflow check', in
+    a clean tree and in one where the first file has been changed.
+    """
+    timings = []
+    for count in files:
+        with generated_repo(files=count) as path:
+            for state in ["clean", "dirty"]:
+                if state == "dirty":
+                    with open(os.path.join(path, tree_file(0)), "a") as handle:
+                        handle.write("changed\n")
+                for name, command in [
+                    (
+                        "git-status",
+                        ["git", "status", "--porcelain=v2", "--untracked-files=no"],
+                    ),
+                    ("diff-cached", ["git", "diff", "--cached", "--quiet"]),
+                    ("diff", ["git", "diff", "--quiet"]),
+                    (
+                        "check",
+                        [sys.executable, os.path.join(HERE, "versionflow.py"), "check"],
+                    ),
+                ]:
+                    timings.append(
+                        time_command(
+                            "%s/%s/%d" % (name, state, count),
+                            command,
+                            repeat,
+                            cwd=path,
+                            returncodes=(0, 1),
+                        )
+                    )
+    emit(timings)
+
+
+COMMANDS = ["check", "describe", "patch", "minor", "major"]
+RELEASES = ["patch", "minor", "major"]
+
+
+@cli.command()
+@click.option("--commits", default=1000, help="Number of commits on master.")
+@click.option("--tags", default=100, help="Number of version tags.")
+@click.option("--branches", default=100, help="Number of feature branches.")
+@click.option("--files", default=10000, help="Number of files in the working tree.")
+@click.option(
+    "--version-files", default=10, help="Number of files with the version in them.")
+@click.option(
+    "--command",
+    "commands",
+    multiple=True,
+    type=click.Choice(COMMANDS),
+    default=COMMANDS,
+    help="versionflow command to time; may be repeated. Defaults to all of them.",
+)
+@click.option("--repeat", default=5, help="Number of runs of each command.")
+def commands(commits, tags, branches, files, version_files, commands, repeat):
+    """Time versionflow's commands in a generated repo.
+
+    The repo is generated once, with the given numbers of commits, tags,
+    feature branches, files and version files. Each release is timed in
+    a fresh copy of it, made before the run.
+    """
+    timings = []
+    with generated_repo(
+        commits=commits,
+        tags=tags,
+        branches=branches,
+        files=files,
+        version_files=version_files,
+    ) as template:
+        copy = template + "-copy"
+
+        def fresh_copy():
+            if os.path.exists(copy):
+                shutil.rmtree(copy)
+            shutil.copytree(template, copy, symlinks=True)
+
+        try:
+            for command in commands:
+                release = command in RELEASES
+                timings.append(
+                    time_command(
+                        command,
+                        [sys.executable, os.path.join(HERE, "versionflow.py"), command],
+                        repeat,
+                        cwd=copy if release else template,
+                        setup=fresh_copy if release else None,
+                    )
+                )
+        finally:
+            if os.path.exists(copy):
+                shutil.rmtree(copy)
+    emit(timings)
+
+
+@cli.command()
+@click.argument("old", type=click.File())
+@click.argument("new", type=click.File())
+@click.option(
+    "--threshold",
+    default=0.1,
+    help="Fraction by which a median time may grow before it counts as a regression.",
+)
+def compare(old, new, threshold):
+    """Compare the timings saved in OLD with those in NEW.
+
+    Shows the median time of each benchmark in both, and how it changed.
+    The exit status is 1 if any of them got slower by more than the
+    threshold.
+    """
+    old_medians = dict((timing["name"], timing["median"]) for timing in json.load(old))
+    regressions = 0
+    for timing in json.load(new):
+        name, median = timing["name"], timing["median"]
+        if name not in old_medians:
+            click.echo("%-30s %10s %10.4f" % (name, "-", median))
+            continue
+        change = median / old_medians[name] - 1 if old_medians[name] else 0.0
+        regressed = change > threshold
+        regressions += regressed
+        click.echo(
+            "%-30s %10.4f %10.4f %+7.1f%%%s"
+            % (
+                name,
+                old_medians[name],
+                median,
+                change * 100,
+                "  REGRESSION" if regressed else "",
+            )
+        )
+    if regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    cli()  # pylint:disable=no-value-for-parameter
@@ -1,12 +1,23 @@
 from __future__ import print_function
+import atexit
 import contextlib
-import cProfile
+import datetime
 import os
+import shutil
+import stat
+import sys
+import threading
+import time
 import unittest
 import traceback
 import functools
+import io
+import json
+from multiprocessing.pool import ThreadPool
 
 import attr
+import configparser
+import six
 import click
 import click.testing
 import git.cmd
@@ -17,15 +28,89 @@ import testing_state_definitions as test_states
 import action_decorator
 
 
-@contextlib.contextmanager
-def profile():
-    cprof = cProfile.Profile()
-    cprof.enable()
-    try:
-        yield
-    finally:
-        cprof.disable()
-        cprof.print_stats("tottime")
+class ThreadOutput(object):
+    """
+    A stream which writes to the current thread's buffer, if it has one.
+
+    click.testing.CliRunner captures the output of the CLI by replacing
+    sys.stdout, so two invocations at once in different threads would
+    get each other's output. invoke() replaces sys.stdout and sys.stderr
+    with ThreadOutputs instead, which write to a buffer of its own for
+    each invocation.
+    """
+
+    encoding = "utf-8"
+    errors = "strict"
+    lock = threading.Lock()
+    local = threading.local()
+    users = 0
+    saved = None
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        return (self.stream if buffer is None else buffer).write(text)
+
+    def flush(self):
+        if getattr(self.local, "buffer", None) is None:
+            self.stream.flush()
+
+    def isatty(self):
+        return False
+
+    @classmethod
+    @contextlib.contextmanager
+    def capture(cls, buffer):
+        with cls.lock:
+            if cls.users == 0:
+                cls.saved = sys.stdout, sys.stderr
+                sys.stdout, sys.stderr = cls(sys.stdout), cls(sys.stderr)
+            cls.users += 1
+        cls.local.buffer = buffer
+        try:
+            yield
+        finally:
+            cls.local.buffer = None
+            with cls.lock:
+                cls.users -= 1
+                if cls.users == 0:
+                    sys.stdout, sys.stderr = cls.saved
+
+
+@attr.s
+class Invocation(object):
+    stdout = attr.ib()
+    exit_code = attr.ib()
+    exception = attr.ib(default=None)
+    exc_info = attr.ib(default=None)
+
+
+def invoke(args):
+    """
+    Run the versionflow CLI with `args`, as CliRunner.invoke does.
+
+    Unlike CliRunner.invoke, this can be called from several threads at
+    once, as long as `args` name the repo dir rather than relying on the
+    current directory.
+    """
+    output = six.StringIO()
+    exception = exc_info = None
+    with ThreadOutput.capture(output):
+        try:
+            versionflow.cli.main(args=args, prog_name="versionflow")
+            exit_code = 0
+        except SystemExit as exc:
+            exit_code = 0 if exc.code is None else exc.code
+            if exit_code != 0:
+                exception = exc
+            if not isinstance(exit_code, int):
+                output.write(six.text_type(exit_code) + "\n")
+                exit_code = 1
+        except Exception as exc:  # pylint:disable=broad-except
+            exception, exit_code, exc_info = exc, 1, sys.exc_info()
+    return Invocation(output.getvalue(), exit_code, exception, exc_info)
 
 
 @attr.s
@@ -56,11 +141,11 @@ class Success(Result):
     def check(self, testclass, result, ctx):
         testclass.assertEqual(result.exit_code, 0)
         # It is a git repo.
-        testclass.assertTrue(os.path.exists(".git"))
-        with versionflow.git_context() as repo:
+        testclass.assertTrue(os.path.exists(os.path.join(ctx.path, ".git")))
+        with versionflow.git_context(ctx.path) as repo:
             # It is not dirty.
             testclass.assertFalse(repo.is_dirty())
-            with versionflow.gitflow_context() as gflow:
+            with versionflow.gitflow_context(ctx.path) as gflow:
                 # It is a gitflow repo.
                 testclass.assertTrue(gflow.is_initialized())
                 setup_cfg = getattr(
@@ -68,23 +153,19 @@ class Success(Result):
             # Bumpversion version number present in git repo
             # on develop branch
             repo.heads.develop.checkout()
-            testclass.assertTrue(os.path.exists(setup_cfg))
+            testclass.assertTrue(os.path.exists(os.path.join(ctx.path, setup_cfg)))
             testclass.assertTrue(repo.active_branch.commit.tree / setup_cfg)
-        bumpver = versionflow.BumpVersionWrapper.from_existing(setup_cfg)
+        bumpver = versionflow.BumpVersionWrapper.from_existing(
+            os.path.join(ctx.path, setup_cfg), ctx.path)
         # - The version number is what we expect it to be.
         testclass.assertEqual(bumpver.current_version, self.version)
         # Check that the git version tag is present and is what we
         # expect
-        tag_version = versionflow.Config.get_last_version()
+        tag_version = versionflow.Config.get_last_version(ctx.path)
         testclass.assertEqual(tag_version, self.version)
         # TODO: The output is what we expect.
         # Check that we are left with a consistent repo
-        if setup_cfg == versionflow.DEFAULT_BV_FILE:
-            testclass.runner.invoke(versionflow.cli, args=["check"])
-        else:
-            testclass.runner.invoke(
-                versionflow.cli, args=["--config", setup_cfg, "check"]
-            )
+        invoke(["--repo-dir", ctx.path, "--config", setup_cfg, "check"])
 
 
 @attr.s
@@ -119,19 +200,21 @@ class StateTest(object):
             name = self.state.__name__
         name = "test_" + prefix + "_" + name
 
+        # The repo dir is passed explicitly, and the current directory is
+        # left alone, so the tests can be run in threads: see run_parallel.
         @self.state("context")
         def test_method(slf, context=None):
+            args = ["--repo-dir", context.path]
             if (
                 hasattr(context, "setup_cfg")
                 and context.setup_cfg != versionflow.DEFAULT_BV_FILE
             ):
-                slf.command_args = ["--config",
-                                    context.setup_cfg] + slf.command_args
-            result = slf.process()
+                args += ["--config", context.setup_cfg]
+            result = slf.process(*args)
             click.echo(result.stdout)
             return result, context
 
-        @action_decorator.mktempdir
+        @action_decorator.tempdir
         def overall_test(slf):
             result, context = test_method(slf)
             try:
@@ -187,8 +270,8 @@ class BaseTest(unittest.TestCase):
     def setUp(self):
         self.runner = click.testing.CliRunner()
 
-    def process(self, *unused_args):
-        return self.runner.invoke(versionflow.cli, args=self.command_args)
+    def process(self, *args):
+        return invoke(list(args) + self.command_args)
 
 
 _always_bad_states = [
@@ -256,6 +339,8 @@ class Test_Check(BaseTest):
         good(test_states.with_feature),
         good(test_states.on_feature),
         good(test_states.good_custom_config),
+        good(test_states.with_versioned_file),
+        bad(test_states.with_stale_versioned_file, versionflow.VersionNotInFile),
     ]
 
 
@@ -270,6 +355,8 @@ def make_bump_tests(bump_command):
         bump_command(test_states.with_feature),
         bump_command(test_states.on_feature),
         bump_command(test_states.good_custom_config),
+        bump_command(test_states.with_versioned_file),
+        bad(test_states.with_stale_versioned_file, versionflow.VersionNotInFile),
     ]
 
 
@@ -291,5 +378,1368 @@ class Test_Major(BaseTest):
     state_tests = make_bump_tests(major)
 
 
+class Test_VersionFormat(unittest.TestCase):
+    def setUp(self):
+        self.version_format = versionflow.VersionFormat(
+            r"(?P<major>\d+)\.(?P<minor>\d+)\.(?P<patch>\d+)(-(?P<release>\w+))?",
+            ["{major}.{minor}.{patch}-{release}", "{major}.{minor}.{patch}"],
+            {"release": ["dev", "final"]},
+        )
+
+    def bump(self, version, part):
+        return self.version_format.serialize_version(
+            self.version_format.bump(
+                self.version_format.parse_version(version), part)
+        )
+
+    def test_bump(self):
+        self.assertEqual(self.bump("1.2.3", "patch"), "1.2.4")
+        self.assertEqual(self.bump("1.2.3", "minor"), "1.3.0")
+        self.assertEqual(self.bump("1.2.3", "major"), "2.0.0")
+
+    def test_bump_values(self):
+        self.assertEqual(self.bump("1.2.3-dev", "release"), "1.2.3-final")
+        self.assertRaises(IndexError, self.bump, "1.2.3-final", "release")
+
+    def test_unparseable(self):
+        self.assertRaises(ValueError, self.version_format.parse_version, "a.b")
+
+    def test_first_and_optional_values(self):
+        self.version_format = attr.evolve(
+            self.version_format,
+            part_values={"release": ["dev", "beta", "final"]},
+            first_values={"patch": "1", "release": "beta"},
+            optional_values={"release": "final"},
+        )
+        self.assertEqual(self.bump("1.2.3", "minor"), "1.3.1-beta")
+        self.assertEqual(self.bump("1.2.3-beta", "release"), "1.2.3")
+        self.assertEqual(self.bump("1.2.3-dev", "release"), "1.2.3-beta")
+
+    def test_now(self):
+        version_format = versionflow.VersionFormat(
+            r"(?P<year>\d+)\.(?P<patch>\d+)", ["{now:%Y}.{patch}"])
+        self.assertEqual(
+            version_format.serialize_version(
+                version_format.bump(version_format.parse_version("2000.4"), "patch")
+            ),
+            "%d.5" % datetime.datetime.now().year,
+        )
+
+
+class Test_BumpVersionFile(unittest.TestCase):
+    versions = versionflow.Versions("1.0.2", "1.0.3")
+
+    def version_file(
+        self,
+        search="version = {current_version}",
+        replace="version = {new_version}",
+        **kwargs
+    ):
+        return versionflow.BumpVersionFile(
+            "versioned",
+            versionflow.VersionFormat(
+                versionflow.BV_DEFAULT_PARSE, [versionflow.BV_DEFAULT_SERIALIZE], {}
+            ),
+            search,
+            replace,
+            **kwargs
+        )
+
+    def test_find_and_splice(self):
+        contents = b"1.0.2 x 1.0.21.0.2\r\n1.0.1.0.2" * 5
+        whole = list(versionflow._find_all(io.BytesIO(contents), b"1.0.2"))
+        self.assertEqual(len(whole), contents.count(b"1.0.2"))
+        self.assertEqual(whole[:4], [(1, 0), (1, 8), (1, 13), (2, 24)])
+        for chunk_size in range(1, 12):
+            found = list(
+                versionflow._find_all(io.BytesIO(contents), b"1.0.2", chunk_size))
+            self.assertEqual(found, whole)
+            dst = io.BytesIO()
+            versionflow._splice(
+                io.BytesIO(contents),
+                dst,
+                [offset for _, offset in found],
+                b"1.0.2",
+                b"1.0.30",
+                chunk_size,
+            )
+            self.assertEqual(dst.getvalue(), contents.replace(b"1.0.2", b"1.0.30"))
+        self.assertRaises(
+            ValueError,
+            versionflow._splice,
+            io.BytesIO(contents),
+            io.BytesIO(),
+            [1],
+            b"1.0.2",
+            b"1.0.3",
+        )
+
+    @action_decorator.mktempdir
+    def test_find(self):
+        with open("versioned", "w") as handle:
+            handle.write("name = x\nversion = 1.0.2\nversion = 1.0.2\n")
+        occurrences = self.version_file().find("1.0.2")
+        self.assertEqual(
+            occurrences.locations(), [("versioned", 2, 9), ("versioned", 3, 25)])
+        self.assertRaises(ValueError, self.version_file().find, "1.0.1")
+        # A file changed after it was searched is not bumped
+        with open("versioned", "w") as handle:
+            handle.write("version = 1.0.2\n")
+        self.assertRaises(
+            ValueError, self.version_file().prepare, self.versions, occurrences)
+        self.assertEqual(os.listdir("."), ["versioned"])
+
+    @action_decorator.mktempdir
+    def test_streamed(self):
+        contents = u"version = 1.0.2\r\n\u2192 version = 1.0.2\n"
+        with io.open("versioned", "w", encoding="utf-8", newline="") as handle:
+            handle.write(contents)
+        os.chmod("versioned", 0o751)
+        pending = self.version_file(stream_threshold=0, chunk_size=4).prepare(
+            self.versions)
+        with io.open("versioned", encoding="utf-8", newline="") as handle:
+            self.assertEqual(handle.read(), contents)
+        versionflow.commit_files([pending])
+        with io.open("versioned", encoding="utf-8", newline="") as handle:
+            self.assertEqual(handle.read(), contents.replace("1.0.2", "1.0.3"))
+        self.assertEqual(stat.S_IMODE(os.stat("versioned").st_mode), 0o751)
+        self.assertEqual(os.listdir("."), ["versioned"])
+
+    @unittest.skipUnless(hasattr(os, "symlink"), "needs symbolic links")
+    @action_decorator.mktempdir
+    def test_symlink(self):
+        with open("target", "w") as handle:
+            handle.write("version = 1.0.2\n")
+        os.symlink("target", "versioned")
+        versionflow.commit_files([self.version_file().prepare(self.versions)])
+        self.assertTrue(os.path.islink("versioned"))
+        with open("target") as handle:
+            self.assertEqual(handle.read(), "version = 1.0.3\n")
+        self.assertEqual(sorted(os.listdir(".")), ["target", "versioned"])
+
+    def test_empty_search(self):
+        parsed_config = configparser.ConfigParser()
+        parsed_config.read_string(
+            u"[bumpversion]\ncurrent_version = 1.0.2\nfiles = versioned\n"
+            u"[bumpversion:file:other]\nsearch =\n"
+        )
+        bv_wrapper = versionflow.BumpVersionWrapper(
+            versionflow.DEFAULT_BV_FILE, parsed_config, "1.0.2")
+        self.assertRaises(versionflow.BadBumpVersionConfig, bv_wrapper.version_files)
+
+    def test_part_options(self):
+        parsed_config = configparser.ConfigParser()
+        parsed_config.read_string(
+            u"[bumpversion]\ncurrent_version = 1.0.2\n"
+            u"parse = (?P<major>\\d+)\\.(?P<minor>\\d+)\\.(?P<patch>\\d+)"
+            u"(-(?P<release>\\w+))?\n"
+            u"serialize =\n  {major}.{minor}.{patch}-{release}\n"
+            u"  {major}.{minor}.{patch}\n"
+            u"message = {now:%Y} {new_version}\n"
+            u"[bumpversion:part:patch]\nfirst_value = 1\n"
+            u"[bumpversion:part:release]\nvalues =\n  dev\n  final\n"
+            u"optional_value = final\n"
+        )
+        bv_wrapper = versionflow.BumpVersionWrapper(
+            versionflow.DEFAULT_BV_FILE, parsed_config, "1.0.2")
+        self.assertEqual(bv_wrapper.get_new_version("minor"), "1.1.1-dev")
+        self.assertEqual(
+            bv_wrapper.commit_message(versionflow.Versions("1.0.2", "1.1.1-dev")),
+            "%d 1.1.1-dev" % datetime.datetime.now().year,
+        )
+
+    @action_decorator.mktempdir
+    def test_fallback_and_missing(self):
+        with open("versioned", "w") as handle:
+            handle.write("__version__ = '1.0.2'\n")
+        versionflow.commit_files(
+            [
+                self.version_file(replace="{new_version}", stream_threshold=0).prepare(
+                    self.versions)
+            ]
+        )
+        with open("versioned") as handle:
+            self.assertEqual(handle.read(), "__version__ = '1.0.3'\n")
+        self.assertRaises(ValueError, self.version_file().prepare, self.versions)
+        self.assertEqual(os.listdir("."), ["versioned"])
+
+
+class Test_PrepareFiles(unittest.TestCase):
+    versions = versionflow.Versions("1.0.2", "1.0.3")
+
+    def make_files(self, count):
+        version_format = versionflow.VersionFormat(
+            versionflow.BV_DEFAULT_PARSE, [versionflow.BV_DEFAULT_SERIALIZE], {}
+        )
+        version_files = []
+        for number in range(count):
+            path = "versioned-%d" % number
+            with open(path, "w") as handle:
+                handle.write("version = 1.0.2\n")
+            version_files.append(
+                versionflow.BumpVersionFile(
+                    path, version_format, "{current_version}", "{new_version}"
+                )
+            )
+        return version_files
+
+    def contents(self):
+        contents = {}
+        for path in os.listdir("."):
+            with open(path) as handle:
+                contents[path] = handle.read()
+        return contents
+
+    @action_decorator.mktempdir
+    def test_bad_file(self):
+        version_files = self.make_files(10)
+        with open(version_files[7].path, "w") as handle:
+            handle.write("version = 1.0.1\n")
+        before = self.contents()
+        self.assertRaises(
+            ValueError, versionflow.prepare_files, version_files, self.versions, 4)
+        self.assertEqual(self.contents(), before)
+
+    @action_decorator.mktempdir
+    def test_rollback(self):
+        version_files = self.make_files(3)
+        before = self.contents()
+        pending = versionflow.prepare_files(version_files, self.versions, 4)
+        replace_file = versionflow._replace_file
+        calls = []
+
+        def fail_third(src, dst):
+            calls.append(src)
+            if len(calls) == 3:
+                raise OSError("disk full")
+            replace_file(src, dst)
+
+        versionflow._replace_file = fail_third
+        try:
+            self.assertRaises(OSError, versionflow.commit_files, pending)
+        finally:
+            versionflow._replace_file = replace_file
+        self.assertEqual(self.contents(), before)
+
+    @action_decorator.mktempdir
+    def test_file_listed_twice(self):
+        with open("versioned", "w") as handle:
+            handle.write("tag v1.0.2\nversion = 1.0.2\n")
+        parsed_config = configparser.ConfigParser()
+        parsed_config.read_string(
+            u"[bumpversion]\ncurrent_version = 1.0.2\nfiles = versioned\n"
+            u"search = v{current_version}\nreplace = v{new_version}\n"
+            u"[bumpversion:file:versioned]\n"
+            u"search = version = {current_version}\n"
+            u"replace = version = {new_version}\n"
+        )
+        bv_wrapper = versionflow.BumpVersionWrapper(
+            versionflow.DEFAULT_BV_FILE, parsed_config, "1.0.2", os.getcwd())
+        occurrences = bv_wrapper.find_versions()
+        self.assertEqual(len(occurrences), 2)
+        pending = versionflow.prepare_files(
+            bv_wrapper.version_files(), self.versions, 4, occurrences)
+        self.assertEqual(len(pending), 1)
+        versionflow.commit_files(pending)
+        self.assertEqual(
+            self.contents(), {"versioned": "tag v1.0.3\nversion = 1.0.3\n"})
+
+    def test_overlapping_edits(self):
+        first = [(2, b"1.0.2", b"1.0.3"), (10, b"1.0.2", b"1.0.3")]
+        second = [(0, b"v 1.0.2", b"v 1.0.3"), (7, b"x", b"y"), (15, b"1", b"2")]
+        self.assertEqual(
+            versionflow._merge_edits(first, second),
+            [first[0], second[1], first[1], second[2]],
+        )
+
+    @action_decorator.mktempdir
+    def test_all_files(self):
+        version_files = self.make_files(20)
+        versionflow.commit_files(
+            versionflow.prepare_files(version_files, self.versions, 4))
+        self.assertEqual(
+            self.contents(),
+            dict(
+                (version_file.path, "version = 1.0.3\n")
+                for version_file in version_files
+            ),
+        )
+
+
+class Test_VersionedFiles(BaseTest):
+    command_args = ["patch"]
+
+    @action_decorator.mktempdir
+    @test_states.with_versioned_file
+    def test_patch_updates_file(self):
+        result = self.process()
+        self.assertEqual(result.exit_code, 0)
+        with open(test_states.VERSIONED_FILE) as handle:
+            self.assertEqual(
+                handle.read(), "version = " + test_states.NEXT_PATCH + "\n")
+        with versionflow.git_context() as repo:
+            self.assertFalse(repo.is_dirty())
+
+
+class Test_Batch(BaseTest):
+    def rows(self, output):
+        lines = [line.split("\t") for line in output.splitlines()]
+        self.assertEqual(lines[0], versionflow.BATCH_FIELDS)
+        return [dict(zip(lines[0], line)) for line in lines[1:]]
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo
+    def test_patch(self):
+        os.mkdir("not_a_repo")
+        with open("manifest", "w") as handle:
+            handle.write("# Repos to release\n\nnot_a_*\n")
+        result = self.runner.invoke(
+            versionflow.cli,
+            args=["batch", "patch", ".", "--manifest", "manifest", "--workers", "2"],
+        )
+        self.assertEqual(result.exit_code, 1)
+        good, bad = self.rows(result.output)
+        self.assertEqual(good["repo"], os.path.abspath("."))
+        self.assertEqual(good["status"], "ok")
+        self.assertEqual(good["version"], test_states.NEXT_PATCH)
+        self.assertEqual(bad["repo"], os.path.abspath("not_a_repo"))
+        self.assertEqual(bad["status"], "error")
+        self.assertEqual(bad["error"], "no-repo")
+        self.assertEqual(
+            versionflow.Config.get_last_version(), test_states.NEXT_PATCH)
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo
+    def test_check(self):
+        result = self.runner.invoke(versionflow.cli, args=["batch", "check", "."])
+        self.assertEqual(result.exit_code, 0)
+        (good,) = self.rows(result.output)
+        self.assertEqual(good["version"], test_states.GOOD_VERSION)
+
+
+class Test_Trace(BaseTest):
+    @action_decorator.mktempdir
+    @test_states.good_base_repo
+    def test_profile(self):
+        result = self.runner.invoke(versionflow.cli, args=["--profile", "patch"])
+        self.assertEqual(result.exit_code, 0)
+        phases = [line.split()[0] for line in result.output.splitlines()]
+        for phase in [
+            "get_git_context",
+            "get_gitflow_context",
+            "check_bumpversion",
+            "check_version_tag",
+            "gitflow_start",
+            "bump_and_commit",
+            "gitflow_end",
+            "total",
+        ]:
+            self.assertIn(phase, phases)
+        self.assertIs(git.Repo.GitCommandWrapperType, git.Git)
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo
+    def test_only_own_repos_traced(self):
+        tracer = versionflow.Tracer()
+        tracer.install()
+        try:
+            with versionflow.git_context(".") as repo:
+                self.assertIsInstance(repo.git, versionflow.TracingGit)
+                repo.git.status()
+            with versionflow.gitflow_context(".") as gflow:
+                self.assertIsInstance(gflow.repo.git, versionflow.TracingGit)
+            other = git.Repo(".")
+            other.git.status()
+            other.close()
+            self.assertIs(type(other.git), git.Git)
+        finally:
+            tracer.uninstall()
+        self.assertEqual(tracer.git_processes, 1)
+        with versionflow.git_context(".") as repo:
+            self.assertIs(type(repo.git), git.Git)
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo
+    def test_trace_file(self):
+        result = self.runner.invoke(
+            versionflow.cli, args=["check"], env={"VERSIONFLOW_TRACE": "trace.json"}
+        )
+        self.assertEqual(result.exit_code, 0)
+        with open("trace.json") as handle:
+            events = json.load(handle)["traceEvents"]
+        self.assertEqual(
+            [event["name"] for event in events],
+            [
+                "get_git_context",
+                "get_gitflow_context",
+                "check_bumpversion",
+                "check_version_tag",
+            ],
+        )
+        self.assertGreater(events[0]["args"]["git_processes"], 0)
+        self.assertGreater(events[0]["args"]["bytes_read"], 0)
+
+
+class Test_JsonOutput(BaseTest):
+    def invoke_json(self, *args):
+        result = self.runner.invoke(versionflow.cli, args=list(args))
+        return result.exit_code, json.loads(result.output)
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_check(self, context=None):
+        exit_code, report = self.invoke_json("check", "--format", "json")
+        self.assertEqual(exit_code, 0)
+        self.assertTrue(report["ok"])
+        self.assertIsNone(report["error"])
+        self.assertEqual(report["head"], context.repo.head.commit.hexsha)
+        self.assertEqual(report["branch"], "develop")
+        self.assertFalse(report["dirty"])
+        self.assertTrue(report["gitflow"])
+        self.assertEqual(report["version"], test_states.GOOD_VERSION)
+        self.assertEqual(report["tag"], test_states.GOOD_VERSION)
+        self.assertTrue(report["tag_on_master"])
+
+    @action_decorator.mktempdir
+    @test_states.dirty_gitflow
+    def test_check_dirty(self):
+        exit_code, report = self.invoke_json("check", "--format", "json")
+        self.assertEqual(exit_code, 1)
+        self.assertFalse(report["ok"])
+        self.assertEqual(report["error"]["code"], "dirty-repo")
+        self.assertEqual(report["error"]["message"], str(versionflow.DirtyRepo()))
+        self.assertTrue(report["dirty"])
+        self.assertIsNone(report["version"])
+
+    @action_decorator.mktempdir
+    @test_states.version_tag_on_wrong_branch("context")
+    def test_check_wrong_branch(self, context=None):
+        exit_code, report = self.invoke_json(
+            "--config", context.setup_cfg, "check", "--format", "json")
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(report["error"]["code"], "version-tag-on-wrong-branch")
+        self.assertFalse(report["tag_on_master"])
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_check_bad_config(self, context=None):
+        with open(versionflow.DEFAULT_BV_FILE, "w") as handle:
+            handle.write("current_version = 1.2.3\n")
+        context.repo.git.commit("-am", "Break the config")
+        exit_code, report = self.invoke_json("check", "--format", "json")
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(report["error"]["code"], "bad-bump-version-config")
+        self.assertEqual(
+            report["error"]["message"], str(versionflow.BadBumpVersionConfig()))
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo
+    def test_check_git_error(self):
+        # master points at a commit which isn't there
+        with open(os.path.join(".git", "refs", "heads", "master"), "w") as handle:
+            handle.write("1" * 40 + "\n")
+        exit_code, report = self.invoke_json("check", "--format", "json")
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(report["error"]["code"], "git-error")
+        result = self.runner.invoke(versionflow.cli, args=["check"])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn(str(versionflow.GitError()), result.output)
+
+    @action_decorator.mktempdir
+    @test_states.with_versioned_file("context")
+    def test_bump_bad_config(self, context=None):
+        with open(versionflow.DEFAULT_BV_FILE, "w") as handle:
+            handle.write("current_version = 1.2.3\n")
+        context.repo.git.commit("-am", "Break the config")
+        result = self.runner.invoke(versionflow.cli, args=["patch"])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIsInstance(result.exception, SystemExit)
+        self.assertIn(str(versionflow.BadBumpVersionConfig()), result.output)
+        with versionflow.git_context() as repo:
+            self.assertEqual(
+                sorted(head.name for head in repo.heads), ["develop", "master"])
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_describe(self, context=None):
+        exit_code, description = self.invoke_json("describe", "--format", "json")
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(
+            description["description"], versionflow.get_current_scm_version("."))
+        self.assertEqual(description["tag"], test_states.GOOD_VERSION)
+        self.assertEqual(description["commit"], context.repo.head.commit.hexsha)
+        self.assertEqual(description["distance"], 1)
+        self.assertFalse(description["dirty"])
+
+    @action_decorator.mktempdir
+    def test_describe_no_repo(self):
+        exit_code, description = self.invoke_json("describe", "--format", "json")
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(description["error"]["code"], "no-repo")
+
+
+class Test_Api(unittest.TestCase):
+    @action_decorator.mktempdir
+    @test_states.good_base_repo
+    def test_threads_elsewhere(self):
+        path = os.getcwd()
+        os.chdir(os.path.dirname(path))
+        try:
+            vf_repo = versionflow.VersionFlowRepo.open(path)
+            pool = ThreadPool(4)
+            try:
+                reports = pool.map(lambda _: vf_repo.check(), range(8))
+            finally:
+                pool.close()
+                pool.join()
+            for report in reports:
+                self.assertTrue(report.ok)
+                self.assertEqual(report.version, test_states.GOOD_VERSION)
+            versions = vf_repo.release(versionflow.BV_MINOR)
+            self.assertEqual(versions.new_version, test_states.NEXT_MINOR)
+            self.assertEqual(vf_repo.check().tag, test_states.NEXT_MINOR)
+        finally:
+            os.chdir(path)
+
+    @action_decorator.mktempdir
+    @test_states.dirty_gitflow
+    def test_release_fails_check(self):
+        vf_repo = versionflow.VersionFlowRepo.open(os.getcwd())
+        self.assertRaises(
+            versionflow.DirtyRepo, vf_repo.release, versionflow.BV_PATCH)
+
+    @action_decorator.mktempdir
+    @test_states.with_stale_versioned_file
+    def test_release_version_not_in_file(self):
+        vf_repo = versionflow.VersionFlowRepo.open(os.getcwd())
+        self.assertEqual(vf_repo.check().error.code, "version-not-in-file")
+        self.assertRaises(
+            versionflow.VersionNotInFile, vf_repo.release, versionflow.BV_PATCH)
+        with versionflow.git_context() as repo:
+            self.assertEqual(
+                sorted(head.name for head in repo.heads), ["develop", "master"])
+            self.assertFalse(repo.is_dirty())
+
+    def unknown_placeholder(self, context, section, option, value):
+        parsed_config = configparser.ConfigParser()
+        parsed_config.read(context.setup_cfg)
+        parsed_config.set(section, option, value)
+        with open(context.setup_cfg, "w") as handle:
+            parsed_config.write(handle)
+        context.repo.git.commit("-am", "Add an unknown placeholder")
+        before = sorted(os.listdir("."))
+        vf_repo = versionflow.VersionFlowRepo.open(os.getcwd())
+        self.assertEqual(vf_repo.check().error.code, "version-not-in-file")
+        self.assertRaises(
+            versionflow.VersionNotInFile, vf_repo.release, versionflow.BV_PATCH)
+        self.assertEqual(sorted(os.listdir(".")), before)
+        with open(test_states.VERSIONED_FILE) as handle:
+            self.assertEqual(
+                handle.read(), "version = " + test_states.GOOD_VERSION + "\n")
+        with versionflow.git_context() as repo:
+            self.assertEqual(
+                sorted(head.name for head in repo.heads), ["develop", "master"])
+            self.assertFalse(repo.is_dirty())
+
+    @action_decorator.mktempdir
+    @test_states.with_versioned_file("context")
+    def test_release_unknown_placeholder(self, context=None):
+        self.unknown_placeholder(
+            context, "bumpversion", "message", "Bump to {new_version}{unknown}")
+
+    @action_decorator.mktempdir
+    @test_states.with_versioned_file("context")
+    def test_release_unknown_placeholder_in_replace(self, context=None):
+        self.unknown_placeholder(
+            context,
+            "bumpversion:file:" + test_states.VERSIONED_FILE,
+            "replace",
+            "version = {new_version}{unknown}",
+        )
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo
+    def test_repo_dir_cli(self):
+        path = os.getcwd()
+        os.chdir(os.path.dirname(path))
+        try:
+            with open(os.path.join(path, "versioned"), "w") as handle:
+                handle.write(test_states.GOOD_VERSION + "\n")
+            runner = click.testing.CliRunner()
+            result = runner.invoke(
+                versionflow.cli, args=["--repo-dir", path, "add", "versioned"])
+            self.assertEqual(result.exit_code, 0)
+            self.assertEqual(os.getcwd(), os.path.dirname(path))
+            files = versionflow.BumpVersionWrapper.from_existing(
+                os.path.join(path, versionflow.DEFAULT_BV_FILE), path
+            ).version_files()
+            self.assertEqual(
+                [version_file.path for version_file in files],
+                [os.path.join(path, "versioned")],
+            )
+        finally:
+            os.chdir(path)
+
+
+@unittest.skipIf(six.PY2, "needs asyncio")
+class Test_CheckAllUnder(BaseTest):
+    @action_decorator.mktempdir
+    @test_states.good_base_repo
+    def test_fleet(self):
+        os.mkdir("fleet")
+        shutil.copytree(
+            ".", os.path.join("fleet", "good"), ignore=shutil.ignore_patterns("fleet")
+        )
+        shutil.copytree(
+            ".", os.path.join("fleet", "dirty"), ignore=shutil.ignore_patterns("fleet")
+        )
+        dirty_file = os.path.join("fleet", "dirty", versionflow.DEFAULT_BV_FILE)
+        with open(dirty_file, "a") as handle:
+            handle.write("\n")
+        git.Repo.init(os.path.join("fleet", "nested", "fresh")).close()
+        os.mkdir(os.path.join("fleet", "plain"))
+        result = self.runner.invoke(
+            versionflow.cli,
+            args=["check", "--all-under", "fleet", "--concurrency", "2", "--format", "json"],
+        )
+        self.assertEqual(result.exit_code, 1)
+        reports = json.loads(result.output)
+        self.assertEqual(
+            [os.path.relpath(report["repo"], "fleet") for report in reports],
+            ["dirty", "good", os.path.join("nested", "fresh")],
+        )
+        self.assertEqual(
+            [report["error"] and report["error"]["code"] for report in reports],
+            ["dirty-repo", None, "no-git-flow"],
+        )
+        good = versionflow.VersionFlowRepo.open(os.path.join("fleet", "good"))
+        self.assertEqual(reports[1], good.check().as_dict())
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_v_prefix(self, context=None):
+        context.repo.git.tag("v" + test_states.GOOD_VERSION, test_states.GOOD_VERSION)
+        context.repo.git.tag("-d", test_states.GOOD_VERSION)
+        result = self.runner.invoke(
+            versionflow.cli, args=["check", "--all-under", ".", "--format", "json"])
+        self.assertEqual(result.exit_code, 0)
+        (report,) = json.loads(result.output)
+        vf_repo = versionflow.VersionFlowRepo.open(os.getcwd())
+        self.assertEqual(report, vf_repo.check().as_dict())
+
+    @action_decorator.mktempdir
+    @test_states.version_tag_on_wrong_branch("context")
+    def test_wrong_branch(self, context=None):
+        result = self.runner.invoke(
+            versionflow.cli,
+            args=["--config", context.setup_cfg, "check", "--all-under", "."],
+        )
+        self.assertEqual(result.exit_code, 1)
+        (row,) = result.output.splitlines()[1:]
+        self.assertEqual(row.split("\t")[-1], "version-tag-on-wrong-branch")
+
+
+class Test_RepoSnapshot(unittest.TestCase):
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_good_repo(self, context=None):
+        snapshot = versionflow.RepoSnapshot.capture(
+            context.repo, context.setup_cfg)
+        self.assertFalse(snapshot.dirty)
+        self.assertEqual(snapshot.head, context.repo.head.commit.hexsha)
+        self.assertEqual(snapshot.branch, "develop")
+        self.assertEqual(
+            snapshot.branches["master"], context.repo.heads.master.commit.hexsha
+        )
+        self.assertEqual(
+            snapshot.tags[test_states.GOOD_VERSION],
+            context.repo.tags[test_states.GOOD_VERSION].commit.hexsha,
+        )
+        self.assertEqual(
+            snapshot.config_blob,
+            (context.repo.head.commit.tree / context.setup_cfg).hexsha,
+        )
+        self.assertTrue(
+            snapshot.contains("master", snapshot.tags[test_states.GOOD_VERSION])
+        )
+
+    @action_decorator.mktempdir
+    @test_states.version_tag_on_wrong_branch("context")
+    def test_tag_not_on_master(self, context=None):
+        snapshot = versionflow.RepoSnapshot.capture(
+            context.repo, context.setup_cfg)
+        self.assertFalse(
+            snapshot.contains("master", snapshot.tags[test_states.GOOD_VERSION])
+        )
+        self.assertFalse(
+            snapshot.contains("no-such-branch", snapshot.head))
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_is_dirty(self, context=None):
+        repo = context.repo
+        run_git = versionflow.git_runner(repo)
+        commands = []
+
+        def is_dirty():
+            del commands[:]
+            snapshot = versionflow.RepoSnapshot.for_repo(repo, context.setup_cfg)
+            versionflow.run_steps(
+                snapshot.read_steps(),
+                lambda args: commands.append(tuple(args)) or run_git(args),
+            )
+            return snapshot.dirty
+
+        with open("untracked", "w") as handle:
+            handle.write("untracked\n")
+        self.assertFalse(is_dirty())
+        with open(context.setup_cfg) as handle:
+            original = handle.read()
+        with open(context.setup_cfg, "a") as handle:
+            handle.write("\n")
+        self.assertTrue(is_dirty())
+        self.assertIn((u"diff", u"--quiet"), commands)
+        # Staged, then undone in the working tree
+        repo.index.add([context.setup_cfg])
+        with open(context.setup_cfg, "w") as handle:
+            handle.write(original)
+        self.assertTrue(is_dirty())
+        # The working tree isn't diffed once something is staged
+        self.assertNotIn((u"diff", u"--quiet"), commands)
+
+    @action_decorator.mktempdir
+    @test_states.dirty_empty_git("context")
+    def test_dirty_empty_repo(self, context=None):
+        snapshot = versionflow.RepoSnapshot.capture(
+            context.repo, versionflow.DEFAULT_BV_FILE)
+        self.assertTrue(snapshot.dirty)
+        self.assertIsNone(snapshot.head)
+        self.assertIsNone(snapshot.config_blob)
+
+
+class Test_VersionTags(unittest.TestCase):
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_nearest(self, context=None):
+        tags = versionflow.VersionTags.read(context.repo)
+        description = tags.nearest()
+        self.assertEqual(description.version, test_states.GOOD_VERSION)
+        self.assertEqual(description.distance, 1)
+        self.assertEqual(description.commit, context.repo.head.commit.hexsha)
+        description = tags.nearest(test_states.GOOD_VERSION)
+        self.assertEqual(description.distance, 0)
+
+    @action_decorator.mktempdir
+    def test_nearest_after_merge(self):
+        # 1.0.1 is on a side branch with a later date than 1.1.0, but
+        # 1.1.0 is fewer commits away once the side branch is merged
+        repo = git.Repo.init()
+        self.addCleanup(repo.close)
+
+        def commit(day, tag=None):
+            date = "2020-01-%02d 12:00:00 +0000" % day
+            repo.git.commit(
+                "--allow-empty",
+                "-m",
+                "Day %d" % day,
+                env={"GIT_AUTHOR_DATE": date, "GIT_COMMITTER_DATE": date},
+            )
+            if tag is not None:
+                repo.git.tag(tag)
+
+        commit(1, "1.0.0")
+        repo.git.branch("side")
+        commit(2)
+        commit(3, "1.1.0")
+        commit(4)
+        repo.git.checkout("side")
+        commit(5, "1.0.1")
+        repo.git.checkout("master")
+        date = "2020-01-06 12:00:00 +0000"
+        repo.git.merge(
+            "--no-ff",
+            "-m",
+            "Merge side",
+            "side",
+            env={"GIT_AUTHOR_DATE": date, "GIT_COMMITTER_DATE": date},
+        )
+        description = versionflow.VersionTags.read(repo).nearest()
+        self.assertEqual(description.version, "1.1.0")
+        self.assertEqual(description.distance, 3)
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_v_prefix(self, context=None):
+        context.repo.git.tag("v" + test_states.GOOD_VERSION, test_states.GOOD_VERSION)
+        context.repo.git.tag("-d", test_states.GOOD_VERSION)
+        report = versionflow.VersionFlowRepo.open(os.getcwd()).check()
+        self.assertTrue(report.ok, report.error)
+        self.assertEqual(report.tag, test_states.GOOD_VERSION)
+        tag = context.repo.tags["v" + test_states.GOOD_VERSION]
+        self.assertEqual(report.tag_commit, tag.commit.hexsha)
+
+    @action_decorator.mktempdir
+    @test_states.gitflow_with_bump("context")
+    def test_no_tags(self, context=None):
+        tags = versionflow.VersionTags.read(context.repo)
+        self.assertRaises(LookupError, tags.nearest)
+
+    def test_describe(self):
+        exact = versionflow.TagDescription("1.0.2", "0123456789abcdef", 0)
+        self.assertEqual(exact.describe(False), "1.0.2")
+        self.assertTrue(exact.describe(True).startswith("1.0.2+d"))
+        ahead = versionflow.TagDescription("1.0.2", "0123456789abcdef", 3)
+        self.assertEqual(ahead.describe(False), "1.0.2+g0123456")
+        self.assertTrue(ahead.describe(True).startswith("1.0.2+g0123456.d"))
+
+
+class Test_DescribeCache(unittest.TestCase):
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_invalidation(self, context=None):
+        stats = []
+        described = versionflow.get_current_scm_version(".", cache_stats=stats)
+        self.assertEqual(
+            versionflow.get_current_scm_version(".", cache_stats=stats), described
+        )
+        self.assertEqual(
+            versionflow.get_current_scm_version(".", use_cache=False), described
+        )
+        context.repo.create_tag(test_states.NEXT_MAJOR)
+        self.assertEqual(
+            versionflow.get_current_scm_version(".", cache_stats=stats),
+            test_states.NEXT_MAJOR,
+        )
+        self.assertEqual(stats, [(0, 1), (1, 1), (1, 2)])
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_hit_does_not_write(self, context=None):
+        path = os.path.join(context.repo.git_dir, versionflow.DESCRIBE_CACHE_FILE)
+        described = versionflow.get_current_scm_version(".")
+        written = os.stat(path)
+        self.assertEqual(versionflow.get_current_scm_version("."), described)
+        self.assertEqual(os.stat(path).st_ino, written.st_ino)
+        self.assertEqual(
+            [name for name in os.listdir(context.repo.git_dir) if name.endswith(".tmp")],
+            [],
+        )
+        stats = []
+        versionflow.get_current_scm_version(".", cache_stats=stats)
+        self.assertEqual(stats, [(1, 0)])
+
+
+class Test_ReleaseFinish(BaseTest):
+    def release(self, args=(), fallback=False):
+        with versionflow.git_context() as repo:
+            develop = repo.heads.develop.commit
+        result = self.runner.invoke(versionflow.cli, args=list(args) + ["minor"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual("using git flow" in result.output, fallback)
+        with versionflow.git_context() as repo:
+            self.assertEqual(repo.active_branch.name, "develop")
+            self.assertFalse(repo.is_dirty(untracked_files=True))
+            self.assertEqual(
+                sorted(head.name for head in repo.heads), ["develop", "master"])
+            tag = repo.tags[test_states.NEXT_MINOR]
+            self.assertEqual(tag.tag.message, test_states.NEXT_MINOR)
+            self.assertEqual(tag.commit, repo.heads.master.commit)
+            self.assertTrue(repo.is_ancestor(develop, repo.heads.develop.commit))
+            self.assertTrue(repo.is_ancestor(tag.commit, repo.heads.develop.commit))
+            return repo.git.log("--graph", "--format=%T %s", "--all")
+
+    def compare_with_gitflow(self, args=()):
+        path = os.getcwd()
+        shutil.copytree(path, path + "-gitflow")
+        try:
+            plumbing = self.release(args)
+            os.chdir(path + "-gitflow")
+            self.assertEqual(self.release(["--finish", "gitflow"]), plumbing)
+        finally:
+            os.chdir(path)
+            shutil.rmtree(path + "-gitflow")
+        return plumbing
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo
+    def test_fast_forward(self):
+        self.compare_with_gitflow()
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_merge(self, context=None):
+        with open("develop_file", "w") as handle:
+            handle.write("develop\n")
+        context.repo.index.add(["develop_file"])
+        context.repo.index.commit("Develop")
+        self.assertIn("Finished release 1.1.0.", self.compare_with_gitflow())
+
+    @action_decorator.mktempdir
+    @test_states.with_versioned_file("context")
+    def test_worktree(self, context=None):
+        with open("develop_file", "w") as handle:
+            handle.write("develop\n")
+        context.repo.index.add(["develop_file"])
+        context.repo.index.commit("Develop")
+        untouched = os.stat(test_states.INITIAL_FILE).st_mtime
+        os.utime(test_states.INITIAL_FILE, (untouched - 10, untouched - 10))
+        self.compare_with_gitflow(["--worktree"])
+        self.assertEqual(
+            os.stat(test_states.INITIAL_FILE).st_mtime, untouched - 10)
+        with open(test_states.VERSIONED_FILE) as handle:
+            self.assertEqual(handle.read(), "version = 1.1.0\n")
+        with versionflow.git_context() as repo:
+            self.assertEqual(len(repo.git.worktree("list").splitlines()), 1)
+
+    @action_decorator.mktempdir
+    @test_states.with_versioned_file("context")
+    def test_worktree_fallback(self, context=None):
+        run = versionflow.ReleaseFinish.run
+        versionflow.ReleaseFinish.run = lambda finish: False
+        try:
+            self.release(["--worktree"], fallback=True)
+        finally:
+            versionflow.ReleaseFinish.run = run
+        with open(test_states.VERSIONED_FILE) as handle:
+            self.assertEqual(handle.read(), "version = 1.1.0\n")
+        with versionflow.git_context() as repo:
+            self.assertEqual(len(repo.git.worktree("list").splitlines()), 1)
+
+    @action_decorator.mktempdir
+    @test_states.with_versioned_file("context")
+    def test_behind_remote(self, context=None):
+        develop = context.repo.heads.develop.commit
+        context.repo.index.commit("Develop")
+        context.repo.create_remote("origin", ".")
+        context.repo.git.update_ref(
+            "refs/remotes/origin/develop", context.repo.heads.develop.commit)
+        context.repo.heads.develop.commit = develop
+        context.repo.head.reset(index=True, working_tree=True)
+        master = context.repo.heads.master.commit
+        result = self.runner.invoke(versionflow.cli, args=["minor"])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("may be fast-forwarded", result.output)
+        self.assertIn(versionflow.BranchNotUpToDate.__doc__, result.output)
+        with versionflow.git_context() as repo:
+            self.assertNotIn(test_states.NEXT_MINOR, repo.tags)
+            self.assertEqual(repo.heads.master.commit, master)
+
+    @action_decorator.mktempdir
+    @test_states.with_versioned_file("context")
+    def test_worktree_gitflow_finish(self, context=None):
+        result = self.runner.invoke(
+            versionflow.cli, args=["--worktree", "--finish", "gitflow", "minor"])
+        self.assertEqual(result.exit_code, 2)
+        self.assertIn("--worktree", result.output)
+
+    def diverged_release(self, repo):
+        """Start a release, with a commit on it and another on develop."""
+        repo.git.checkout("-b", "release/1.1.0")
+        for branch, name in [
+            ("release/1.1.0", "release_file"),
+            ("develop", "develop_file"),
+        ]:
+            repo.git.checkout(branch)
+            with open(name, "w") as handle:
+                handle.write(name + "\n")
+            repo.git.add(name)
+            repo.git.commit("-m", name)
+        repo.git.checkout("release/1.1.0")
+        return versionflow.ReleaseFinish(
+            repo, "release/1.1.0", "master", "develop", "1.1.0", "1.1.0", "Finish")
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_checkout_fails(self, context=None):
+        finish = self.diverged_release(context.repo)
+        refs = context.repo.git.show_ref()
+        # An untracked file which the checkout of develop would overwrite
+        with open("develop_file", "w") as handle:
+            handle.write("untracked\n")
+        self.assertRaises(git.GitCommandError, finish.run)
+        self.assertEqual(context.repo.git.show_ref(), refs)
+        self.assertEqual(context.repo.active_branch.name, "release/1.1.0")
+        self.assertFalse(context.repo.is_dirty())
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_ref_update_fails(self, context=None):
+        finish = self.diverged_release(context.repo)
+        refs = context.repo.git.show_ref()
+        # Another git process is updating master
+        open(os.path.join(".git", "refs", "heads", "master.lock"), "w").close()
+        self.assertRaises(git.GitCommandError, finish.run)
+        self.assertEqual(context.repo.git.show_ref(), refs)
+        self.assertEqual(context.repo.active_branch.name, "release/1.1.0")
+        self.assertFalse(context.repo.is_dirty(untracked_files=True))
+        self.assertFalse(os.path.exists("develop_file"))
+
+    @action_decorator.mktempdir
+    @test_states.good_base_repo("context")
+    def test_remote(self, context=None):
+        context.repo.create_remote("origin", os.getcwd()).fetch()
+        self.release()
+
+
+class Test_PartialClone(BaseTest):
+    def partial_clone(self, repo, path):
+        """Clone `repo` to `path` without any blobs, on master."""
+        repo.git.config("uploadpack.allowFilter", "true")
+        repo.git.config("uploadpack.allowAnySHA1InWant", "true")
+        repo.git.clone(
+            "--filter=blob:none", "--no-checkout", "file://" + repo.working_dir, path)
+        clone = git.Repo(path)
+        for setting in versionflow.GITFLOW_SETTINGS:
+            clone.git.config(setting, repo.git.config(setting))
+        clone.git.checkout("-B", "master", "origin/master")
+        clone.git.branch("-f", "develop", "origin/develop")
+        return clone
+
+    @action_decorator.mktempdir
+    @test_states.with_versioned_file("context")
+    def test_fetch_missing_blobs(self, context=None):
+        self.assertEqual(versionflow.promisor_remote(context.repo), None)
+        self.assertEqual(
+            versionflow.fetch_missing_blobs(
+                context.repo, "develop", [test_states.VERSIONED_FILE]),
+            [],
+        )
+        clone = self.partial_clone(context.repo, "clone")
+        try:
+            self.assertEqual(versionflow.promisor_remote(clone), "origin")
+            paths = [test_states.VERSIONED_FILE, versionflow.DEFAULT_BV_FILE, "none"]
+            fetched = versionflow.fetch_missing_blobs(clone, "develop", paths)
+            self.assertEqual(
+                sorted(fetched),
+                sorted(clone.git.rev_parse("develop:" + path) for path in paths[:2]),
+            )
+            self.assertEqual(versionflow.fetch_missing_blobs(clone, "develop", paths), [])
+        finally:
+            clone.close()
+
+    @action_decorator.mktempdir
+    @test_states.with_versioned_file("context")
+    def test_worktree_release(self, context=None):
+        path = os.getcwd()
+        self.partial_clone(context.repo, "clone").close()
+        os.chdir("clone")
+        try:
+            result = self.runner.invoke(versionflow.cli, args=["--worktree", "minor"])
+            self.assertEqual(result.exit_code, 0)
+            self.assertFalse(result.output.endswith("using git flow\n"))
+            with versionflow.git_context() as repo:
+                self.assertEqual(repo.active_branch.name, "master")
+                self.assertFalse(repo.is_dirty())
+                self.assertEqual(
+                    repo.tags[test_states.NEXT_MINOR].commit, repo.heads.master.commit)
+            with open(test_states.VERSIONED_FILE) as handle:
+                self.assertEqual(handle.read(), "version = 1.1.0\n")
+        finally:
+            os.chdir(path)
+
+
+class Test_ConfigCache(unittest.TestCase):
+    @action_decorator.mktempdir
+    def test_invalidation(self):
+        cache = versionflow.ConfigCache()
+        self.assertIsNone(cache.get("config"))
+        with open("config", "w") as handle:
+            handle.write("[bumpversion]\ncurrent_version = 1.0.2\n")
+        parsed = cache.get("config")
+        self.assertIs(cache.get("config"), parsed)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        with open("config.new", "w") as handle:
+            handle.write("[bumpversion]\ncurrent_version = 1.0.3\n")
+        os.rename("config.new", "config")
+        self.assertEqual(
+            cache.get("config").get("bumpversion", "current_version"), "1.0.3")
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    @action_decorator.mktempdir
+    @test_states.with_versioned_file
+    def test_parsed_once(self):
+        misses = versionflow.CONFIG_CACHE.misses
+        vf_repo = versionflow.VersionFlowRepo.open(os.getcwd())
+        self.assertTrue(vf_repo.check().ok)
+        vf_repo.release(versionflow.BV_PATCH)
+        self.assertEqual(vf_repo.check().version, test_states.NEXT_PATCH)
+        self.assertEqual(versionflow.CONFIG_CACHE.misses, misses + 1)
+
+
+class Test_OccurrenceIndex(unittest.TestCase):
+    def index(self, context):
+        return versionflow.OccurrenceIndex.load(context.repo)
+
+    @action_decorator.mktempdir
+    @test_states.with_versioned_file("context")
+    def test_invalidation(self, context=None):
+        vf_repo = versionflow.VersionFlowRepo.open(os.getcwd())
+        self.assertTrue(vf_repo.check().ok)
+        index = self.index(context)
+        self.assertEqual((index.hits, index.misses), (0, 1))
+        self.assertTrue(vf_repo.check().ok)
+        index = self.index(context)
+        self.assertEqual((index.hits, index.misses), (1, 1))
+        self.assertEqual(
+            index.entries[test_states.VERSIONED_FILE][versionflow.BV_DEFAULT_SEARCH][
+                "found"
+            ], [[1, 10]])
+        with open(test_states.VERSIONED_FILE, "w") as handle:
+            handle.write("\nversion = " + test_states.GOOD_VERSION + "\n")
+        context.repo.index.add([test_states.VERSIONED_FILE])
+        context.repo.index.commit("Move the version")
+        self.assertTrue(vf_repo.check().ok)
+        index = self.index(context)
+        self.assertEqual((index.hits, index.misses), (1, 2))
+        self.assertEqual(
+            index.entries[test_states.VERSIONED_FILE][versionflow.BV_DEFAULT_SEARCH][
+                "found"
+            ], [[2, 11]])
+        versions = vf_repo.release(versionflow.BV_PATCH)
+        self.assertEqual(self.index(context).hits, 2)
+        with open(test_states.VERSIONED_FILE) as handle:
+            self.assertEqual(
+                handle.read(), "\nversion = " + versions.new_version + "\n")
+
+
+    @action_decorator.mktempdir
+    @test_states.with_versioned_file("context")
+    def test_same_blob_other_bytes(self, context=None):
+        with open(test_states.VERSIONED_FILE, "w") as handle:
+            handle.write("a\nversion = " + test_states.GOOD_VERSION + "\n")
+        context.repo.index.add([test_states.VERSIONED_FILE])
+        context.repo.index.commit("Move the version")
+        vf_repo = versionflow.VersionFlowRepo.open(os.getcwd())
+        self.assertTrue(vf_repo.check().ok)
+        # The same blob, checked out with CRLF line endings
+        context.repo.git.config("core.autocrlf", "true")
+        with open(test_states.VERSIONED_FILE, "wb") as handle:
+            handle.write(
+                b"a\r\nversion = " + test_states.GOOD_VERSION.encode() + b"\r\n")
+        self.assertTrue(vf_repo.check().ok)
+        self.assertEqual(self.index(context).hits, 0)
+        versions = vf_repo.release(versionflow.BV_PATCH)
+        with open(test_states.VERSIONED_FILE, "rb") as handle:
+            self.assertEqual(
+                handle.read(),
+                b"a\r\nversion = " + versions.new_version.encode() + b"\r\n")
+
+
+class Test_ActionDecorator(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.depths = []
+
+    def make(self, name, fail_after=False):
+        def action(unused_ctx):
+            self.calls.append(name)
+            self.depths.append(len(traceback.extract_stack()))
+
+        def post_action(unused_ctx):
+            self.calls.append("after " + name)
+            if fail_after:
+                raise RuntimeError(name)
+
+        action.__name__ = "test_action_" + name
+        decorator = action_decorator.ActionDecorator(action)
+        decorator.after(post_action)
+        return decorator
+
+    def test_flat_chain(self):
+        parts = [self.make(str(number)) for number in range(10)]
+        chain = functools.reduce(lambda left, right: left | right, parts)
+        self.assertEqual(chain.parts, tuple(parts))
+        contexts = []
+
+        @chain("ctx")
+        def func(ctx=None):
+            contexts.append(type(ctx))
+
+        calls = action_decorator.TIMINGS.totals.get("test_action_9", (0, 0.0))[0]
+        func()
+        func()
+        names = [str(number) for number in range(10)]
+        self.assertEqual(
+            self.calls[:20], names + ["after " + name for name in reversed(names)])
+        self.assertEqual(len(set(self.depths)), 1)
+        self.assertIs(contexts[0], contexts[1])
+        self.assertEqual(
+            action_decorator.TIMINGS.totals["test_action_9"][0], calls + 2)
+
+    def test_post_actions_all_run(self):
+        chain = self.make("a") | self.make("b", fail_after=True) | self.make("c")
+
+        @chain
+        def func():
+            pass
+
+        with self.assertRaises(RuntimeError):
+            func()
+        self.assertEqual(self.calls, ["a", "b", "c", "after c", "after b", "after a"])
+
+
+class Test_StateCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = action_decorator.StateCache(resources={"repo": git.Repo})
+        self.addCleanup(self.cache.clear)
+
+    def state(self):
+        return self.cache.cached(
+            "state"
+            * (test_states.clean_git | test_states._set_custom_bumpversion_config)
+        )
+
+    def test_restores_copies(self):
+        state = self.state()
+        parents = []
+
+        @action_decorator.tempdir
+        @state("context")
+        def use_state(context=None):
+            self.assertEqual(context.path, action_decorator.work_dir())
+            self.assertEqual(context.setup_cfg, "unusual_config")
+            self.assertEqual(context.repo.working_tree_dir, context.path)
+            self.assertFalse(context.repo.is_dirty())
+            initial_file = os.path.join(context.path, test_states.INITIAL_FILE)
+            with open(initial_file, "a") as handle:
+                handle.write("changed\n")
+            context.repo.git.add(test_states.INITIAL_FILE)
+            parents.append(context.repo.index.commit("Change").parents)
+
+        use_state()
+        use_state()
+        self.assertEqual((self.cache.steps_run, self.cache.restores), (3, 2))
+        self.assertEqual(parents[0], parents[1])
+
+    @action_decorator.tempdir
+    def test_links_objects(self):
+        state = self.state()
+
+        @state("context")
+        def use_state(context=None):
+            commit = context.repo.head.commit.hexsha
+            objects = os.path.join(context.path, ".git", "objects")
+            self.assertGreater(
+                os.stat(os.path.join(objects, commit[:2], commit[2:])).st_nlink, 1)
+            self.assertEqual(
+                os.stat(os.path.join(context.path, ".git", "index")).st_nlink, 1)
+
+        use_state()
+
+    def test_steps(self):
+        chain = test_states.clean_git | test_states._make_dirty
+        self.assertEqual(
+            chain.steps,
+            (
+                test_states._make_git,
+                test_states._do_initial_commit,
+                test_states._make_dirty,
+            ),
+        )
+
+    @action_decorator.tempdir
+    def test_shared_prefix(self):
+        self.state()
+        dirty = self.cache.cached(test_states.clean_git | test_states._make_dirty)
+
+        @dirty("context")
+        def use_state(context=None):
+            self.assertTrue(context.repo.is_dirty())
+
+        use_state()
+        self.assertEqual(self.cache.steps_run, 4)
+        self.assertEqual(len(self.cache.states), 2)
+
+
+class Test_Invoke(unittest.TestCase):
+    def test_threads(self):
+        def check(state):
+            @action_decorator.tempdir
+            @state("context")
+            def run(context=None):
+                return invoke(["--repo-dir", context.path, "check"])
+
+            return run()
+
+        states = [test_states.good_base_repo, test_states.dirty_gitflow] * 4
+        pool = ThreadPool(len(states))
+        try:
+            results = pool.map(check, states)
+        finally:
+            pool.close()
+        dirty = str(versionflow.DirtyRepo())
+        for state, result in zip(states, results):
+            if state is test_states.good_base_repo:
+                self.assertEqual(result.exit_code, 0)
+                self.assertNotIn(dirty, result.stdout)
+            else:
+                self.assertEqual(result.exit_code, 1)
+                self.assertTrue(result.stdout.endswith(dirty + "\nAborted!\n"))
+
+
+class Test_Version(unittest.TestCase):
+    def test_version(self):
+        result = click.testing.CliRunner().invoke(versionflow.cli, args=["--version"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(
+            result.output.endswith(
+                "version " + versionflow.get_current_version(None) + "\n"
+            )
+        )
+
+
+STATE_TEST_CASES = [Test_Init, Test_Check, Test_Patch, Test_Minor, Test_Major]
+
+
+def run_parallel(workers):
+    """
+    Run the tests made by StateTest on `workers` threads.
+
+    Returns a unittest.TestResult for all of them.
+    """
+    loader = unittest.TestLoader()
+    tests = [
+        test
+        for testcase in STATE_TEST_CASES
+        for test in loader.loadTestsFromTestCase(testcase)
+    ]
+
+    def run(test):
+        result = unittest.TestResult()
+        test.run(result)
+        return result
+
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(run, tests)
+    finally:
+        pool.close()
+    combined = unittest.TestResult()
+    for result in results:
+        combined.testsRun += result.testsRun
+        combined.errors.extend(result.errors)
+        combined.failures.extend(result.failures)
+        combined.skipped.extend(result.skipped)
+    return combined
+
+
 if __name__ == "__main__":
+    if "--timings" in sys.argv:
+        # Show which setup actions the tests spent the most time on.
+        sys.argv.remove("--timings")
+        atexit.register(
+            lambda: print("\n".join(action_decorator.TIMINGS.report()), file=sys.stderr)
+        )
+    if sys.argv[1:2] == ["--parallel"]:
+        start = time.time()
+        result = run_parallel(int(sys.argv[2]))
+        for test, trace in result.errors + result.failures:
+            print(test, trace, file=sys.stderr)
+        failed = len(result.errors + result.failures)
+        print(
+            "Ran %d tests in %.2fs: %d failed"
+            % (result.testsRun, time.time() - start, failed),
+            file=sys.stderr,
+        )
+        sys.exit(not result.wasSuccessful())
     unittest.main()
@@ -1,10 +1,13 @@
 from __future__ import print_function
+import os
+
 import gitflow.core
 import git
-from action_decorator import ActionDecorator
+from action_decorator import ActionDecorator, StateCache
 import versionflow
 
 INITIAL_FILE = u"initial_file"
+VERSIONED_FILE = u"versioned_file"
 DIRTY_FILE = u"dirty"
 GOOD_VERSION = u"1.0.2"
 NEXT_PATCH = u"1.0.3"
@@ -13,6 +16,10 @@ NEXT_MAJOR = u"2.0.0"
 BAD_VERSION = u"0.0.2"
 
 
+def _path(ctx, filename):
+    return os.path.join(ctx.path, filename)
+
+
 @ActionDecorator
 def _do_nothing(unused_ctx):
     pass
@@ -20,7 +27,7 @@ def _do_nothing(unused_ctx):
 
 @ActionDecorator
 def _make_git(ctx):
-    ctx.repo = git.Repo.init()
+    ctx.repo = git.Repo.init(ctx.path)
 
 
 @_make_git.after
@@ -33,15 +40,15 @@ def _close_git(ctx):
 @ActionDecorator
 def _do_initial_commit(ctx):
     assert not ctx.repo.is_dirty()
-    with open(INITIAL_FILE, "w") as handle:
+    with open(_path(ctx, INITIAL_FILE), "w") as handle:
         print("initial", file=handle)
-    ctx.repo.index.add([INITIAL_FILE])
+    ctx.repo.git.add(INITIAL_FILE)
     ctx.repo.index.commit("Initial commit")
 
 
 @ActionDecorator
 def _init_gitflow(ctx):
-    ctx.gf_wrapper = gitflow.core.GitFlow()
+    ctx.gf_wrapper = gitflow.core.GitFlow(ctx.path)
     ctx.gf_wrapper.init()
 
 
@@ -55,9 +62,9 @@ def _close_gitflow(ctx):
 @ActionDecorator
 def _make_dirty(ctx):
     # Make a dirty repo
-    with open(DIRTY_FILE, "w") as handle:
+    with open(_path(ctx, DIRTY_FILE), "w") as handle:
         print(DIRTY_FILE, file=handle)
-    ctx.repo.index.add([DIRTY_FILE])
+    ctx.repo.git.add(DIRTY_FILE)
 
 
 @ActionDecorator
@@ -78,7 +85,7 @@ def _set_standard_bumpversion_config(ctx):
 def _write_bumpversion(ctx):
     # Add bumpversion config
     assert hasattr(ctx, "setup_cfg")
-    with open(ctx.setup_cfg, "w") as handle:
+    with open(_path(ctx, ctx.setup_cfg), "w") as handle:
         print("[bumpversion]", file=handle)
         print("current_version=" + GOOD_VERSION, file=handle)
 
@@ -86,7 +93,7 @@ def _write_bumpversion(ctx):
 @ActionDecorator
 def _stage_bumpversion(ctx):
     assert not ctx.repo.is_dirty()
-    ctx.repo.index.add([ctx.setup_cfg])
+    ctx.repo.git.add(ctx.setup_cfg)
 
 
 @ActionDecorator
@@ -94,6 +101,26 @@ def _commit_bumpversion(ctx):
     ctx.repo.index.commit("Add bumpversion info")
 
 
+@ActionDecorator
+def _add_versioned_file(ctx):
+    with open(_path(ctx, VERSIONED_FILE), "w") as handle:
+        print("version = " + GOOD_VERSION, file=handle)
+    with open(_path(ctx, ctx.setup_cfg), "a") as handle:
+        print("[bumpversion:file:" + VERSIONED_FILE + "]", file=handle)
+    ctx.repo.git.add(VERSIONED_FILE, ctx.setup_cfg)
+    ctx.repo.index.commit("Add versioned file")
+
+
+@ActionDecorator
+def _add_stale_versioned_file(ctx):
+    with open(_path(ctx, VERSIONED_FILE), "w") as handle:
+        print("version = " + BAD_VERSION, file=handle)
+    with open(_path(ctx, ctx.setup_cfg), "a") as handle:
+        print("[bumpversion:file:" + VERSIONED_FILE + "]", file=handle)
+    ctx.repo.git.add(VERSIONED_FILE, ctx.setup_cfg)
+    ctx.repo.index.commit("Add stale versioned file")
+
+
 @ActionDecorator
 def _merge_dev(ctx):
     repo = ctx.repo
@@ -174,40 +201,50 @@ def _set_feature_branch(ctx):
 # results in a new action c which is the composition of a then b,
 # and with c.__name__ = "name"
 
+# Each named state is cached, so it is only built once, and every test
+# using it gets a copy. A state composed from a named state starts from
+# a copy of that one.
+
+STATES = StateCache(resources={"repo": git.Repo, "gf_wrapper": gitflow.core.GitFlow})
+
 # pylint:disable=invalid-name
 
-do_nothing = "nothing" * (_do_nothing)
-make_git = "make_git" * (_make_git)
-nothing_and_custom = "just_custom_set" * (_set_custom_bumpversion_config)
+cached = STATES.cached
 
-dirty_empty_git = "dirty_empty_git" * (make_git | _make_dirty)
-clean_git = "clean_git" * (make_git | _do_initial_commit)
-dirty_git = "dirty_git" * (clean_git | _make_dirty)
+do_nothing = cached("nothing" * (_do_nothing))
+make_git = cached("make_git" * (_make_git))
+nothing_and_custom = cached("just_custom_set" * (_set_custom_bumpversion_config))
 
-empty_gitflow = "empty_gitflow" * (make_git | _init_gitflow)
-dirty_empty_gitflow = "dirty_empty_gitflow" * (empty_gitflow | _make_dirty)
-clean_gitflow = "clean_gitflow" * (empty_gitflow | _do_initial_commit)
-dirty_gitflow = "dirty_gitflow" * (clean_gitflow | _make_dirty)
+dirty_empty_git = cached("dirty_empty_git" * (make_git | _make_dirty))
+clean_git = cached("clean_git" * (make_git | _do_initial_commit))
+dirty_git = cached("dirty_git" * (clean_git | _make_dirty))
 
-just_bump = "just_bump" * (_set_standard_bumpversion_config | _write_bumpversion)
+empty_gitflow = cached("empty_gitflow" * (make_git | _init_gitflow))
+dirty_empty_gitflow = cached("dirty_empty_gitflow" * (empty_gitflow | _make_dirty))
+clean_gitflow = cached("clean_gitflow" * (empty_gitflow | _do_initial_commit))
+dirty_gitflow = cached("dirty_gitflow" * (clean_gitflow | _make_dirty))
 
-git_with_untracked_bump = "git_with_untracked_bump" * (
+just_bump = cached("just_bump" * (
+    _set_standard_bumpversion_config | _write_bumpversion
+))
+
+git_with_untracked_bump = cached("git_with_untracked_bump" * (
     make_git | _set_standard_bumpversion_config | _write_bumpversion
-)
-git_with_dirty_bump = "git_with_dirty_bump" * (
+))
+git_with_dirty_bump = cached("git_with_dirty_bump" * (
     git_with_untracked_bump | _stage_bumpversion
-)
-git_with_bump = "git_with_bump" * (git_with_dirty_bump | _commit_bumpversion)
+))
+git_with_bump = cached("git_with_bump" * (git_with_dirty_bump | _commit_bumpversion))
 
-gitflow_with_untracked_bump = "gitflow_with_untracked_bump" * (
+gitflow_with_untracked_bump = cached("gitflow_with_untracked_bump" * (
     clean_gitflow | _set_standard_bumpversion_config | _write_bumpversion
-)
-gitflow_with_dirty_bump = "gitflow_with_dirty_bump" * (
+))
+gitflow_with_dirty_bump = cached("gitflow_with_dirty_bump" * (
     gitflow_with_untracked_bump | _stage_bumpversion
-)
-gitflow_with_bump = "gitflow_with_bump" * (
+))
+gitflow_with_bump = cached("gitflow_with_bump" * (
     gitflow_with_dirty_bump | _commit_bumpversion
-)
+))
 
 _add_bumpversion = _write_bumpversion | _stage_bumpversion | _commit_bumpversion
 
@@ -222,25 +259,25 @@ _set_merged_bad_tag = (
     _merge_dev | _set_master_branch | _set_bad_tag | _set_develop_branch | _merge_master
 )
 
-empty_bad_tag_and_bump = "empty_bad_tag_and_bump" * (
+empty_bad_tag_and_bump = cached("empty_bad_tag_and_bump" * (
     empty_gitflow
     | _set_standard_bumpversion_config
     | _add_bumpversion
     | _set_merged_bad_tag
-)
-bad_tag_and_bump = "bad_tag_and_bump" * (
+))
+bad_tag_and_bump = cached("bad_tag_and_bump" * (
     clean_gitflow
     | _set_standard_bumpversion_config
     | _add_bumpversion
     | _set_merged_bad_tag
-)
+))
 
 
-good_dev_branch = "good_dev_branch" * (gitflow_with_bump | _set_merged_tag)
+good_dev_branch = cached("good_dev_branch" * (gitflow_with_bump | _set_merged_tag))
 
-good_base_repo = "good_base_repo" * (good_dev_branch | _ff_master)
+good_base_repo = cached("good_base_repo" * (good_dev_branch | _ff_master))
 
-good_custom_config = "custom_bump" * (
+good_custom_config = cached("custom_bump" * (
     clean_gitflow
     | _set_custom_bumpversion_config
     | _add_bumpversion
@@ -249,17 +286,25 @@ good_custom_config = "custom_bump" * (
     | _set_good_tag
     | _set_develop_branch
     | _merge_master
-)
+))
 
-version_tag_on_wrong_branch = "version_tag_on_wrong_branch" * (
+version_tag_on_wrong_branch = cached("version_tag_on_wrong_branch" * (
     clean_gitflow | _set_custom_bumpversion_config | _add_bumpversion | _set_good_tag
-)
+))
 
-on_bad_master = "on_bad_master" * (
+on_bad_master = cached("on_bad_master" * (
     gitflow_with_bump | _set_good_tag | _set_master_branch
-)
-on_master = "on_master" * (good_base_repo | _set_master_branch)
-existing_release = "existing_release" * (good_base_repo | _make_release_branch)
-on_release_branch = "on_release_branch" * (existing_release | _set_release_branch)
-with_feature = "with_feature" * (good_base_repo | _make_feature_branch)
-on_feature = "on_feature" * (with_feature | _set_feature_branch)
+))
+on_master = cached("on_master" * (good_base_repo | _set_master_branch))
+existing_release = cached("existing_release" * (good_base_repo | _make_release_branch))
+on_release_branch = cached("on_release_branch" * (
+    existing_release | _set_release_branch
+))
+with_feature = cached("with_feature" * (good_base_repo | _make_feature_branch))
+on_feature = cached("on_feature" * (with_feature | _set_feature_branch))
+with_versioned_file = cached("with_versioned_file" * (
+    good_base_repo | _add_versioned_file
+))
+with_stale_versioned_file = cached("with_stale_versioned_file" * (
+    good_base_repo | _add_stale_versioned_file
+))
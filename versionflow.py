@@ -1,6 +1,19 @@
+import bisect
+import copy
+import datetime
+import glob
+import io
+import json
 import os
+import re
+import shutil
+import string
 import subprocess
+import tempfile
+import threading
+import timeit
 import configparser
+from multiprocessing.pool import ThreadPool
 from contextlib import contextmanager
 import six
 
@@ -9,8 +22,7 @@ import click
 import git
 import gitflow.core
 import gitflow.branches
-import setuptools_scm
-import pkg_resources
+import gitflow.exceptions
 
 VERSION = "0.4.0"
 
@@ -19,12 +31,49 @@ GITFLOW_HOTFIX = u"hotfix"
 BV_PATCH = u"patch"
 BV_MINOR = u"minor"
 BV_MAJOR = u"major"
+BATCH_CHECK = u"check"
+BATCH_ACTIONS = [BATCH_CHECK, BV_PATCH, BV_MINOR, BV_MAJOR]
+BATCH_FIELDS = [u"repo", u"action", u"status", u"version", u"seconds", u"error"]
 BV_SECTION = u"bumpversion"
-BV_EXEC = u"bumpversion"
 BV_CURRENT_VER_OPTION = u"current_version"
 BV_NEW_VER_OPTION = u"new_version"
 START_VERSION = u"0.0.0"
 DEFAULT_BV_FILE = u".versionflow"
+BV_DEFAULT_PARSE = r"(?P<major>\d+)\.(?P<minor>\d+)\.(?P<patch>\d+)"
+BV_DEFAULT_SERIALIZE = u"{major}.{minor}.{patch}"
+BV_DEFAULT_SEARCH = u"{current_version}"
+BV_DEFAULT_REPLACE = u"{new_version}"
+BV_DEFAULT_MESSAGE = u"Bump version: {current_version} \u2192 {new_version}"
+VERSION_TAG_PATTERN = re.compile(r"^v?(\d+\.\d+\.\d+)$")
+# Globs for git describe which match at least every version tag
+VERSION_TAG_GLOBS = (u"[0-9]*.[0-9]*.[0-9]*", u"v[0-9]*.[0-9]*.[0-9]*")
+REF_TYPES = (u"heads", u"tags")
+FOR_EACH_REF_ARGS = (u"--format=%(refname) %(objectname) %(*objectname)",) + tuple(
+    u"refs/" + ref_type for ref_type in REF_TYPES
+)
+# Staged changes, then unstaged ones
+DIRTY_CHECKS = ((u"--cached", u"--quiet"), (u"--quiet",))
+# The settings nu-gitflow needs for a repo to count as initialised
+GITFLOW_SETTINGS = (
+    u"gitflow.branch.master",
+    u"gitflow.branch.develop",
+    u"gitflow.prefix.feature",
+    u"gitflow.prefix.release",
+    u"gitflow.prefix.hotfix",
+    u"gitflow.prefix.support",
+    u"gitflow.prefix.versiontag",
+)
+DESCRIBE_CACHE_FILE = u"versionflow-describe.json"
+VERSION_INDEX_FILE = u"versionflow-index"
+# Version files bigger than this are rewritten a chunk at a time
+STREAM_THRESHOLD = 16 * 1024 * 1024
+STREAM_CHUNK_SIZE = 1024 * 1024
+IO_WORKERS = 8
+BV_SECTION_PATTERN = re.compile("^" + BV_SECTION + ":(file|part):(.+)$")
+FINISH_PLUMBING = u"plumbing"
+FINISH_GITFLOW = u"gitflow"
+OUTPUT_TEXT = u"text"
+OUTPUT_JSON = u"json"
 
 
 class VersionFlowError(Exception):
@@ -34,6 +83,11 @@ class VersionFlowError(Exception):
         """
         return self.__doc__
 
+    @property
+    def code(self):
+        """A stable identifier for the error, e.g. "dirty-repo"."""
+        return re.sub(r"(?<!^)(?=[A-Z])", u"-", type(self).__name__).lower()
+
 
 class NoRepo(VersionFlowError):
     """Not a git repo."""
@@ -67,6 +121,10 @@ class SetNextBumpVersionError(VersionFlowError):
     """Could not set the next version with bumpversion."""
 
 
+class VersionNotInFile(VersionFlowError):
+    """The current version is missing from a version file."""
+
+
 class NoVersionTags(VersionFlowError):
     """Could not get version number from repository tags."""
 
@@ -87,9 +145,221 @@ class GitError(VersionFlowError):
     """Error executing git commands."""
 
 
+class GitFlowError(VersionFlowError):
+    """Error from git flow."""
+
+
+class BadBumpVersionConfig(VersionFlowError):
+    """Could not parse the bumpversion config."""
+
+
+class BranchNotUpToDate(VersionFlowError):
+    """A git flow branch is behind its remote tracking branch."""
+
+
+# The errors of the libraries used, and the errors to report them as
+LIBRARY_ERRORS = [
+    (git.GitCommandError, GitError),
+    (gitflow.exceptions.GitflowError, GitFlowError),
+    (configparser.Error, BadBumpVersionConfig),
+]
+
+
+def as_versionflow_error(exc):
+    """Return the VersionFlowError to report `exc` as, or None."""
+    if isinstance(exc, VersionFlowError):
+        return exc
+    for library_error, error in LIBRARY_ERRORS:
+        if isinstance(exc, library_error):
+            return error()
+    return None
+
+
+@attr.s
+class TracePhase(object):
+    """The wall time and git usage of one phase of a versionflow run."""
+
+    name = attr.ib()
+    thread = attr.ib()
+    start = attr.ib()
+    seconds = attr.ib(default=0.0)
+    git_processes = attr.ib(default=0)
+    bytes_read = attr.ib(default=0)
+
+
+@attr.s
+class Tracer(object):
+    """Records the phases of a versionflow run while it is installed.
+
+    Git processes and the bytes of output read from them are counted
+    towards every phase that is open in the thread which ran them. Only
+    the repos opened through repo_type while it is installed are traced.
+    """
+
+    start = attr.ib(default=attr.Factory(timeit.default_timer))
+    phases = attr.ib(default=attr.Factory(list))
+    git_processes = attr.ib(default=0)
+    bytes_read = attr.ib(default=0)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+    _local = attr.ib(default=attr.Factory(threading.local), repr=False)
+
+    def install(self):
+        global _TRACER
+        _TRACER = self
+
+    @staticmethod
+    def uninstall():
+        global _TRACER
+        _TRACER = None
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    @contextmanager
+    def phase(self, name):
+        phase = TracePhase(
+            name, threading.current_thread().ident, timeit.default_timer())
+        stack = self._stack()
+        stack.append(phase)
+        try:
+            yield phase
+        finally:
+            stack.pop()
+            phase.seconds = timeit.default_timer() - phase.start
+            with self._lock:
+                self.phases.append(phase)
+
+    def record_git(self, processes, nbytes):
+        for phase in self._stack():
+            phase.git_processes += processes
+            phase.bytes_read += nbytes
+        with self._lock:
+            self.git_processes += processes
+            self.bytes_read += nbytes
+
+    def summary(self):
+        """Return the phases totalled by name, as lines of a table."""
+        totals = {}
+        names = []
+        for phase in self.phases:
+            if phase.name not in totals:
+                names.append(phase.name)
+                totals[phase.name] = [0.0, 0, 0]
+            total = totals[phase.name]
+            total[0] += phase.seconds
+            total[1] += phase.git_processes
+            total[2] += phase.bytes_read
+        rows = [(name,) + tuple(totals[name]) for name in names]
+        rows.append(
+            (
+                u"total",
+                timeit.default_timer() - self.start,
+                self.git_processes,
+                self.bytes_read,
+            )
+        )
+        lines = [u"%-20s %9s %5s %9s" % (u"phase", u"seconds", u"git", u"bytes")]
+        lines.extend(u"%-20s %9.3f %5d %9d" % row for row in rows)
+        return lines
+
+    def chrome_trace(self):
+        """Return the phases in the Chrome trace event format."""
+        pid = os.getpid()
+        return {
+            u"traceEvents": [
+                {
+                    u"name": phase.name,
+                    u"ph": u"X",
+                    u"ts": (phase.start - self.start) * 1e6,
+                    u"dur": phase.seconds * 1e6,
+                    u"pid": pid,
+                    u"tid": phase.thread,
+                    u"args": {
+                        u"git_processes": phase.git_processes,
+                        u"bytes_read": phase.bytes_read,
+                    },
+                }
+                for phase in sorted(self.phases, key=lambda phase: phase.start)
+            ]
+        }
+
+
+_TRACER = None
+
+
 @contextmanager
-def gitflow_context(*args, **kwargs):
-    gflow = gitflow.core.GitFlow(*args, **kwargs)
+def trace_phase(name):
+    """Record the enclosed code as a phase, if a Tracer is installed."""
+    tracer = _TRACER
+    if tracer is None:
+        yield
+    else:
+        with tracer.phase(name):
+            yield
+
+
+def trace_git(processes=0, nbytes=0):
+    tracer = _TRACER
+    if tracer is not None:
+        tracer.record_git(processes, nbytes)
+
+
+class TracingGit(git.Git):
+    """A git command wrapper which reports what it runs to the Tracer."""
+
+    def execute(self, command, *args, **kwargs):
+        trace_git(processes=1)
+        result = super(TracingGit, self).execute(command, *args, **kwargs)
+        output = result[1] if isinstance(result, tuple) else result
+        if isinstance(output, six.text_type):
+            output = output.encode("utf-8")
+        if isinstance(output, six.binary_type):
+            trace_git(nbytes=len(output))
+        return result
+
+
+_TRACING_REPO_TYPES = {}
+
+
+def repo_type(base=git.Repo):
+    """Return the class to open a repo of class `base` with.
+
+    While a Tracer is installed this is a subclass of `base` whose git
+    commands are traced; otherwise it is `base` itself.
+    """
+    if _TRACER is None:
+        return base
+    try:
+        return _TRACING_REPO_TYPES[base]
+    except KeyError:
+        return _TRACING_REPO_TYPES.setdefault(
+            base,
+            type(
+                "Tracing" + base.__name__,
+                (base,),
+                {"GitCommandWrapperType": TracingGit},
+            ),
+        )
+
+
+def open_gitflow(path, base=git.Repo):
+    """Make a GitFlow for `path`, with its repo opened as repo_type(base)."""
+    gflow = gitflow.core.GitFlow(path)
+    cls = repo_type(base)
+    if gflow.repo is not None and type(gflow.repo) is not cls:
+        gflow.repo.close()
+        gflow.repo = cls(path)
+    gflow.git = cls.GitCommandWrapperType(gflow.working_dir)
+    return gflow
+
+
+@contextmanager
+def gitflow_context(path="."):
+    gflow = open_gitflow(path)
     try:
         yield gflow
     finally:
@@ -98,7 +368,7 @@ def gitflow_context(*args, **kwargs):
 
 @contextmanager
 def git_context(*args, **kwargs):
-    repo = git.Repo(*args, **kwargs)
+    repo = repo_type()(*args, **kwargs)
     try:
         yield repo
     finally:
@@ -107,156 +377,887 @@ def git_context(*args, **kwargs):
 
 @contextmanager
 def init_git_context(*args, **kwargs):
-    repo = git.Repo.init(*args, **kwargs)
+    repo = repo_type().init(*args, **kwargs)
     try:
         yield repo
     finally:
         repo.close()
 
 
+@attr.s
+class GitCommand(object):
+    """A job which runs git with `args`: see run_steps."""
+
+    args = attr.ib()
+
+
+def run_steps(steps, run_git):
+    """Run a step generator, one job at a time.
+
+    A step generator yields lists of jobs which it needs done, and which
+    don't depend on each other, and is sent back a list of their results.
+    A job is either a GitCommand, which is run with `run_git(args)` to
+    give its (status, output), or a function of no arguments, whose
+    result is what it returns. The versionflow checks are written as
+    step generators so that versionflow_async can run the same checks,
+    running their jobs for many repos at once.
+    """
+    results = None
+    while True:
+        try:
+            jobs = steps.send(results)
+        except StopIteration:
+            return
+        results = run_jobs(jobs, run_git)
+
+
+def run_jobs(jobs, run_git):
+    """Run a list of jobs in turn, and return their results."""
+    return [
+        run_git(job.args) if isinstance(job, GitCommand) else job() for job in jobs
+    ]
+
+
+def git_runner(repo):
+    """Return a function which runs git in `repo`, for run_steps."""
+
+    def run_git(args):
+        status, output, _ = repo.git.execute(
+            [repo.git.GIT_PYTHON_GIT_EXECUTABLE] + list(args),
+            with_extended_output=True,
+            with_exceptions=False,
+        )
+        return status, output
+
+    return run_git
+
+
+def exited_ok(result):
+    """Did a git command which answers yes or no with its status say yes?
+
+    Raises GitError if it failed instead.
+    """
+    status, _ = result
+    if status not in (0, 1):
+        raise GitError()
+    return status == 0
+
+
+def ancestor_job(commit, descendant):
+    """A job which asks whether `commit` is an ancestor of `descendant`."""
+    return GitCommand((u"merge-base", u"--is-ancestor", commit, descendant))
+
+
+@attr.s
+class RepoSnapshot(object):
+    """The state of a git repo that the versionflow checks look at.
+
+    This is gathered with a fixed, small number of git commands no
+    matter how many checks use it. Call `refresh` after changing the
+    repo to bring it up to date.
+    """
+
+    repo = attr.ib()
+    config_path = attr.ib()
+    head = attr.ib(default=None)
+    branch = attr.ib(default=None)
+    dirty = attr.ib(default=False)
+    branches = attr.ib(factory=dict)
+    tags = attr.ib(factory=dict)
+    config_blob = attr.ib(default=None)
+
+    @classmethod
+    def for_repo(cls, repo, bumpversion_config):
+        """Make a snapshot of `repo`, without reading anything yet."""
+        config_path = os.path.relpath(
+            os.path.join(repo.working_dir, bumpversion_config), repo.working_dir)
+        return cls(repo, config_path.replace(os.sep, "/"))
+
+    @classmethod
+    def capture(cls, repo, bumpversion_config):
+        snapshot = cls.for_repo(repo, bumpversion_config)
+        snapshot.refresh()
+        return snapshot
+
+    def refresh(self):
+        run_steps(self.read_steps(), git_runner(self.repo))
+
+    def read_steps(self):
+        """A step generator which reads the snapshot: see run_steps.
+
+        The refs, the config file's blob and the first of DIRTY_CHECKS
+        are read at once. Each `git diff --quiet` in DIRTY_CHECKS stops
+        at the first change it finds, and the next is only run if it
+        found none, so the working tree isn't diffed if something is
+        staged. Unlike `git status`, they don't work out every change.
+        They refresh the index as status does, so they use git's
+        fsmonitor if core.fsmonitor is set.
+        """
+        self.branch, self.head = read_head(self.repo)
+        jobs = [
+            lambda: read_refs(self.repo),
+            GitCommand((u"diff",) + DIRTY_CHECKS[0]),
+        ]
+        if self.head is not None:
+            jobs.append(GitCommand((u"ls-tree", self.head, u"--", self.config_path)))
+        results = yield jobs
+        (self.branches, self.tags), staged = results[:2]
+        self.config_blob = None
+        for status, output in results[2:]:
+            if status:
+                raise GitError()
+            for line in output.splitlines():
+                mode_type_sha, path = line.split("\t", 1)
+                if path == self.config_path:
+                    self.config_blob = mode_type_sha.split()[-1]
+        self.dirty = not exited_ok(staged)
+        for args in DIRTY_CHECKS[1:]:
+            if self.dirty:
+                break
+            (result,) = yield [GitCommand((u"diff",) + args)]
+            self.dirty = not exited_ok(result)
+
+    def contains(self, branch, commit):
+        """Is `commit` reachable from the tip of the given branch?"""
+        if branch not in self.branches:
+            return False
+        (result,) = run_jobs(
+            [ancestor_job(commit, self.branches[branch])], git_runner(self.repo))
+        return exited_ok(result)
+
+
+def read_refs(repo):
+    """Read the branches and tags of a repo.
+
+    Returns two dicts, mapping branch names and tag names to the commits
+    they point at. Annotated tags are peeled to the commit they tag.
+
+    The refs are read straight from the packed-refs file and the loose
+    ref files, so this usually runs no git commands at all: only loose
+    tags, and packed ones that git has not recorded as peeled, are
+    peeled with a single `git cat-file`.
+    """
+    common_dir = repo.common_dir
+    if os.path.isdir(os.path.join(common_dir, "reftable")):
+        return _read_refs_with_git(repo)
+    refs = {}
+    peeled = {}
+    packed_refs = os.path.join(common_dir, "packed-refs")
+    tags_peeled = False
+    if os.path.exists(packed_refs):
+        with io.open(packed_refs, encoding="utf-8") as handle:
+            refname = None
+            for line in handle:
+                line = line.rstrip("\n")
+                if line.startswith("#"):
+                    tags_peeled = " peeled" in line or "fully-peeled" in line
+                elif line.startswith("^"):
+                    peeled[refname] = line[1:]
+                elif line:
+                    sha, refname = line.split(" ", 1)
+                    refs[refname] = sha
+                    if tags_peeled:
+                        peeled[refname] = sha
+    for ref_type in REF_TYPES:
+        ref_dir = os.path.join(common_dir, "refs", ref_type)
+        for dirpath, _, filenames in os.walk(ref_dir):
+            subdir = os.path.relpath(dirpath, ref_dir)
+            prefix = "refs/" + ref_type + "/"
+            if subdir != os.curdir:
+                prefix += subdir.replace(os.sep, "/") + "/"
+            for filename in filenames:
+                with open(os.path.join(dirpath, filename), "rb") as handle:
+                    sha = handle.read().decode("utf-8").strip()
+                if sha.startswith("ref:"):
+                    continue
+                refname = prefix + filename
+                if refs.get(refname) != sha:
+                    refs[refname] = sha
+                    peeled.pop(refname, None)
+    unpeeled = [
+        refname
+        for refname in refs
+        if refname.startswith("refs/tags/") and refname not in peeled
+    ]
+    if unpeeled:
+        trace_git(processes=1)
+        output = subprocess.Popen(
+            [git.Git.GIT_PYTHON_GIT_EXECUTABLE, "cat-file", "--batch-check"],
+            cwd=repo.working_dir,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        ).communicate(
+            "".join(refs[refname] + "^{commit}\n" for refname in unpeeled).encode(
+                "ascii")
+        )[0]
+        trace_git(nbytes=len(output))
+        for refname, line in zip(unpeeled, output.decode("ascii").splitlines()):
+            if not line.endswith(" missing"):
+                peeled[refname] = line.split()[0]
+    return _split_refs(
+        (refname, peeled.get(refname, sha)) for refname, sha in refs.items()
+    )
+
+
+def _read_refs_with_git(repo):
+    return parse_for_each_ref(repo.git.for_each_ref(*FOR_EACH_REF_ARGS))
+
+
+def parse_for_each_ref(output):
+    """Read the output of `git for-each-ref` with FOR_EACH_REF_ARGS."""
+    lines = output.splitlines()
+    # For annotated tags the last field is the tagged commit
+    return _split_refs((line.split()[0], line.split()[-1]) for line in lines)
+
+
+def _split_refs(refs):
+    branches = {}
+    tags = {}
+    for refname, sha in refs:
+        if refname.startswith("refs/heads/"):
+            branches[refname[len("refs/heads/"):]] = sha
+        elif refname.startswith("refs/tags/"):
+            tags[refname[len("refs/tags/"):]] = sha
+    return branches, tags
+
+
+def git_input(repo, text, *args):
+    """Run a git command with `text` as its input, and return its output.
+
+    Raises GitCommandError if it fails, as GitPython does.
+    """
+    command = [git.Git.GIT_PYTHON_GIT_EXECUTABLE] + list(args)
+    trace_git(processes=1)
+    proc = subprocess.Popen(
+        command,
+        cwd=repo.working_dir,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    output, error = proc.communicate(text.encode("utf-8"))
+    trace_git(nbytes=len(output))
+    if proc.returncode:
+        raise git.GitCommandError(command, proc.returncode, error, output)
+    return output.decode("utf-8")
+
+
+@attr.s
+class TagDescription(object):
+    """Where a commit is relative to its nearest version tag.
+
+    `tag` is the name of the tag, which may have a "v" before the version.
+    """
+
+    version = attr.ib()
+    commit = attr.ib()
+    distance = attr.ib()
+    tag = attr.ib(default=None)
+
+    def describe(self, dirty):
+        """Describe the commit like setuptools_scm's node-and-date scheme."""
+        date = datetime.datetime.now().strftime("%Y%m%d")
+        if self.distance:
+            local = "g" + self.commit[:7]
+            if dirty:
+                local += ".d" + date
+        else:
+            local = "d" + date if dirty else ""
+        return self.version + ("+" + local if local else "")
+
+
+@attr.s
+class VersionTags(object):
+    """The semantic version tags of a git repo."""
+
+    repo = attr.ib()
+    tags = attr.ib()
+
+    @classmethod
+    def read(cls, repo):
+        _, tags = read_refs(repo)
+        return cls(repo, tags)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        return cls(snapshot.repo, snapshot.tags)
+
+    def tags_by_commit(self):
+        """Map each tagged commit to the (version, tag name) of its
+        highest version tag."""
+        by_commit = {}
+        for tag, commit in self.tags.items():
+            match = VERSION_TAG_PATTERN.match(tag)
+            if match:
+                version = match.group(1)
+                best = by_commit.get(commit)
+                if best is None or _version_key(version) > _version_key(best[0]):
+                    by_commit[commit] = (version, tag)
+        return by_commit
+
+    def nearest(self, target="HEAD"):
+        """Find the version tag nearest to `target`, as `git describe` does.
+
+        That is the one with the fewest commits between it and `target`,
+        which isn't always the newest one when branches have been merged.
+        Returns a TagDescription of `target`. Raises LookupError if there
+        is no such tag.
+        """
+        found = []
+        run_steps(self.nearest_steps(target, found), git_runner(self.repo))
+        return found[0]
+
+    def nearest_steps(self, target, found):
+        """nearest, as a step generator: see run_steps.
+
+        The TagDescription is appended to `found`.
+        """
+        if not self.tags_by_commit():
+            raise LookupError("No version tags in the repo")
+        excluded = []
+        while True:
+            ((status, output),) = yield [
+                GitCommand([u"describe"] + describe_args(target, excluded))
+            ]
+            if status:
+                break
+            description = self.parse_describe(output)
+            if description is not None:
+                if description.distance:
+                    # git describe's count can be out when commits have
+                    # the same date, so count them exactly
+                    ((status, output),) = yield [
+                        GitCommand(
+                            (
+                                u"rev-list",
+                                u"--count",
+                                u"refs/tags/%s..%s" % (description.tag, target),
+                            )
+                        )
+                    ]
+                    if status:
+                        raise GitError()
+                    description.distance = int(output)
+                found.append(description)
+                return
+            # The globs matched a tag that isn't a version, e.g. "1.2.3rc"
+            excluded.append(output.rsplit("-", 2)[0])
+        raise LookupError("No version tags reachable from " + target)
+
+    def parse_describe(self, output):
+        """Make a TagDescription from the output of `git describe`.
+
+        Returns None if the tag described isn't a version tag.
+        """
+        tag, distance, commit = output.strip().rsplit("-", 2)
+        if tag not in self.tags or not VERSION_TAG_PATTERN.match(tag):
+            return None
+        # Of the version tags on the same commit, use the highest
+        version, tag = self.tags_by_commit()[self.tags[tag]]
+        return TagDescription(version, commit[1:], int(distance), tag)
+
+
+def describe_args(target, excluded=()):
+    """The arguments to `git describe` `target` by its nearest version tag."""
+    args = [u"--tags", u"--long", u"--abbrev=40"]
+    for glob in VERSION_TAG_GLOBS:
+        args += [u"--match", glob]
+    for tag in excluded:
+        args += [u"--exclude", tag]
+    return args + [target]
+
+
+@attr.s
+class DescribeCache(object):
+    """A cache of the version tag description of HEAD.
+
+    This is kept in a file in the git dir, and is only used while HEAD
+    and the tag refs are unchanged. It can also count its hits and
+    misses, but only does so when asked, as counting a hit means
+    writing the file again.
+    """
+
+    path = attr.ib()
+    key = attr.ib()
+    valid = attr.ib(default=False)
+    entry = attr.ib(default=None)
+    hits = attr.ib(default=0)
+    misses = attr.ib(default=0)
+
+    @classmethod
+    def load(cls, repo):
+        cache = cls(
+            os.path.join(repo.git_dir, DESCRIBE_CACHE_FILE),
+            _describe_cache_key(repo)
+        )
+        try:
+            with io.open(cache.path, encoding="utf-8") as handle:
+                data = json.load(handle)
+            cache.hits = data["hits"]
+            cache.misses = data["misses"]
+            if cache.key is not None and data["key"] == cache.key:
+                cache.entry = data["description"]
+                cache.valid = True
+        except (EnvironmentError, ValueError, KeyError):
+            pass
+        return cache
+
+    def describe(self, repo, count=False):
+        """Get the description of HEAD, from the cache if possible.
+
+        The file is only written on a miss, unless `count` is set, when
+        the hit is counted in it too.
+        """
+        if self.valid:
+            if count:
+                self.hits += 1
+                self.save()
+            if self.entry is None:
+                raise LookupError("No version tags reachable from HEAD")
+            return TagDescription(**self.entry)
+        if count:
+            self.misses += 1
+        try:
+            description = VersionTags.read(repo).nearest()
+        except LookupError:
+            self.entry = None
+            raise
+        else:
+            self.entry = attr.asdict(description)
+            return description
+        finally:
+            self.valid = self.key is not None
+            self.save()
+
+    def save(self):
+        _write_json(self.path, {
+            "key": self.key if self.valid else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "description": self.entry,
+        })
+
+
+def _describe_cache_key(repo):
+    """Get a key which changes whenever HEAD or any tag might have changed.
+
+    Returns None if HEAD cannot be read from the git dir.
+    """
+    head = _read_head(repo)
+    if head is None:
+        return None
+    key = [head]
+    for path in [("packed-refs",), ("refs", "tags")]:
+        try:
+            stat = os.stat(os.path.join(repo.common_dir, *path))
+            key.append([stat.st_mtime, stat.st_size])
+        except OSError:
+            key.append(None)
+    return key
+
+
+def _read_head(repo):
+    """Get the commit HEAD points at, without running git."""
+    return read_head(repo)[1]
+
+
+def read_head(repo):
+    """Get the branch HEAD is on and the commit it points at.
+
+    This reads the git dir rather than running git. The branch is None
+    if HEAD is detached, and the commit is None if the branch has no
+    commits yet.
+    """
+    branch = commit = None
+    try:
+        with open(os.path.join(repo.git_dir, "HEAD"), "rb") as handle:
+            head = handle.read().decode("utf-8").strip()
+        if not head.startswith("ref:"):
+            return None, head
+        refname = head[len("ref:"):].strip()
+        if refname.startswith("refs/heads/"):
+            branch = refname[len("refs/heads/"):]
+        loose_ref = os.path.join(repo.common_dir, *refname.split("/"))
+        if os.path.exists(loose_ref):
+            with open(loose_ref, "rb") as handle:
+                head = handle.read().decode("utf-8").strip()
+            return branch, None if head.startswith("ref:") else head
+        with open(os.path.join(repo.common_dir, "packed-refs"), "rb") as handle:
+            for line in handle:
+                fields = line.decode("utf-8").split()
+                if fields[-1:] == [refname]:
+                    commit = fields[0]
+                    break
+    except EnvironmentError:
+        pass
+    return branch, commit
+
+
+def _write_json(path, data):
+    """Write `data` to the JSON file `path`, replacing it atomically.
+
+    The data is first written to a temporary file of its own in the same
+    directory, so that concurrent writers don't trip over each other.
+    Write failures are ignored, as the files written like this are only
+    caches.
+    """
+    directory, name = os.path.split(path)
+    try:
+        handle, temp_path = tempfile.mkstemp(
+            prefix="." + name + ".", suffix=".tmp", dir=directory)
+    except EnvironmentError:
+        return
+    try:
+        with io.open(handle, "w", encoding="utf-8") as temp_file:
+            temp_file.write(six.text_type(json.dumps(data)))
+        _replace_file(temp_path, path)
+    except EnvironmentError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+
+def _replace_file(src, dst):
+    # os.replace is atomic and overwrites on every platform, but is
+    # Python 3 only; on POSIX os.rename does the same.
+    getattr(os, "replace", os.rename)(src, dst)
+
+
+def _version_key(version):
+    return tuple(int(part) for part in version.split("."))
+
+
+@attr.s
+class StatusReport(object):
+    """What the checks found out about a repo."""
+
+    repo = attr.ib()
+    head = attr.ib(default=None)
+    branch = attr.ib(default=None)
+    dirty = attr.ib(default=None)
+    gitflow = attr.ib(default=None)
+    version = attr.ib(default=None)
+    tag = attr.ib(default=None)
+    tag_commit = attr.ib(default=None)
+    tag_on_master = attr.ib(default=None)
+    error = attr.ib(default=None)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def as_dict(self):
+        result = attr.asdict(self)
+        result[u"ok"] = self.ok
+        result[u"error"] = _error_dict(self.error)
+        return result
+
+
+def _error_dict(error):
+    if error is None:
+        return None
+    return {u"code": error.code, u"message": str(error)}
+
+
+def _emit_json(document):
+    click.echo(json.dumps(document, indent=2, sort_keys=True))
+
+
 @attr.s
 class Config(object):
-    repo_dir = attr.ib(default=lambda: os.path.abspath(os.getcwd()))
+    """Where a versionflow repo is, and how to report on it.
+
+    Everything is done relative to `repo_dir`, never the current
+    directory, so that Configs for different repos can be used at once
+    from different threads. A relative `bumpversion_config` is taken to
+    be relative to `repo_dir`.
+    """
+
+    repo_dir = attr.ib(default=attr.Factory(os.getcwd))
     bumpversion_config = attr.ib(default=DEFAULT_BV_FILE)
+    quiet = attr.ib(default=False)
+    # A StatusReport for the checks to fill in, if wanted
+    report = attr.ib(default=None)
+    io_workers = attr.ib(default=IO_WORKERS)
+    # How to finish releases: FINISH_PLUMBING or FINISH_GITFLOW
+    finish = attr.ib(default=FINISH_PLUMBING)
+    # Whether to release in a temporary worktree
+    worktree = attr.ib(default=False)
+
+    def __attrs_post_init__(self):
+        self.repo_dir = os.path.abspath(self.repo_dir)
+        self.bumpversion_config = os.path.join(
+            self.repo_dir, self.bumpversion_config)
+
+    def echo(self, message, err=False):
+        """Report progress, unless this config is quiet."""
+        if not self.quiet:
+            click.echo(message, err=err)
+
+    def record(self, **fields):
+        """Set fields of the StatusReport, if there is one."""
+        if self.report is not None:
+            for name, value in fields.items():
+                setattr(self.report, name, value)
+
+    def status(self):
+        """Run the checks quietly, and return a StatusReport of them."""
+        config = attr.evolve(self, quiet=True, report=StatusReport(self.repo_dir))
+        try:
+            with VersionFlowRepo.create_checked(config, False):
+                pass
+        except Exception as exc:  # pylint:disable=broad-except
+            config.report.error = as_versionflow_error(exc)
+            if config.report.error is None:
+                raise
+        return config.report
 
     @contextmanager
     def get_git_context(self, create):
-        click.echo("Checking if this is a clean git repo...")
+        repo = self.open_repo(create)
         try:
-            with git_context(self.repo_dir) as repo:
-                click.echo("- Confirmed that this is a git repo")
-                if repo.is_dirty():
-                    raise DirtyRepo()
-                else:
-                    click.echo("- git repo is clean")
-                yield repo
-        except git.InvalidGitRepositoryError:
-            if create:
-                with init_git_context(self.repo_dir) as repo:
-                    click.echo("- Initialised this directory as a git repo")
-                    yield repo
-            else:
-                raise NoRepo()
+            yield repo
+        finally:
+            repo.close()
 
-    @contextmanager
-    def get_gitflow_context(self, create):
-        click.echo("Checking if this is a git flow repo...")
-        with gitflow_context() as gflow:
-            if gflow.is_initialized():
-                click.echo("- Confirmed that this is a git flow repo")
-            elif create:
-                click.echo("- Initialising a git flow repo...")
-                gflow.init()
-                click.echo("- Initialised this directory as a git flow repo")
-            else:
-                raise NoGitFlow()
-            yield gflow
+    def open_repo(self, create):
+        """Open the repo, or if `create` is set and there isn't one, make it."""
+        self.echo("Checking if this is a clean git repo...")
+        try:
+            repo = repo_type()(self.repo_dir)
+        except (git.InvalidGitRepositoryError, git.NoSuchPathError):
+            if not create:
+                raise NoRepo()
+            repo = repo_type().init(self.repo_dir)
+            self.echo("- Initialised this directory as a git repo")
+        else:
+            self.echo("- Confirmed that this is a git repo")
+        return repo
 
     def bv_wrapper(self):
-        return BumpVersionWrapper.from_existing(self.bumpversion_config)
+        return BumpVersionWrapper.from_existing(
+            self.bumpversion_config, self.repo_dir, self.io_workers)
+
+    def check_version_files(self, bv_wrap, repo=None):
+        """Check that the current version is in every version file.
 
-    def check_bumpversion(self, create, repo):
-        click.echo("Checking if bumpversion is initialised... ")
+        If `repo` is given, files which haven't changed since they were
+        last checked aren't searched again.
+        """
         try:
-            # Check that the bumpversion config file is in the git repo
-            bv_wrap = self.bv_wrapper()
-            relpath = os.path.relpath(self.bumpversion_config)
-            repo.active_branch.commit.tree / relpath
-        except BumpVersionWrapper.NoBumpversionConfig:
-            if create:
-                bv_wrap = BumpVersionWrapper.initialize(
-                    self.bumpversion_config)
-                click.echo(
-                    "- bumpversion initialised with current version set to "
-                    + bv_wrap.current_version
-                )
-                repo.index.add([self.bumpversion_config])
-                repo.index.commit("Add bumpversion config")
-                return bv_wrap
-            else:
-                raise NoBumpVersion()
-        except KeyError:
-            if create:
-                click.echo("- bumpversion config added to git repo")
-                repo.index.add([self.bumpversion_config])
-                repo.index.commit("Add bumpversion config")
-            else:
-                raise BumpNotInGit()
-        click.echo("- bumpversion configured; version is at " +
-                   bv_wrap.current_version)
-        return bv_wrap
+            bv_wrap.check_placeholders()
+            occurrences = bv_wrap.find_versions(repo)
+        except KeyError as exc:
+            self.echo("Unknown placeholder {%s}" % exc.args[0], err=True)
+            raise VersionNotInFile()
+        except (EnvironmentError, ValueError) as exc:
+            self.echo(str(exc), err=True)
+            raise VersionNotInFile()
+        if occurrences:
+            self.echo(
+                "- current version found in %d version files"
+                % len(set(found.path for found in occurrences.values())))
 
     @staticmethod
-    def get_last_version():
+    def get_last_version(repo_dir=None):
         # Try to get version number from repository
-        return setuptools_scm.get_version(
-            version_scheme=_last_version, local_scheme=lambda v: ""
-        )
-
-    def check_version_tag(self, create, bv_wrapper, gf_wrapper):
-        # Check that there is a version tag, and that it is
-        # correct as per the bumpversion section
-        click.echo("Checking version in repository tags...")
         try:
-            version = self.get_last_version()
-            click.echo("- Last tagged version is " + version)
-            # Check if this version is on the master branch
-            branches = gf_wrapper.repo.git.branch(
-                "--contains", "tags/" + version
-            ).splitlines()
-            branches = [b.lstrip("*").strip() for b in branches]
-            if "master" not in branches:
-                raise VersionTagOnWrongBranch()
-            # Check if the version tags match what we expect
-            if version != bv_wrapper.current_version:
-                raise BadVersionTags()
-        except LookupError:
-            if create:
-                # set base version tags
-                gf_wrapper.tag(bv_wrapper.current_version,
-                               gf_wrapper.repo.heads.master)
-                click.echo("- Base version tags set to " +
-                           bv_wrapper.current_version)
-            else:
-                raise NoVersionTags()
-
-
-def _set_curdir(unused_ctx, _, path):
-    if not path:
-        path = os.path.abspath(os.curdir)
-    else:
-        path = os.path.abspath(path)
-        click.echo("Switching dir to " + path)
-    os.chdir(path)
-    return path
+            with git_context(repo_dir) as repo:
+                return VersionTags.read(repo).nearest().version
+        except (git.InvalidGitRepositoryError, git.NoSuchPathError):
+            raise LookupError("Not a git repo")
 
 
-def _make_abs_path(unused_ctx, _, path):
-    return os.path.abspath(path)
+@attr.s
+class RepoChecks(object):
+    """The checks made of a repo before anything is released from it.
+
+    Each check is a step generator (see run_steps), so that the same
+    checks are run one git command at a time by create_checked and for
+    many repos at once by versionflow_async. What they find is recorded
+    through the config. If `create` is set, whatever is missing is set up
+    instead, using `gf_wrapper`.
+    """
 
+    config = attr.ib()
+    snapshot = attr.ib()
+    create = attr.ib(default=False)
+    gf_wrapper = attr.ib(default=None)
+    # The BumpVersionWrapper, once check_bumpversion has passed
+    bv_wrapper = attr.ib(default=None)
+
+    def stages(self):
+        """Return the checks in order, as (phase name, step generator)s."""
+        return [
+            (u"get_git_context", self.check_clean()),
+            (u"get_gitflow_context", self.check_gitflow()),
+            (u"check_bumpversion", self.check_bumpversion()),
+            (u"check_version_tag", self.check_version_tag()),
+        ]
+
+    def check_clean(self):
+        snapshot = self.snapshot
+        steps = snapshot.read_steps()
+        results = None
+        while True:
+            try:
+                jobs = steps.send(results)
+            except StopIteration:
+                break
+            results = yield jobs
+        self.config.record(
+            head=snapshot.head, branch=snapshot.branch, dirty=snapshot.dirty)
+        if snapshot.dirty:
+            raise DirtyRepo()
+        self.config.echo("- git repo is clean")
+
+    def check_gitflow(self):
+        config = self.config
+        config.echo("Checking if this is a git flow repo...")
+        ((status, output),) = yield [
+            GitCommand((u"config", u"--get-regexp", u"^gitflow\\."))
+        ]
+        # Status 1 means there are no git flow settings at all
+        if status not in (0, 1):
+            raise GitError()
+        names = set(line.split(" ", 1)[0] for line in output.splitlines())
+        initialized = all(setting in names for setting in GITFLOW_SETTINGS)
+        config.record(gitflow=initialized)
+        if initialized:
+            config.echo("- Confirmed that this is a git flow repo")
+        elif self.create:
+            config.echo("- Initialising a git flow repo...")
+            yield [self._init_gitflow]
+            config.record(gitflow=True)
+            config.echo("- Initialised this directory as a git flow repo")
+        else:
+            raise NoGitFlow()
+
+    def _init_gitflow(self):
+        self.gf_wrapper.init()
+        self.snapshot.refresh()
+
+    def check_bumpversion(self):
+        config = self.config
+        config.echo("Checking if bumpversion is initialised... ")
+        try:
+            bv_wrap = config.bv_wrapper()
+        except BumpVersionWrapper.NoBumpversionConfig:
+            if not self.create:
+                raise NoBumpVersion()
+            bv_wrap = BumpVersionWrapper.initialize(
+                config.bumpversion_config, config.repo_dir)
+            config.echo(
+                "- bumpversion initialised with current version set to "
+                + bv_wrap.current_version
+            )
+            config.record(version=bv_wrap.current_version)
+            yield [self._commit_bumpversion]
+            self.bv_wrapper = bv_wrap
+            return
+        # Check that the bumpversion config file is in the git repo
+        if self.snapshot.config_blob is None:
+            if not self.create:
+                raise BumpNotInGit()
+            config.echo("- bumpversion config added to git repo")
+            yield [self._commit_bumpversion]
+        config.echo("- bumpversion configured; version is at " +
+                    bv_wrap.current_version)
+        config.record(version=bv_wrap.current_version)
+        # Reading the version files blocks, so it is a job of its own
+        yield [lambda: config.check_version_files(bv_wrap, self.snapshot.repo)]
+        self.bv_wrapper = bv_wrap
+
+    def _commit_bumpversion(self):
+        repo = self.snapshot.repo
+        repo.git.add("--", self.config.bumpversion_config)
+        repo.index.commit("Add bumpversion config")
+        self.snapshot.refresh()
+
+    def check_version_tag(self):
+        config = self.config
+        snapshot = self.snapshot
+        config.echo("Checking version in repository tags...")
+        found = []
+        try:
+            steps = VersionTags.from_snapshot(snapshot).nearest_steps(u"HEAD", found)
+            results = None
+            while True:
+                try:
+                    jobs = steps.send(results)
+                except StopIteration:
+                    break
+                results = yield jobs
+        except LookupError:
+            if not self.create:
+                raise NoVersionTags()
+            # set base version tags
+            yield [
+                lambda: self.gf_wrapper.tag(
+                    self.bv_wrapper.current_version, self.gf_wrapper.repo.heads.master)
+            ]
+            config.echo("- Base version tags set to " + self.bv_wrapper.current_version)
+            return
+        description = found[0]
+        version = description.version
+        config.echo("- Last tagged version is " + version)
+        # Check if this version is on the master branch
+        tag_commit = snapshot.tags[description.tag]
+        on_master = False
+        if "master" in snapshot.branches:
+            (result,) = yield [ancestor_job(tag_commit, snapshot.branches["master"])]
+            on_master = exited_ok(result)
+        config.record(tag=version, tag_commit=tag_commit, tag_on_master=on_master)
+        if not on_master:
+            raise VersionTagOnWrongBranch()
+        # Check if the version tags match what we expect
+        if version != self.bv_wrapper.current_version:
+            raise BadVersionTags()
+
+
+def get_current_scm_version(target_dir=None, use_cache=True, cache_stats=None):
+    """Describe the current commit of the repo containing `target_dir`.
+
+    Unless `use_cache` is False, the version tag part of the description
+    comes from the DescribeCache in the git dir when it is still valid.
+    The cache's (hits, misses) are counted and appended to `cache_stats`
+    if it is given.
+    """
+    try:
+        description, dirty = describe_scm(target_dir, use_cache, cache_stats)
+    except VersionFlowError as exc:
+        raise LookupError(str(exc))
+    return description.describe(dirty)
 
-def _last_version(version):
-    if str(version.tag) == "0.0":
-        raise LookupError()
-    return version.format_with("{tag}")
 
+def describe_scm(target_dir=None, use_cache=True, cache_stats=None):
+    """Return the nearest TagDescription and whether the repo is dirty.
 
-def get_current_scm_version(target_dir=None):
+    The arguments are as for get_current_scm_version. Raises NoRepo or
+    NoVersionTags if there is nothing to describe.
+    """
     try:
-        old = os.path.abspath(os.getcwd())
-        if target_dir is not None:
-            os.chdir(target_dir)
-        while not os.path.exists(".git"):
-            last_dir = os.getcwd()
-            os.chdir(os.path.pardir)
-            if os.getcwd() == last_dir:
-                break
-        # Try to get version number from repository
-        return setuptools_scm.get_version(
-            version_scheme=_last_version, local_scheme="node-and-date"
-        )
-    finally:
-        os.chdir(old)
+        with trace_phase(u"describe"), git_context(
+                target_dir, search_parent_directories=True) as repo:
+            try:
+                if use_cache:
+                    cache = DescribeCache.load(repo)
+                    try:
+                        description = cache.describe(
+                            repo, count=cache_stats is not None)
+                    finally:
+                        if cache_stats is not None:
+                            cache_stats.append((cache.hits, cache.misses))
+                else:
+                    description = VersionTags.read(repo).nearest()
+            except LookupError:
+                raise NoVersionTags()
+            dirty = bool(
+                repo.git.status("--porcelain", "--untracked-files=no"))
+            return description, dirty
+    except (git.InvalidGitRepositoryError, git.NoSuchPathError):
+        raise NoRepo()
 
 
 def get_current_version(target_module, target_attribute="VERSION"):
@@ -285,46 +1286,176 @@ def get_current_version(target_module, target_attribute="VERSION"):
         return getattr(target_module, target_attribute)
 
 
-@click.version_option(version=get_current_version(None, "VERSION"))
+def _show_version(ctx, _, value):
+    # Resolving the version runs git, so only do it when it is asked for
+    # rather than when this module is imported.
+    if not value or ctx.resilient_parsing:
+        return
+    click.echo(
+        "%(prog)s, version %(version)s"
+        % {
+            "prog": ctx.find_root().info_name,
+            "version": get_current_version(None, "VERSION"),
+        }
+    )
+    ctx.exit()
+
+
 @click.group()
+@click.option(
+    "--version",
+    is_flag=True,
+    expose_value=False,
+    is_eager=True,
+    callback=_show_version,
+    help="Show the version and exit.",
+)
 @click.option(
     "--repo-dir",
     metavar="PATH",
-    is_eager=True,
-    callback=_set_curdir,
     help="""Use the given PATH as the root of the versionflow repo. Defaults to the current directory.""",
     type=click.Path(exists=True, file_okay=False, dir_okay=True),
 )
 @click.option(
     "--config",
-    callback=_make_abs_path,
-    help="Use the given FILE as the versionflow configuration file. Defaults to .versionflow",
+    help="Use the given FILE as the versionflow configuration file, relative to the repo dir. Defaults to .versionflow",
     type=click.Path(
         exists=False, file_okay=True, readable=True, writable=True, dir_okay=False
     ),
     default=DEFAULT_BV_FILE,
 )
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Show the time taken, git processes run and bytes read by each phase, on stderr.",
+)
+@click.option(
+    "--trace",
+    metavar="FILE",
+    envvar="VERSIONFLOW_TRACE",
+    help="Write the phases to FILE in the Chrome trace event format.",
+    type=click.Path(dir_okay=False, writable=True),
+)
+@click.option(
+    "--io-workers",
+    default=IO_WORKERS,
+    type=click.IntRange(1, None),
+    help="Number of version files to rewrite at once.",
+)
+@click.option(
+    "--finish",
+    type=click.Choice([FINISH_PLUMBING, FINISH_GITFLOW]),
+    default=FINISH_PLUMBING,
+    help="Finish releases with git plumbing, without checking out master, or with git flow.",
+)
+@click.option(
+    "--worktree",
+    is_flag=True,
+    help="Release in a temporary git worktree with just the version files in it.",
+)
 @click.pass_context
-def cli(ctx, repo_dir, config):
+def cli(ctx, repo_dir, config, profile, trace, io_workers, finish, worktree):
+    if worktree and finish == FINISH_GITFLOW:
+        raise click.UsageError("--worktree can't be used with --finish gitflow")
     # Record configuration options
-    ctx.obj = Config(repo_dir=repo_dir, bumpversion_config=config)
+    ctx.obj = Config(
+        repo_dir=repo_dir or os.getcwd(),
+        bumpversion_config=config,
+        io_workers=io_workers,
+        finish=finish,
+        worktree=worktree,
+    )
+    if profile or trace:
+        tracer = Tracer()
+        tracer.install()
+        ctx.call_on_close(lambda: _finish_trace(tracer, profile, trace))
+
+
+def _finish_trace(tracer, profile, trace_file):
+    tracer.uninstall()
+    if profile:
+        for line in tracer.summary():
+            click.echo(line, err=True)
+    if trace_file:
+        with io.open(trace_file, "w", encoding="utf-8") as handle:
+            handle.write(six.text_type(json.dumps(tracer.chrome_trace(), indent=1)))
+
+
+FORMAT_OPTION = click.option(
+    "--format",
+    "output_format",
+    type=click.Choice([OUTPUT_TEXT, OUTPUT_JSON]),
+    default=OUTPUT_TEXT,
+    help="Write the result as text, or as a single JSON document.",
+)
 
 
-def _do_status(config, create):
+def _do_status(config, create, output_format=OUTPUT_TEXT):
+    if output_format == OUTPUT_JSON:
+        report = config.status()
+        _emit_json(report.as_dict())
+        if not report.ok:
+            raise click.exceptions.Exit(1)
+        return
     try:
         with VersionFlowRepo.create_checked(config, create):
             pass
-    except VersionFlowError as exc:
-        click.echo(str(exc), err=True)
+    except Exception as exc:  # pylint:disable=broad-except
+        error = as_versionflow_error(exc)
+        if error is None:
+            raise
+        click.echo(str(error), err=True)
         raise click.Abort()
 
 
-@cli.command()
-@click.pass_context
-def describe(config):
-    """Give the source control description of the current version.
-    """
-    click.echo(get_current_scm_version())
+@cli.command()
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Work out the version from the repo, not from the cache kept in the .git directory.",
+)
+@click.option(
+    "--cache-stats",
+    is_flag=True,
+    help="Count how often the cache is used, and show the counts on stderr.",
+)
+@FORMAT_OPTION
+@click.pass_obj
+def describe(config, no_cache, cache_stats, output_format):
+    """Give the source control description of the current version.
+    """
+    stats = [] if cache_stats else None
+    try:
+        if output_format == OUTPUT_JSON:
+            _describe_json(config, not no_cache, stats)
+        else:
+            click.echo(
+                get_current_scm_version(
+                    config.repo_dir, use_cache=not no_cache, cache_stats=stats)
+            )
+    finally:
+        for hits, misses in stats or []:
+            click.echo(
+                "describe cache: %d hits, %d misses" % (hits, misses), err=True)
+
+
+def _describe_json(config, use_cache, stats):
+    try:
+        description, dirty = describe_scm(config.repo_dir, use_cache, stats)
+    except VersionFlowError as exc:
+        _emit_json({u"ok": False, u"error": _error_dict(exc)})
+        raise click.exceptions.Exit(1)
+    _emit_json(
+        {
+            u"ok": True,
+            u"error": None,
+            u"description": description.describe(dirty),
+            u"tag": description.version,
+            u"commit": description.commit,
+            u"distance": description.distance,
+            u"dirty": dirty,
+        }
+    )
 
 
 @cli.command()
@@ -335,63 +1466,371 @@ def init(config):
 
 
 @cli.command()
+@FORMAT_OPTION
+@click.option(
+    "--all-under",
+    metavar="DIR",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+    help="Check every git repo under DIR at once, instead of the repo dir. Needs Python 3.",
+)
+@click.option(
+    "--concurrency",
+    default=16,
+    type=click.IntRange(1, None),
+    help="With --all-under, the most git processes to run at once.",
+)
 @click.pass_obj
-def check(config):
+def check(config, output_format, all_under, concurrency):
     """Check if the repo state of this package is OK."""
-    _do_status(config, False)
+    if all_under:
+        _check_all_under(config, all_under, concurrency, output_format)
+    else:
+        _do_status(config, False, output_format)
+
+
+def _check_all_under(config, directory, concurrency, output_format):
+    if six.PY2:
+        raise click.UsageError("--all-under needs Python 3")
+    import versionflow_async  # pylint:disable=import-outside-toplevel
+
+    results = versionflow_async.check_all(
+        versionflow_async.find_repos(directory),
+        os.path.relpath(config.bumpversion_config, config.repo_dir),
+        concurrency,
+    )
+    if output_format == OUTPUT_JSON:
+        _emit_json([report.as_dict() for report, _ in results])
+    else:
+        click.echo(u"\t".join(BATCH_FIELDS))
+        for report, seconds in results:
+            click.echo(BatchResult.from_report(report, seconds).as_row())
+    if not all(report.ok for report, _ in results):
+        raise click.exceptions.Exit(1)
 
 
 @cli.command()
 @click.pass_obj
-@click.argument("filename", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.argument("filename", type=click.Path(file_okay=True, dir_okay=False))
 def add(config, filename):
     """Add a file containing a version number to be updated by versionflow.
 
     This options records that the given file contains a version number. After
     this file has been "add"ed to versionflow, the version number in it will be
     automatically updated any time versionflow changes the version number for
-    this repository.
+    this repository. FILENAME is relative to the repo dir.
     """
+    if not os.path.isfile(os.path.join(config.repo_dir, filename)):
+        raise click.BadParameter(
+            "File %s does not exist." % click.format_filename(filename),
+            param_hint="filename",
+        )
     _add_file(config, filename)
 
 
 def _add_file(config, filename):
-    filename = os.path.relpath(filename, config.repo_dir)
+    filename = os.path.relpath(
+        os.path.join(config.repo_dir, filename), config.repo_dir)
     bv_wrapper = config.bv_wrapper()
     bv_wrapper.add_file(filename)
 
 
+@cli.command()
+@click.pass_obj
+@click.argument("action", type=click.Choice(BATCH_ACTIONS))
+@click.argument("repos", nargs=-1)
+@click.option(
+    "--manifest",
+    type=click.File("r"),
+    help="Also run on the repos listed in FILE, one path or glob pattern per line.",
+)
+@click.option(
+    "--workers",
+    default=4,
+    type=click.IntRange(1, None),
+    help="Number of repos to work on at once.",
+)
+def batch(config, action, repos, manifest, workers):
+    """Run check, patch, minor or major on many repos.
+
+    REPOS are paths or glob patterns. The result for each repo is written
+    as a tab-separated table with a header line; the exit status is 1 if
+    any of the repos failed.
+    """
+    patterns = list(repos)
+    if manifest is not None:
+        patterns.extend(_read_manifest(manifest))
+    results = run_batch(config, action, _expand_repos(patterns), workers)
+    click.echo(u"\t".join(BATCH_FIELDS))
+    for result in results:
+        click.echo(result.as_row())
+    if any(not result.ok for result in results):
+        raise click.exceptions.Exit(1)
+
+
+def _read_manifest(manifest):
+    for line in manifest:
+        line = line.strip()
+        if line and not line.startswith(u"#"):
+            yield line
+
+
+def _expand_repos(patterns):
+    repos = []
+    for pattern in patterns:
+        # A path that matches nothing is kept, so that it gets reported
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            path = os.path.abspath(path)
+            if path not in repos:
+                repos.append(path)
+    return repos
+
+
+def run_batch(config, action, repos, workers=4):
+    """Do `action` on each of `repos` using a pool of `workers` threads.
+
+    Each repo uses the same config file path, relative to its root, as
+    `config` does. Returns a list of BatchResults in the order of `repos`.
+    """
+    config_file = os.path.relpath(config.bumpversion_config, config.repo_dir)
+    configs = [
+        Config(
+            repo_dir=repo,
+            bumpversion_config=os.path.join(repo, config_file),
+            quiet=True,
+            io_workers=config.io_workers,
+            finish=config.finish,
+            worktree=config.worktree,
+        )
+        for repo in repos
+    ]
+    pool = ThreadPool(min(workers, max(len(configs), 1)))
+    try:
+        return list(
+            pool.imap(lambda repo_config: BatchResult.run(repo_config, action), configs)
+        )
+    finally:
+        pool.close()
+        pool.join()
+
+
+@attr.s
+class BatchResult(object):
+    repo = attr.ib()
+    action = attr.ib()
+    ok = attr.ib()
+    version = attr.ib(default=None)
+    seconds = attr.ib(default=0.0)
+    error = attr.ib(default=None)
+
+    @classmethod
+    def run(cls, config, action):
+        start = timeit.default_timer()
+        vf_repo = VersionFlowRepo(config)
+        try:
+            if action == BATCH_CHECK:
+                report = vf_repo.check()
+                return cls.from_report(report, timeit.default_timer() - start)
+            else:
+                version = vf_repo.release(action).new_version
+        except Exception as exc:  # pylint:disable=broad-except
+            # One bad repo shouldn't stop the rest of the batch
+            error = as_versionflow_error(exc)
+            return cls(
+                config.repo_dir,
+                action,
+                False,
+                seconds=timeit.default_timer() - start,
+                error=type(exc).__name__ if error is None else error.code,
+            )
+        return cls(
+            config.repo_dir,
+            action,
+            True,
+            version,
+            timeit.default_timer() - start,
+        )
+
+    @classmethod
+    def from_report(cls, report, seconds):
+        return cls(
+            report.repo,
+            BATCH_CHECK,
+            report.ok,
+            report.version if report.ok else None,
+            seconds,
+            None if report.ok else report.error.code,
+        )
+
+    def as_row(self):
+        return u"\t".join(
+            [
+                self.repo,
+                self.action,
+                u"ok" if self.ok else u"error",
+                self.version or u"-",
+                u"%.3f" % self.seconds,
+                self.error or u"-",
+            ]
+        )
+
+
 @attr.s
 class VersionFlowRepo(object):
+    """A versionflow repo.
+
+    For use as a library, e.g.
+
+        vf_repo = VersionFlowRepo.open("path/to/repo")
+        if vf_repo.check().ok:
+            vf_repo.release(BV_MINOR)
+
+    The gitflow and bumpversion wrappers are only set inside
+    create_checked.
+    """
+
     config = attr.ib()
-    gf_wrapper = attr.ib()
-    bv_wrapper = attr.ib()
+    gf_wrapper = attr.ib(default=None)
+    bv_wrapper = attr.ib(default=None)
+    # Whether the wrappers are for a temporary worktree
+    in_worktree = attr.ib(default=False)
+
+    @classmethod
+    def open(cls, path, bumpversion_config=DEFAULT_BV_FILE, quiet=True):
+        """Return a VersionFlowRepo for the repo at `path`.
+
+        Nothing is checked until check or release is called.
+        """
+        return cls(
+            Config(repo_dir=path, bumpversion_config=bumpversion_config, quiet=quiet)
+        )
+
+    def check(self):
+        """Return a StatusReport of the checks on this repo."""
+        return self.config.status()
+
+    def release(self, part):
+        """Release a new version with the given part bumped.
+
+        Returns the Versions, or raises a VersionFlowError if the repo
+        failed its checks or the release failed.
+        """
+        with VersionFlowProcessor.from_config(
+                self.config, part, GITFLOW_RELEASE) as proc:
+            return proc.process()
 
     @classmethod
     @contextmanager
     def create_checked(cls, config=None, create=False):
         if config is None:
             config = Config()
-        # Check this is a clean git repo
-        with config.get_git_context(create) as repo:
-            # Check if git flow is initialised
-            with config.get_gitflow_context(create) as gf_wrapper:
-                # Check that there is a bumpversion section
-                bv_wrapper = config.check_bumpversion(create, repo)
-                # Check that there is a version tag, and that it is
-                # correct as per the bumpversion section
-                config.check_version_tag(create, bv_wrapper, gf_wrapper)
-                yield cls(config, gf_wrapper, bv_wrapper)
-
-    def process_action(self, versions, part):
+        with config.get_git_context(create) as repo, gitflow_context(
+                repo.working_dir) as gf_wrapper:
+            checks = RepoChecks(
+                config,
+                RepoSnapshot.for_repo(repo, config.bumpversion_config),
+                create,
+                gf_wrapper,
+            )
+            run_git = git_runner(repo)
+            for phase, steps in checks.stages():
+                with trace_phase(phase):
+                    run_steps(steps, run_git)
+            yield cls(config, gf_wrapper, checks.bv_wrapper)
+
+    def process_action(self, versions):
+        if self.config.worktree:
+            self.process_in_worktree(versions)
+            return
+        try:
+            with trace_phase(u"gitflow_start"):
+                self.gitflow_start(versions)
+            with trace_phase(u"bump_and_commit"):
+                self.bv_wrapper.bump_and_commit(versions, self.gf_wrapper.repo)
+            with trace_phase(u"gitflow_end"):
+                self.gitflow_end(versions)
+            self.config.echo("New version is %s" % versions.new_version)
+        except git.GitCommandError as exc:
+            self._git_failure("Failed to do the release", exc)
+
+    def process_in_worktree(self, versions):
+        """Release in a temporary worktree, leaving the repo's own alone.
+
+        Only the bumpversion config and version files are checked out in
+        the worktree. Afterwards, if the repo's own working tree is on a
+        branch which the release moved, it is brought up to date, which
+        only changes those files.
+        """
+        repo = self.gf_wrapper.repo
+        develop = self.gf_wrapper.develop_name()
+        branch, before = read_head(repo)
         try:
-            self.gitflow_start(versions)
-            self.bv_wrapper.bump_and_commit(part)
-            self.gitflow_end(versions)
-            click.echo("New version is %s" % versions.new_version)
+            with trace_phase(u"worktree_add"):
+                worktree = add_worktree(repo, develop)
+            try:
+                with trace_phase(u"worktree_checkout"):
+                    bv_wrapper = self._worktree_bv_wrapper(
+                        repo, worktree, develop, branch == develop)
+                if bv_wrapper.current_version != versions.current_version:
+                    raise BadVersionTags()
+                with worktree_gitflow_context(worktree) as gf_wrapper:
+                    attr.evolve(
+                        self,
+                        config=attr.evolve(self.config, worktree=False),
+                        gf_wrapper=gf_wrapper,
+                        bv_wrapper=bv_wrapper,
+                        in_worktree=True,
+                    ).process_action(versions)
+            except _FinishInCheckout:
+                finish_in_checkout = True
+            else:
+                finish_in_checkout = False
+            finally:
+                with trace_phase(u"worktree_remove"):
+                    remove_worktree(repo, worktree)
+            if finish_in_checkout:
+                # Nothing but the release branch has been changed yet
+                self.config.echo(
+                    "- Can't merge the release with plumbing; "
+                    "using git flow in the repo's own working tree")
+                with trace_phase(u"gitflow_end"):
+                    self.gitflow_finish(versions)
+                self.config.echo("New version is %s" % versions.new_version)
+                return
+            after = read_head(repo)[1]
+            if branch is not None and after != before:
+                with trace_phase(u"update_checkout"):
+                    repo.git.read_tree("-m", "-u", before, after)
         except git.GitCommandError as exc:
             self._git_failure("Failed to do the release", exc)
 
+    def _worktree_bv_wrapper(self, repo, worktree, develop, on_develop):
+        """Check out the version files in the worktree, and return a
+        BumpVersionWrapper for them.
+
+        If the repo's own working tree is on develop, the config and files
+        are the ones that were checked. Otherwise the config is read
+        from develop in the worktree first, to find out what the files
+        are there.
+        """
+        root = repo.working_tree_dir
+        config_file = os.path.relpath(self.bv_wrapper.config_file, root)
+        if on_develop:
+            bv_wrapper = self.bv_wrapper.moved_to(worktree)
+        else:
+            checkout_files(repo, worktree, develop, [config_file])
+            bv_wrapper = BumpVersionWrapper.from_existing(
+                os.path.join(worktree, config_file), worktree, self.bv_wrapper.workers)
+        checkout_files(
+            repo,
+            worktree,
+            develop,
+            [config_file] + [
+                os.path.relpath(version_file.path, worktree)
+                for version_file in bv_wrapper.version_files()
+            ],
+        )
+        return bv_wrapper
+
     @staticmethod
     def _git_failure(message, exc):
         click.echo(message, err=True)
@@ -417,6 +1856,38 @@ class VersionFlowRepo(object):
             raise AlreadyReleasing()
 
     def gitflow_end(self, versions):
+        if self.config.finish == FINISH_PLUMBING:
+            finish = ReleaseFinish.from_gitflow(
+                self.gf_wrapper, versions.new_version, checkout=not self.in_worktree)
+            # The same check git flow does first, that none of the
+            # branches is behind its remote tracking branch
+            for branch in [
+                finish.release_branch,
+                finish.develop_branch,
+                finish.master_branch,
+            ]:
+                self.must_be_uptodate(branch)
+            if finish.run():
+                return
+            if self.in_worktree:
+                # git flow would check out develop in the worktree, which
+                # fails if the repo's own working tree is on it too
+                raise _FinishInCheckout()
+            self.config.echo("- Can't merge the release with plumbing; using git flow")
+        self.gitflow_finish(versions)
+
+    def must_be_uptodate(self, branch):
+        try:
+            self.gf_wrapper.must_be_uptodate(branch, False)
+        except SystemExit as exc:
+            # git flow exits with a message if the branches have diverged
+            self.config.echo(str(exc.code), err=True)
+            raise BranchNotUpToDate()
+        except gitflow.exceptions.GitflowError as exc:
+            self.config.echo(str(exc), err=True)
+            raise GitFlowError()
+
+    def gitflow_finish(self, versions):
         self.gf_wrapper.finish(
             gitflow.branches.ReleaseBranchManager.identifier,
             versions.new_version,
@@ -428,12 +1899,290 @@ class VersionFlowRepo(object):
         )
 
 
+class _FinishInCheckout(Exception):
+    """The release has to be finished in the repo's own working tree."""
+
+
+@attr.s
+class ReleaseFinish(object):
+    """Finishes a git flow release without checking out master.
+
+    git flow merges the release branch into master, tags it and merges
+    the tag into develop, checking out master and then develop to do
+    so. This makes the same merge commits with `git merge-tree` and
+    `git commit-tree`, and moves the branches and creates the tag in one
+    `git update-ref` transaction, so the working tree is only touched if
+    develop ends up different from the release branch.
+    """
+
+    repo = attr.ib()
+    release_branch = attr.ib()
+    master_branch = attr.ib()
+    develop_branch = attr.ib()
+    tag_name = attr.ib()
+    tag_message = attr.ib()
+    merge_message = attr.ib()
+    # Whether to move HEAD and the working tree on to develop afterwards
+    checkout = attr.ib(default=True)
+
+    @classmethod
+    def from_gitflow(cls, gf_wrapper, version, checkout=True):
+        return cls(
+            gf_wrapper.repo,
+            gf_wrapper.get("gitflow.prefix.release") + version,
+            gf_wrapper.master_name(),
+            gf_wrapper.develop_name(),
+            gf_wrapper.get("gitflow.prefix.versiontag") + version,
+            version,
+            "Finished %s %s."
+            % (gitflow.branches.ReleaseBranchManager.identifier, version),
+            checkout,
+        )
+
+    def run(self):
+        """Finish the release, and return True.
+
+        Returns False, having changed nothing, if the merges can't be
+        done this way: if they conflict, or if git is too old to have
+        `git merge-tree --write-tree`.
+        """
+        release, master, develop, release_tree = self.repo.git.rev_parse(
+            "refs/heads/" + self.release_branch,
+            "refs/heads/" + self.master_branch,
+            "refs/heads/" + self.develop_branch,
+            "refs/heads/%s^{tree}" % self.release_branch,
+        ).split()
+        trees = {release: release_tree}
+        new_master = self._merge(master, release, trees)
+        if new_master is None:
+            return False
+        new_develop = self._merge(develop, new_master, trees)
+        if new_develop is None:
+            return False
+        tag = self._tag(new_master)
+        # HEAD is on the release branch, and is left on develop. The
+        # working tree is brought up to date before any ref is moved, so
+        # that if that fails the repo is left as it was.
+        checkout = self.checkout and trees.get(new_develop) != release_tree
+        if checkout:
+            self.repo.git.read_tree("-m", "-u", release, new_develop)
+        try:
+            git_input(
+                self.repo,
+                "".join(
+                    [
+                        "update refs/heads/%s %s %s\n"
+                        % (self.master_branch, new_master, master),
+                        "update refs/heads/%s %s %s\n"
+                        % (self.develop_branch, new_develop, develop),
+                        "create refs/tags/%s %s\n" % (self.tag_name, tag),
+                        "delete refs/heads/%s %s\n" % (self.release_branch, release),
+                    ]
+                ),
+                "update-ref",
+                "-m",
+                self.merge_message,
+                "--stdin",
+            )
+        except git.GitCommandError:
+            if checkout:
+                self.repo.git.read_tree("-m", "-u", new_develop, release)
+            raise
+        if self.checkout:
+            self.repo.git.symbolic_ref(
+                "HEAD", "refs/heads/" + self.develop_branch, m=self.merge_message)
+        return True
+
+    def _merge(self, ours, theirs, trees):
+        """Merge `theirs` into `ours`, and return the resulting commit.
+
+        As git flow does, this does nothing if `theirs` is already merged,
+        fast forwards if it is a single commit ahead, and otherwise makes
+        a merge commit. `trees` maps commits to their trees, and has the
+        merge commit added to it. Returns None if the merge conflicts.
+        """
+        behind, ahead = self.repo.git.rev_list(
+            "--left-right", "--count", "%s...%s" % (ours, theirs)).split()
+        if ahead == "0":
+            return ours
+        if ahead == "1" and behind == "0":
+            return theirs
+        if behind == "0" and theirs in trees:
+            tree = trees[theirs]
+        else:
+            tree = self._merge_tree(ours, theirs)
+            if tree is None:
+                return None
+        commit = self._commit(tree, ours, theirs)
+        trees[commit] = tree
+        return commit
+
+    def _merge_tree(self, ours, theirs):
+        try:
+            output = self.repo.git.merge_tree("--write-tree", ours, theirs)
+        except git.GitCommandError:
+            return None
+        return output.split()[0]
+
+    def _commit(self, tree, *parents):
+        args = [tree]
+        for parent in parents:
+            args.extend(["-p", parent])
+        return self.repo.git.commit_tree(*args, m=self.merge_message)
+
+    def _tag(self, commit):
+        ident = self.repo.git.var("GIT_COMMITTER_IDENT")
+        return git_input(
+            self.repo,
+            "object %s\ntype commit\ntag %s\ntagger %s\n\n%s\n"
+            % (commit, self.tag_name, ident, self.tag_message),
+            "mktag",
+        ).strip()
+
+
+def add_worktree(repo, commit):
+    """Add a temporary worktree at `commit`, with no files in it yet.
+
+    The worktree's index has every file in it, but the files are only
+    written out by checkout_files, so that adding it costs next to
+    nothing however big the repo is. Its HEAD is detached. Returns the
+    path of the worktree.
+    """
+    path = tempfile.mkdtemp(prefix="versionflow-")
+    try:
+        repo.git.worktree("add", "--no-checkout", "--detach", path, commit)
+    except git.GitCommandError:
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+    try:
+        repo.GitCommandWrapperType(path).read_tree("HEAD")
+    except git.GitCommandError:
+        remove_worktree(repo, path)
+        raise
+    return path
+
+
+def checkout_files(repo, worktree, commit, paths):
+    """Write `paths` at `commit` into a worktree made by add_worktree.
+
+    `paths` are relative to the root. In a partial clone, any of their
+    blobs which are missing are fetched first, all at once.
+    """
+    fetch_missing_blobs(repo, commit, paths)
+    repo.GitCommandWrapperType(worktree).checkout_index(
+        "--force", "--", *[path.replace(os.sep, "/") for path in paths])
+
+
+def promisor_remote(repo):
+    """Return the remote a partial clone gets missing objects from.
+
+    Returns None if the repo is not a partial clone.
+    """
+    reader = repo.config_reader()
+    for remote in repo.remotes:
+        section = 'remote "%s"' % remote.name
+        if reader.has_option(section, "promisor") and reader.get_value(
+                section, "promisor"):
+            return remote.name
+    if reader.has_option("extensions", "partialclone"):
+        return reader.get_value("extensions", "partialclone")
+    return None
+
+
+def fetch_missing_blobs(repo, commit, paths):
+    """Fetch the blobs of `paths` at `commit` which a partial clone lacks.
+
+    git would fetch each of them on its own as it first needed it; this
+    fetches them all at once. `paths` are relative to the root. Returns
+    the ids of the blobs fetched, and does nothing if the repo is not a
+    partial clone.
+    """
+    remote = promisor_remote(repo)
+    if remote is None or not paths:
+        return []
+    entries = [
+        line.split("\t", 1)[0]
+        for line in repo.git.ls_tree(
+            commit,
+            "--",
+            *[path.replace(os.sep, "/") for path in paths],
+            env={"GIT_LITERAL_PATHSPECS": "1"}
+        ).splitlines()
+        if line.split()[1] == "blob"
+    ]
+    if not entries:
+        return []
+    # Listing a tree of just these blobs with --missing=print shows which
+    # are missing without fetching them. mktree --missing doesn't need
+    # them, and only allows names without slashes.
+    tree = git_input(
+        repo,
+        "".join("%s\t%d\n" % (entry, number) for number, entry in enumerate(entries)),
+        "mktree",
+        "--missing",
+    ).strip()
+    missing = [
+        line[1:]
+        for line in repo.git.rev_list("--objects", "--missing=print", tree).splitlines()
+        if line.startswith("?")
+    ]
+    if missing:
+        # The same fetch git does for a missing object, for all of them
+        git_input(
+            repo,
+            "".join(blob + "\n" for blob in missing),
+            "-c",
+            "fetch.negotiationAlgorithm=noop",
+            "fetch",
+            remote,
+            "--no-tags",
+            "--no-write-fetch-head",
+            "--recurse-submodules=no",
+            "--filter=blob:none",
+            "--stdin",
+        )
+    return missing
+
+
+class WorktreeRepo(git.Repo):
+    """A git.Repo for a linked worktree.
+
+    GitPython reads the repo config from the worktree's own git dir; git
+    reads it from the common dir, which is where the git flow settings
+    are.
+    """
+
+    def _get_config_path(self, config_level):
+        if config_level == "repository":
+            return os.path.normpath(os.path.join(self.common_dir, "config"))
+        return super(WorktreeRepo, self)._get_config_path(config_level)
+
+
+@contextmanager
+def worktree_gitflow_context(path):
+    """As gitflow_context, for a worktree made by add_worktree."""
+    gflow = open_gitflow(path, WorktreeRepo)
+    try:
+        yield gflow
+    finally:
+        gflow.repo.close()
+
+
+def remove_worktree(repo, path):
+    """Remove a worktree made by add_worktree."""
+    # The files left out of it look deleted, so it has to be forced
+    repo.git.worktree("remove", "--force", path)
+
+
 def _do_version(config, level):
     try:
         with VersionFlowProcessor.from_config(config, level, GITFLOW_RELEASE) as proc:
             proc.process()
-    except VersionFlowError as exc:
-        click.echo(str(exc), err=True)
+    except Exception as exc:  # pylint:disable=broad-except
+        error = as_versionflow_error(exc)
+        if error is None:
+            raise
+        click.echo(str(error), err=True)
         raise click.Abort()
 
 
@@ -476,7 +2225,62 @@ class VersionFlowProcessor(object):
     def process(self):
         versions = Versions.from_bumpversion(
             self.vf_repo.bv_wrapper, self.part)
-        self.vf_repo.process_action(versions, self.part)
+        self.vf_repo.process_action(versions)
+        return versions
+
+
+@attr.s
+class ConfigCache(object):
+    """Parsed bumpversion config files, shared by everything in a process.
+
+    A file is only parsed again once its inode, mtime or size changes.
+    The parsed configs are shared, so must not be changed: change a copy,
+    and `put` it back once it has been written to the file.
+    """
+
+    entries = attr.ib(default=attr.Factory(dict))
+    lock = attr.ib(default=attr.Factory(threading.Lock), repr=False)
+    hits = attr.ib(default=0)
+    misses = attr.ib(default=0)
+
+    def get(self, path):
+        """Return the parsed config in `path`, or None if there is no file."""
+        path = os.path.abspath(path)
+        key = _file_key(path)
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        parsed_config = configparser.ConfigParser()
+        parsed_config.read(path)
+        with self.lock:
+            self.entries[path] = (key, parsed_config)
+        return parsed_config
+
+    def put(self, path, parsed_config):
+        """Record that `parsed_config` has just been written to `path`."""
+        path = os.path.abspath(path)
+        key = _file_key(path)
+        with self.lock:
+            if key is None:
+                self.entries.pop(path, None)
+            else:
+                self.entries[path] = (key, parsed_config)
+
+
+def _file_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime, stat.st_size)
+
+
+CONFIG_CACHE = ConfigCache()
 
 
 @attr.s
@@ -484,27 +2288,30 @@ class BumpVersionWrapper(object):
     config_file = attr.ib()
     parsed_config = attr.ib()
     current_version = attr.ib()
+    # Directory that the paths of version files are relative to
+    root = attr.ib(default=None)
+    # Number of threads to rewrite version files with
+    workers = attr.ib(default=IO_WORKERS)
+    # Where the current version is in the version files, once found
+    occurrences = attr.ib(default=None)
 
     class NoBumpversionConfig(RuntimeError):
         pass
 
     @classmethod
-    def from_existing(cls, bumpversion_config):
-        if not os.path.exists(bumpversion_config):
-            raise cls.NoBumpversionConfig()
-        parsed_config = configparser.ConfigParser()
-        parsed_config.read(bumpversion_config)
-        if not parsed_config.has_section(BV_SECTION):
+    def from_existing(cls, bumpversion_config, root=None, workers=IO_WORKERS):
+        parsed_config = CONFIG_CACHE.get(bumpversion_config)
+        if parsed_config is None or not parsed_config.has_section(BV_SECTION):
             raise cls.NoBumpversionConfig()
         try:
             current_version = parsed_config.get(
                 BV_SECTION, BV_CURRENT_VER_OPTION)
         except (configparser.NoSectionError, configparser.NoOptionError):
             raise cls.NoBumpversionConfig()
-        return cls(bumpversion_config, parsed_config, current_version)
+        return cls(bumpversion_config, parsed_config, current_version, root, workers)
 
     @classmethod
-    def initialize(cls, bumpversion_config):
+    def initialize(cls, bumpversion_config, root=None):
         config_parser = configparser.ConfigParser()
         if os.path.exists(bumpversion_config):
             config_parser.read(bumpversion_config)
@@ -512,44 +2319,828 @@ class BumpVersionWrapper(object):
             config_parser.add_section(BV_SECTION)
         if not config_parser.has_option(BV_SECTION, BV_CURRENT_VER_OPTION):
             config_parser.set(BV_SECTION, BV_CURRENT_VER_OPTION, START_VERSION)
-        config_parser.write(open(bumpversion_config, "w"))
-        return cls(bumpversion_config, config_parser, START_VERSION)
+        with open(bumpversion_config, "w") as handle:
+            config_parser.write(handle)
+        CONFIG_CACHE.put(bumpversion_config, config_parser)
+        return cls(bumpversion_config, config_parser, START_VERSION, root)
+
+    def _get(self, section, option, default=None):
+        # Read options raw: parse regexes and format strings are not
+        # meant to be interpolated.
+        if not self.parsed_config.has_option(section, option):
+            return default
+        return self.parsed_config.get(section, option, raw=True)
+
+    def _part_options(self, option):
+        """Map the name of each part which sets `option` to its value."""
+        options = {}
+        for section in self.parsed_config.sections():
+            match = BV_SECTION_PATTERN.match(section)
+            if match and match.group(1) == "part":
+                value = self._get(section, option)
+                if value is not None:
+                    options[match.group(2)] = value
+        return options
+
+    def version_format(self, section=BV_SECTION):
+        """Get the VersionFormat configured in the given section.
+
+        Options missing from a file section are taken from the main
+        bumpversion section.
+        """
+        default = None if section == BV_SECTION else self.version_format()
+        parse = self._get(section, "parse")
+        serialize = self._get(section, "serialize")
+        if default is not None:
+            if parse is None:
+                parse = default.parse
+            if serialize is None:
+                return attr.evolve(default, parse=parse)
+        part_values = self._part_options("values")
+        return VersionFormat(
+            parse or BV_DEFAULT_PARSE,
+            _split_lines(serialize) if serialize else [BV_DEFAULT_SERIALIZE],
+            dict(
+                (label, _split_lines(values)) for label, values in part_values.items()
+            ),
+            self._part_options("first_value"),
+            self._part_options("optional_value"),
+        )
+
+    def version_files(self):
+        """Get the files containing version numbers, as BumpVersionFiles.
+
+        Raises BadBumpVersionConfig if any of them has an empty search.
+        """
+        search = self._get(BV_SECTION, "search", BV_DEFAULT_SEARCH)
+        replace = self._get(BV_SECTION, "replace", BV_DEFAULT_REPLACE)
+        version_files = [
+            BumpVersionFile(
+                self._path(filename), self.version_format(), search, replace)
+            for filename in self._get(BV_SECTION, "files", "").split()
+        ]
+        for section in self.parsed_config.sections():
+            match = BV_SECTION_PATTERN.match(section)
+            if match and match.group(1) == "file":
+                version_files.append(
+                    BumpVersionFile(
+                        self._path(match.group(2)),
+                        self.version_format(section),
+                        self._get(section, "search", search),
+                        self._get(section, "replace", replace),
+                    )
+                )
+        if any(not version_file.search for version_file in version_files):
+            # There would be an occurrence between every character
+            raise BadBumpVersionConfig()
+        return version_files
+
+    def check_placeholders(self):
+        """Format every search, replace and the commit message.
+
+        Raises KeyError for a placeholder which isn't a version, so that
+        it is found before anything is released, not while bumping.
+        """
+        versions = Versions(self.current_version, self.current_version)
+        for version_file in self.version_files():
+            version_file.searches(versions.current_version)
+            version_file.replacement(versions.new_version)
+        self.commit_message(versions)
+
+    def commit_message(self, versions):
+        return self._get(BV_SECTION, "message", BV_DEFAULT_MESSAGE).format(
+            current_version=versions.current_version,
+            new_version=versions.new_version,
+            **time_placeholders()
+        )
+
+    def find_versions(self, repo=None):
+        """Find the current version in all the version files.
+
+        The result is kept, so that the files don't have to be searched
+        again when the version is bumped. If `repo` is given, the
+        OccurrenceIndex in its git dir is used and updated.
+        """
+        if repo is None:
+            self.occurrences = find_versions(
+                self.version_files(), self.current_version, self.workers)
+        else:
+            self.occurrences = OccurrenceIndex.load(repo).find_versions(
+                repo, self.version_files(), self.current_version, self.workers)
+        return self.occurrences
+
+    def moved_to(self, root):
+        """Return a copy of this wrapper for the same files under `root`."""
+        old_root = self.root or os.getcwd()
+
+        def move(path):
+            return os.path.join(root, os.path.relpath(path, old_root))
+
+        occurrences = None
+        if self.occurrences is not None:
+            occurrences = dict(
+                ((move(key[0]),) + key[1:], attr.evolve(found, path=move(found.path)))
+                for key, found in self.occurrences.items()
+            )
+        return attr.evolve(
+            self,
+            config_file=move(self.config_file),
+            root=root,
+            occurrences=occurrences,
+        )
 
-    def bump_and_commit(self, part):
+    def _path(self, filename):
+        if self.root is None:
+            return filename
+        return os.path.join(self.root, filename)
+
+    def bump_and_commit(self, versions, repo):
+        """Write the new version to the config and files, and commit them."""
         try:
-            self._run_bumpversion(["--commit", part])
-        except subprocess.CalledProcessError as exc:
-            # Handle bumpversion failures
+            # Write all the new files before changing any of them, so
+            # that a bad file does not leave a half-done bump.
+            pending = prepare_files(
+                self.version_files(), versions, self.workers, self.occurrences)
+            new_config = copy.deepcopy(self.parsed_config)
+            new_config.set(BV_SECTION, BV_CURRENT_VER_OPTION, versions.new_version)
+            with _discard_on_error(pending):
+                pending.append(self._prepare_config(new_config))
+                message = self.commit_message(versions)
+            # If any file can't be replaced, the ones already replaced
+            # are put back from their backups
+            commit_files(pending)
+        except KeyError as exc:
+            # A search, replace or message format has a placeholder which
+            # isn't a version; no file has been changed
+            click.echo("Unknown placeholder {%s}" % exc.args[0], err=True)
+            raise VersionNotInFile()
+        except (EnvironmentError, ValueError) as exc:
+            # Handle version bump failures
             click.echo(
                 "Failed to bump the version number in the release", err=True)
-            click.echo(exc.output, err=True)
+            click.echo(str(exc), err=True)
             raise SetNextBumpVersionError()
+        CONFIG_CACHE.put(self.config_file, new_config)
+        self.parsed_config = new_config
+        self.current_version = versions.new_version
+        repo.git.add("--", *[pending_file.path for pending_file in pending])
+        repo.index.commit(message)
+
+    def _prepare_config(self, new_config):
+        pending = PendingFile.create(self.config_file)
+        with _discard_on_error([pending]):
+            with open(pending.temp_path, "w") as handle:
+                new_config.write(handle)
+        return pending
 
     def get_new_version(self, part):
-        bv_output = self._run_bumpversion(["--list", part, "--dry-run"])
-        new_version = None
-        for line in bv_output.splitlines():
-            if line.startswith(BV_NEW_VER_OPTION + "="):
-                new_version = line.strip().split("=")[-1]
-        # What if we can't find new version?
-        if new_version is None:
+        version_format = self.version_format()
+        try:
+            parts = version_format.parse_version(self.current_version)
+        except ValueError as exc:
+            click.echo(str(exc), err=True)
+            raise GetBumpVersionError()
+        try:
+            return version_format.serialize_version(
+                version_format.bump(parts, part))
+        except (IndexError, KeyError, ValueError):
             click.echo("Failed to get next version number", err=True)
             raise GetNextBumpVersionError()
-        return new_version
-
-    def _run_bumpversion(self, bv_args, **subprocess_kw_args):
-        if six.PY3 and "encoding" not in subprocess_kw_args:
-            subprocess_kw_args["encoding"] = "utf-8"
-        return subprocess.check_output(
-            [BV_EXEC] + ["--config-file", self.config_file] + bv_args,
-            stderr=subprocess.STDOUT,
-            **subprocess_kw_args
-        )
 
     def add_file(self, filename):
         new_section = ":".join([BV_SECTION, "file", filename])
-        self.parsed_config.add_section(new_section)
-        self.parsed_config.write(open(self.config_file, "w"))
+        new_config = copy.deepcopy(self.parsed_config)
+        new_config.add_section(new_section)
+        with open(self.config_file, "w") as handle:
+            new_config.write(handle)
+        CONFIG_CACHE.put(self.config_file, new_config)
+        self.parsed_config = new_config
+
+
+def time_placeholders():
+    """The times bumpversion lets versions, searches and messages use."""
+    return {
+        "now": datetime.datetime.now(),
+        "utcnow": datetime.datetime.utcnow(),
+    }
+
+
+def _split_lines(value):
+    return [line.strip() for line in value.splitlines() if line.strip()]
+
+
+@attr.s
+class VersionFormat(object):
+    """How version numbers are parsed from and serialised to strings.
+
+    This follows the bumpversion rules: `parse` is a regex with a named
+    group for each part of the version, and `serialize` is a list of
+    format strings, the last of which that can represent all of the
+    significant parts of a version being used to serialise it. Parts are
+    numeric unless they have a list of `values` in `part_values`.
+
+    A part is reset to its first value when a part before it is bumped,
+    and can be left out when serialising while it has its optional
+    value. Both are the first of its `values`, or 0, unless set in
+    `first_values` or (for parts with values) `optional_values`.
+    """
+
+    parse = attr.ib()
+    serialize = attr.ib()
+    part_values = attr.ib(factory=dict)
+    first_values = attr.ib(factory=dict)
+    optional_values = attr.ib(factory=dict)
+
+    def order(self):
+        return [
+            label
+            for _, label, _, _ in string.Formatter().parse(self.serialize[0])
+            if label
+        ]
+
+    def parse_version(self, version_string):
+        match = re.search(self.parse, version_string, re.VERBOSE)
+        if not match:
+            raise ValueError(
+                "Could not parse version '%s' with '%s'" % (version_string, self.parse)
+            )
+        # As in bumpversion, a part which isn't there has its optional value
+        return {
+            label: self._optional_value(label) if value is None else value
+            for label, value in match.groupdict().items()
+        }
+
+    def _first_value(self, label):
+        if label in self.first_values:
+            return self.first_values[label]
+        if label in self.part_values:
+            return self.part_values[label][0]
+        return u"0"
+
+    def _optional_value(self, label):
+        # As in bumpversion, a numeric part is optional at its first value
+        if label in self.part_values:
+            return self.optional_values.get(label, self.part_values[label][0])
+        return self._first_value(label)
+
+    def _next_value(self, label, value):
+        if label in self.part_values:
+            values = self.part_values[label]
+            return values[values.index(value) + 1]
+        prefix, number, suffix = re.match(
+            r"(\D*)(\d+)(.*)", value).groups()
+        return prefix + str(int(number) + 1) + suffix
+
+    def bump(self, parts, part):
+        if part not in parts:
+            raise KeyError(part)
+        new_parts = dict(parts)
+        bumped = False
+        for label in self.order():
+            if label not in parts:
+                continue
+            if label == part:
+                new_parts[label] = self._next_value(label, parts[label])
+                bumped = True
+            elif bumped:
+                new_parts[label] = self._first_value(label)
+        return new_parts
+
+    def serialize_version(self, parts):
+        # Leading optional parts must be shown, as must any part which
+        # does not have its optional value.
+        needed = set()
+        found_required = False
+        for label in self.order():
+            if label not in parts:
+                continue
+            if parts[label] != self._optional_value(label):
+                found_required = True
+                needed.add(label)
+            elif not found_required:
+                needed.add(label)
+        chosen = None
+        for serialize_format in self.serialize:
+            labels = set(
+                label
+                for _, label, _, _ in string.Formatter().parse(serialize_format)
+                if label
+            )
+            if needed <= labels or chosen is None:
+                chosen = serialize_format
+        return chosen.format(**dict(time_placeholders(), **parts))
+
+
+@attr.s
+class BumpVersionFile(object):
+    """A file whose version number is updated by a version bump."""
+
+    path = attr.ib()
+    version_format = attr.ib()
+    search = attr.ib()
+    replace = attr.ib()
+    stream_threshold = attr.ib(default=STREAM_THRESHOLD)
+    chunk_size = attr.ib(default=STREAM_CHUNK_SIZE)
+
+    @property
+    def key(self):
+        """What find_versions keys this file's VersionOccurrences by.
+
+        A file can be listed more than once with different searches and
+        replaces, so the path alone isn't enough.
+        """
+        return (self.path, self.search, self.replace)
+
+    def _reformat(self, version):
+        return self.version_format.serialize_version(
+            self.version_format.parse_version(version))
+
+    def _chunk_size(self, handle):
+        # Read small files whole, and big ones a chunk at a time
+        if os.fstat(handle.fileno()).st_size > self.stream_threshold:
+            return self.chunk_size
+        return None
+
+    def searches(self, current_version):
+        """Return what to search for to find `current_version`, in order."""
+        search_for = self.search.format(
+            current_version=self._reformat(current_version), **time_placeholders())
+        searches = [search_for]
+        if current_version != search_for:
+            # As bumpversion does, fall back to the plain version string.
+            searches.append(current_version)
+        return searches
+
+    def replacement(self, new_version):
+        """Return what to replace the current version with."""
+        return self.replace.format(
+            new_version=self._reformat(new_version), **time_placeholders())
+
+    def find(self, current_version):
+        """Find where `current_version` is in this file.
+
+        Returns VersionOccurrences, or raises ValueError if the version
+        is not there.
+        """
+        with io.open(self.path, "rb") as handle:
+            chunk_size = self._chunk_size(handle)
+            for search in self.searches(current_version):
+                handle.seek(0)
+                found = list(
+                    _find_all(handle, search.encode("utf-8"), chunk_size))
+                if found:
+                    return VersionOccurrences(
+                        self.path, current_version, search.encode("utf-8"), found)
+        raise ValueError(
+            "Did not find '%s' in file %s" % (current_version, self.path))
+
+    def edits(self, versions, occurrences=None):
+        """Return the (offset, old, new) of each change the bump makes.
+
+        The version is replaced where `occurrences` says it is, if they
+        are for the current version, and otherwise the file is searched
+        first.
+        """
+        if occurrences is None or occurrences.version != versions.current_version:
+            occurrences = self.find(versions.current_version)
+        replace_with = self.replacement(versions.new_version).encode("utf-8")
+        return [
+            (offset, occurrences.search, replace_with)
+            for offset in occurrences.offsets()
+        ]
+
+    def prepare(self, versions, occurrences=None):
+        """Write a copy of this file with the new version in it.
+
+        The copy goes in a temporary file next to this one, so returns a
+        PendingFile to move it into place with.
+        """
+        return prepare_file([self], versions, [occurrences])
+
+
+def prepare_file(version_files, versions, occurrences):
+    """Write a copy of a file with the new version in it.
+
+    `version_files` are all for the same path, e.g. when a file is both
+    in `files` and in a section of its own, and `occurrences` are their
+    VersionOccurrences, or None. All their changes are made in one copy.
+    Where the changes of two of them overlap, only the earlier one's is
+    made, as if they had been made one after the other. Returns a
+    PendingFile.
+    """
+    edits = []
+    for version_file, found in zip(version_files, occurrences):
+        edits = _merge_edits(edits, version_file.edits(versions, found))
+    version_file = version_files[0]
+    pending = PendingFile.create(version_file.path)
+    with _discard_on_error([pending]):
+        with io.open(version_file.path, "rb") as src, io.open(
+                pending.temp_path, "wb") as dst:
+            _apply_edits(src, dst, edits, version_file._chunk_size(src))
+    return pending
+
+
+def _merge_edits(edits, more):
+    """Add the edits in `more` to the sorted `edits`, unless they overlap."""
+    edits = list(edits)
+    starts = [offset for offset, _, _ in edits]
+    for edit in more:
+        offset, old, _ = edit
+        index = bisect.bisect(starts, offset)
+        if index and starts[index - 1] + len(edits[index - 1][1]) > offset:
+            continue
+        if index < len(edits) and offset + len(old) > starts[index]:
+            continue
+        starts.insert(index, offset)
+        edits.insert(index, edit)
+    return edits
+
+
+@attr.s
+class VersionOccurrences(object):
+    """Where a version is in a version file.
+
+    `found` is a list of (line, offset) pairs, one for each occurrence
+    of `search`, which is what was searched for to find `version`.
+    Lines count from 1 and offsets are in bytes.
+    """
+
+    path = attr.ib()
+    version = attr.ib()
+    search = attr.ib()
+    found = attr.ib()
+
+    def offsets(self):
+        return [offset for _, offset in self.found]
+
+    def locations(self):
+        """Return the (file, line, offset) of each occurrence."""
+        return [(self.path, line, offset) for line, offset in self.found]
+
+
+@attr.s
+class OccurrenceIndex(object):
+    """Where the current version was last found in each version file.
+
+    This is kept in a file in the git dir. There are entries for each
+    file's path and search format, each keyed by the blob id of the file
+    in the git index, by the size, mtime and inode of the file on disk
+    and by what was searched for in it, so a file is only searched again
+    once any of them has changed. The stat data is needed as well as the
+    blob id because the offsets are into the file on disk, and with
+    core.autocrlf or a clean filter the same blob can be checked out as
+    different bytes. Files which aren't in the git index are always
+    searched. It also counts its hits and misses.
+    """
+
+    path = attr.ib()
+    entries = attr.ib(default=attr.Factory(dict))
+    hits = attr.ib(default=0)
+    misses = attr.ib(default=0)
+
+    # Changed whenever the entries change shape, so old ones are ignored
+    FORMAT = 3
+
+    @classmethod
+    def load(cls, repo):
+        index = cls(os.path.join(repo.git_dir, VERSION_INDEX_FILE))
+        try:
+            with io.open(index.path, encoding="utf-8") as handle:
+                data = json.load(handle)
+            index.hits = data["hits"]
+            index.misses = data["misses"]
+            if data.get("format") == cls.FORMAT:
+                index.entries = data["entries"]
+        except (EnvironmentError, ValueError, KeyError):
+            pass
+        return index
+
+    def find_versions(self, repo, version_files, current_version, workers=IO_WORKERS):
+        """As find_versions, but using and updating this index.
+
+        The git index only matches the files on disk if the repo is
+        clean, so this should only be used once that has been checked.
+        """
+        root = repo.working_tree_dir
+        names = dict(
+            (version_file.path, _tree_path(root, version_file.path))
+            for version_file in version_files
+        )
+        blobs = read_blob_ids(repo, sorted(set(names.values())))
+        occurrences = {}
+        keys = {}
+        to_search = []
+        for version_file in version_files:
+            name = names[version_file.path]
+            key = [
+                blobs.get(name),
+                _stat_key(version_file.path),
+                version_file.searches(current_version),
+            ]
+            keys[version_file.key] = key
+            entry = self.entries.get(name, {}).get(version_file.search)
+            if None not in key[:2] and entry is not None and entry["key"] == key:
+                occurrences[version_file.key] = VersionOccurrences(
+                    version_file.path,
+                    current_version,
+                    entry["search"].encode("utf-8"),
+                    [tuple(found) for found in entry["found"]],
+                )
+            else:
+                to_search.append(version_file)
+        self.hits += len(occurrences)
+        self.misses += len(to_search)
+        occurrences.update(find_versions(to_search, current_version, workers))
+        self.entries = {}
+        for version_file in version_files:
+            found = occurrences[version_file.key]
+            key = keys[version_file.key]
+            if None not in key[:2]:
+                self.entries.setdefault(names[version_file.path], {})[
+                    version_file.search
+                ] = {
+                    "key": key,
+                    "search": found.search.decode("utf-8"),
+                    "found": found.found,
+                }
+        self.save()
+        return occurrences
+
+    def save(self):
+        _write_json(
+            self.path,
+            {
+                "format": self.FORMAT,
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": self.entries,
+            },
+        )
+
+
+def _stat_key(path):
+    """Return the size, mtime and inode of `path`, or None if it's missing."""
+    try:
+        stat = os.stat(path)
+    except EnvironmentError:
+        return None
+    return [stat.st_size, stat.st_mtime, stat.st_ino]
+
+
+def _tree_path(root, path):
+    """Return `path` relative to `root`, with / separators, as git has it."""
+    return os.path.relpath(os.path.join(root, path), root).replace(os.sep, "/")
+
+
+def read_blob_ids(repo, names):
+    """Return the blob ids of the files `names` in the git index.
+
+    `names` are relative to the root of the working tree. Files which are
+    not in the index are left out.
+    """
+    if not names:
+        return {}
+    blobs = {}
+    output = repo.git.ls_files(
+        "--stage", "-z", "--", *names, env={"GIT_LITERAL_PATHSPECS": "1"})
+    for record in output.split("\0"):
+        if not record:
+            continue
+        info, name = record.split("\t", 1)
+        _, blob, stage = info.split()
+        if stage == "0":
+            blobs[name] = blob
+    return blobs
+
+
+def _find_all(handle, search, chunk_size=None):
+    """Yield the (line, offset) of each occurrence of `search` in `handle`.
+
+    As bytes.replace would, this finds the non-overlapping occurrences
+    from the left. The file is read `chunk_size` at a time, or whole if
+    that is None.
+    """
+    # The most that could be the start of an occurrence split across chunks
+    overlap = len(search) - 1
+    # Offset in the file and line number of the start of the buffer
+    base = 0
+    line = 1
+    buffer = b""
+    while True:
+        chunk = handle.read() if chunk_size is None else handle.read(chunk_size)
+        buffer += chunk
+        # Where to search from, and how far newlines have been counted
+        start = counted = 0
+        index = buffer.find(search)
+        while index != -1:
+            line += buffer.count(b"\n", counted, index)
+            counted = index
+            yield line, base + index
+            start = index + len(search)
+            index = buffer.find(search, start)
+        if not chunk or chunk_size is None:
+            return
+        end = max(start, len(buffer) - overlap)
+        line += buffer.count(b"\n", counted, end)
+        base += end
+        buffer = buffer[end:]
+
+
+def _splice(src, dst, offsets, old, new, chunk_size=None):
+    """Copy `src` to `dst`, replacing `old` at each of `offsets` with `new`.
+
+    Raises ValueError if `old` isn't at one of the offsets, e.g. because
+    the file has changed since it was searched.
+    """
+    _apply_edits(src, dst, [(offset, old, new) for offset in offsets], chunk_size)
+
+
+def _apply_edits(src, dst, edits, chunk_size=None):
+    """As _splice, for a sorted list of (offset, old, new) edits."""
+    position = 0
+    for offset, old, new in edits:
+        _copy(src, dst, offset - position, chunk_size)
+        if src.read(len(old)) != old:
+            raise ValueError(
+                "%s has changed since it was checked" % getattr(src, "name", "File"))
+        dst.write(new)
+        position = offset + len(old)
+    _copy(src, dst, None, chunk_size)
+
+
+def _copy(src, dst, size, chunk_size):
+    """Copy `size` bytes, or everything if that is None, from `src` to `dst`."""
+    while size is None or size > 0:
+        if chunk_size is None:
+            want = -1 if size is None else size
+        else:
+            want = chunk_size if size is None else min(size, chunk_size)
+        data = src.read(want)
+        if not data:
+            return
+        dst.write(data)
+        if size is not None:
+            size -= len(data)
+
+
+@attr.s
+class PendingFile(object):
+    """A new version of a file, written to a temporary file beside it.
+
+    If `path` is a symbolic link, the file it links to is the one which
+    is replaced, so the link is kept. Hard links to the file are not
+    kept: the path is given a new file, and the others keep the old one.
+    """
+
+    path = attr.ib()
+    temp_path = attr.ib()
+    # The file which is replaced: `path`, with any symbolic links resolved
+    target = attr.ib()
+    # A link to or copy of the old version, once it has been replaced
+    backup_path = attr.ib(default=None)
+
+    @classmethod
+    def create(cls, path):
+        target = os.path.realpath(path)
+        directory, name = os.path.split(target)
+        handle, temp_path = tempfile.mkstemp(
+            prefix="." + name + ".", suffix=".tmp", dir=directory)
+        os.close(handle)
+        # mkstemp makes the file private, so give it the original's mode
+        shutil.copymode(target, temp_path)
+        return cls(path, temp_path, target)
+
+    def commit(self):
+        """Atomically replace the file with its new version.
+
+        The old version is kept until `finish`, so that `rollback` can
+        put it back.
+        """
+        backup_path = self.temp_path + ".orig"
+        try:
+            os.link(self.target, backup_path)
+        except (AttributeError, OSError):
+            # No hard links on this platform or file system
+            shutil.copy2(self.target, backup_path)
+        self.backup_path = backup_path
+        _replace_file(self.temp_path, self.target)
+
+    def rollback(self):
+        _replace_file(self.backup_path, self.target)
+        self.backup_path = None
+
+    def finish(self):
+        if self.backup_path is not None:
+            os.remove(self.backup_path)
+            self.backup_path = None
+
+    def discard(self):
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        self.finish()
+
+
+def prepare_files(version_files, versions, workers=IO_WORKERS, occurrences=None):
+    """Prepare all the version files for a bump, `workers` at a time.
+
+    `occurrences` is the result of find_versions. Returns a list of
+    PendingFiles, one for each path. If any file fails, the others are
+    discarded and the first failure is raised, so no file is changed.
+    """
+    occurrences = occurrences or {}
+    by_path = {}
+    paths = []
+    for version_file in version_files:
+        if version_file.path not in by_path:
+            paths.append(version_file.path)
+        by_path.setdefault(version_file.path, []).append(version_file)
+    results = _map_files(
+        lambda path: prepare_file(
+            by_path[path],
+            versions,
+            [occurrences.get(version_file.key) for version_file in by_path[path]],
+        ),
+        paths,
+        workers,
+    )
+    pending = [result for result in results if isinstance(result, PendingFile)]
+    errors = [result for result in results if not isinstance(result, PendingFile)]
+    if errors:
+        for pending_file in pending:
+            pending_file.discard()
+        raise errors[0]
+    return pending
+
+
+def find_versions(version_files, current_version, workers=IO_WORKERS):
+    """Find `current_version` in all the version files, `workers` at a time.
+
+    Returns a dict mapping the key of each BumpVersionFile to its
+    VersionOccurrences. Raises the first ValueError or EnvironmentError
+    if the version is missing from any of the files.
+    """
+    results = _map_files(
+        lambda version_file: version_file.find(current_version),
+        version_files,
+        workers,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return dict(
+        (version_file.key, result)
+        for version_file, result in zip(version_files, results)
+    )
+
+
+def _map_files(function, items, workers):
+    """Call `function` on each of `items`, e.g. files, from a thread pool.
+
+    Returns the results in order, with the exception in place of the
+    result for any call that raised one.
+    """
+    if workers > 1 and len(items) > 1:
+        pool = ThreadPool(min(workers, len(items)))
+        try:
+            return pool.map(lambda item: _try(function, item), items)
+        finally:
+            pool.close()
+            pool.join()
+    return [_try(function, item) for item in items]
+
+
+def _try(function, item):
+    try:
+        return function(item)
+    except Exception as exc:  # pylint:disable=broad-except
+        # Raised once all the files are done, so none are left behind
+        return exc
+
+
+def commit_files(pending):
+    """Move all the PendingFiles into place, or none of them."""
+    with _discard_on_error(pending):
+        committed = []
+        try:
+            for pending_file in pending:
+                pending_file.commit()
+                committed.append(pending_file)
+        except Exception:
+            for pending_file in reversed(committed):
+                pending_file.rollback()
+            raise
+    for pending_file in committed:
+        pending_file.finish()
+
+
+@contextmanager
+def _discard_on_error(pending):
+    try:
+        yield
+    except Exception:
+        for pending_file in pending:
+            pending_file.discard()
+        raise
 
 
 @attr.s
@@ -560,13 +3151,7 @@ class Versions(object):
     @classmethod
     def from_bumpversion(cls, bv_wrapper, part):
         """Get the current and next version from bumpversion."""
-        try:
-            return cls(bv_wrapper.current_version, bv_wrapper.get_new_version(part))
-        except subprocess.CalledProcessError as exc:
-            # Handle bumpversion failures
-            click.echo("Failed to get version numbers", err=True)
-            click.echo(exc.output, err=True)
-            raise GetBumpVersionError()
+        return cls(bv_wrapper.current_version, bv_wrapper.get_new_version(part))
 
 
 if __name__ == "__main__":
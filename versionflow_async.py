@@ -0,0 +1,120 @@
+"""Check many versionflow repos at once with asyncio.
+
+This runs the same checks as `versionflow check`, but rather than going
+through GitPython and nu-gitflow one repo at a time it runs the git
+queries for all the repos as concurrent subprocesses, with no more than
+a given number of them running at any one time. It needs Python 3.5 or
+later, so versionflow only imports it for `check --all-under`.
+"""
+import asyncio
+import os
+import subprocess
+import timeit
+
+import git
+
+import versionflow
+
+
+def find_repos(directory):
+    """Return the roots of the git repos under `directory`, in order.
+
+    Repos nested inside other repos, such as submodules, are not included.
+    """
+    repos = []
+    for dirpath, dirnames, _ in os.walk(os.path.abspath(directory)):
+        if os.path.exists(os.path.join(dirpath, ".git")):
+            repos.append(dirpath)
+            dirnames[:] = []
+        else:
+            dirnames.sort()
+    return repos
+
+
+def check_all(repos, bumpversion_config=versionflow.DEFAULT_BV_FILE, concurrency=16):
+    """Check each of `repos`, running up to `concurrency` git processes at once.
+
+    `bumpversion_config` is relative to each repo. Returns a list of
+    (StatusReport, seconds) pairs in the order of `repos`.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            _check_all(repos, bumpversion_config, concurrency))
+    finally:
+        loop.close()
+
+
+async def _check_all(repos, bumpversion_config, concurrency):
+    runner = GitRunner(asyncio.BoundedSemaphore(concurrency))
+    return await asyncio.gather(
+        *[_timed_check(runner, repo, bumpversion_config) for repo in repos]
+    )
+
+
+async def _timed_check(runner, repo, bumpversion_config):
+    start = timeit.default_timer()
+    report = await check_repo(runner, repo, bumpversion_config)
+    return report, timeit.default_timer() - start
+
+
+class GitRunner(object):
+    """Runs git commands, no more than the semaphore allows at once."""
+
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+
+    async def run(self, repo, *args):
+        """Run git in `repo` and return its exit status and output."""
+        async with self.semaphore:
+            versionflow.trace_git(processes=1)
+            proc = await asyncio.create_subprocess_exec(
+                git.Git.GIT_PYTHON_GIT_EXECUTABLE,
+                *args,
+                cwd=repo,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+            output, _ = await proc.communicate()
+        versionflow.trace_git(nbytes=len(output))
+        return proc.returncode, output.decode("utf-8")
+
+
+async def run_steps(runner, repo, steps):
+    """As versionflow.run_steps, but running each list of jobs at once.
+
+    Functions are run in the default executor, as they may block.
+    """
+    loop = asyncio.get_event_loop()
+    results = None
+    while True:
+        try:
+            jobs = steps.send(results)
+        except StopIteration:
+            return
+        results = await asyncio.gather(
+            *[
+                runner.run(repo, *job.args)
+                if isinstance(job, versionflow.GitCommand)
+                else loop.run_in_executor(None, job)
+                for job in jobs
+            ]
+        )
+
+
+async def check_repo(runner, repo, bumpversion_config=versionflow.DEFAULT_BV_FILE):
+    """Check the repo at `repo`, and return a StatusReport."""
+    report = versionflow.StatusReport(repo)
+    config = versionflow.Config(repo, bumpversion_config, quiet=True, report=report)
+    try:
+        with config.get_git_context(False) as git_repo:
+            checks = versionflow.RepoChecks(
+                config, versionflow.RepoSnapshot.for_repo(git_repo, bumpversion_config)
+            )
+            for _, steps in checks.stages():
+                await run_steps(runner, repo, steps)
+    except Exception as exc:  # pylint:disable=broad-except
+        report.error = versionflow.as_versionflow_error(exc)
+        if report.error is None:
+            raise
+    return report